@@ -0,0 +1,333 @@
+"""Arithmetic and logic unit for the 8086 emulator.
+
+Every operation takes the emulator's Flags object, the operand values and
+the operand size in bits (8 or 16), updates the flags the way the 8086
+does and returns the result. Operands may be passed unmasked; they are
+reduced to the operand size first.
+"""
+
+MASK = {8: 0xFF, 16: 0xFFFF}
+SIGN = {8: 0x80, 16: 0x8000}
+
+# PF reflects the low byte of a result: set when it has an even number of 1 bits
+PARITY = tuple(bin(value).count('1') % 2 == 0 for value in range(256))
+
+# (ZF, SF, PF) for every 8-bit result
+SZP8 = tuple((value == 0, bool(value & 0x80), PARITY[value]) for value in range(256))
+
+def set_szp(flags, result, size):
+    """Set ZF, SF and PF from a result already reduced to size bits"""
+    if size == 8:
+        flags.zero, flags.sign, flags.parity = SZP8[result]
+    else:
+        flags.zero = result == 0
+        flags.sign = bool(result & 0x8000)
+        flags.parity = PARITY[result & 0xFF]
+
+def to_signed(value, size):
+    """Interpret an unsigned size-bit value as two's complement"""
+    value &= (1 << size) - 1
+    return value - (1 << size) if value >> (size - 1) else value
+
+# Addition and subtraction
+
+def _add(flags, a, b, carry, size):
+    mask = MASK[size]
+    a &= mask
+    b &= mask
+    result = a + b + carry
+    flags.carry = result > mask
+    flags.auxiliary = bool((a ^ b ^ result) & 0x10)
+    flags.overflow = bool((a ^ result) & (b ^ result) & SIGN[size])
+    result &= mask
+    set_szp(flags, result, size)
+    return result
+
+def _sub(flags, a, b, borrow, size):
+    mask = MASK[size]
+    a &= mask
+    b &= mask
+    result = a - b - borrow
+    flags.carry = result < 0
+    flags.auxiliary = bool((a ^ b ^ result) & 0x10)
+    flags.overflow = bool((a ^ b) & (a ^ result) & SIGN[size])
+    result &= mask
+    set_szp(flags, result, size)
+    return result
+
+def add(flags, a, b, size):
+    return _add(flags, a, b, 0, size)
+
+def adc(flags, a, b, size):
+    return _add(flags, a, b, int(flags.carry), size)
+
+def sub(flags, a, b, size):
+    return _sub(flags, a, b, 0, size)
+
+def sbb(flags, a, b, size):
+    return _sub(flags, a, b, int(flags.carry), size)
+
+def inc(flags, a, size):
+    """INC: like ADD 1 but CF is preserved"""
+    carry = flags.carry
+    result = _add(flags, a, 1, 0, size)
+    flags.carry = carry
+    return result
+
+def dec(flags, a, size):
+    """DEC: like SUB 1 but CF is preserved"""
+    carry = flags.carry
+    result = _sub(flags, a, 1, 0, size)
+    flags.carry = carry
+    return result
+
+def neg(flags, a, size):
+    """NEG: two's complement negation, CF is set unless the operand is 0"""
+    return _sub(flags, 0, a, 0, size)
+
+def not_(flags, a, size):
+    """NOT: one's complement, no flags are affected"""
+    return ~a & MASK[size]
+
+# Logic
+
+def _logic(flags, result, size):
+    flags.carry = False
+    flags.overflow = False
+    flags.auxiliary = False
+    set_szp(flags, result, size)
+    return result
+
+def and_(flags, a, b, size):
+    return _logic(flags, a & b & MASK[size], size)
+
+def or_(flags, a, b, size):
+    return _logic(flags, (a | b) & MASK[size], size)
+
+def xor(flags, a, b, size):
+    return _logic(flags, (a ^ b) & MASK[size], size)
+
+# Shifts and rotates. All run in constant time for any count; a count of
+# zero leaves the operand and the flags untouched.
+
+def shl(flags, value, count, size):
+    if count == 0:
+        return value & MASK[size]
+    mask = MASK[size]
+    value &= mask
+    result = (value << count) & mask
+    flags.carry = bool((value >> (size - count)) & 1) if count <= size else False
+    flags.overflow = bool(result & SIGN[size]) != flags.carry
+    flags.auxiliary = False
+    set_szp(flags, result, size)
+    return result
+
+def shr(flags, value, count, size):
+    if count == 0:
+        return value & MASK[size]
+    value &= MASK[size]
+    result = value >> count
+    # OF is the sign bit of the operand before the final one-bit shift
+    before_last = value >> (count - 1)
+    flags.carry = bool(before_last & 1)
+    flags.overflow = bool(before_last & SIGN[size])
+    flags.auxiliary = False
+    set_szp(flags, result, size)
+    return result
+
+def sar(flags, value, count, size):
+    if count == 0:
+        return value & MASK[size]
+    signed = to_signed(value, size)
+    flags.carry = bool((signed >> (count - 1)) & 1)
+    result = (signed >> count) & MASK[size]
+    flags.overflow = False
+    flags.auxiliary = False
+    set_szp(flags, result, size)
+    return result
+
+def rol(flags, value, count, size):
+    if count == 0:
+        return value & MASK[size]
+    mask = MASK[size]
+    value &= mask
+    n = count % size
+    result = ((value << n) | (value >> (size - n))) & mask
+    flags.carry = bool(result & 1)
+    flags.overflow = bool(result & SIGN[size]) != flags.carry
+    return result
+
+def ror(flags, value, count, size):
+    if count == 0:
+        return value & MASK[size]
+    mask = MASK[size]
+    value &= mask
+    n = count % size
+    result = ((value >> n) | (value << (size - n))) & mask
+    flags.carry = bool(result & SIGN[size])
+    flags.overflow = flags.carry != bool(result & (SIGN[size] >> 1))
+    return result
+
+def rcl(flags, value, count, size):
+    if count == 0:
+        return value & MASK[size]
+    # Rotate the (size + 1)-bit quantity CF:value
+    width = size + 1
+    wide = (int(flags.carry) << size) | (value & MASK[size])
+    n = count % width
+    wide = ((wide << n) | (wide >> (width - n))) & ((1 << width) - 1)
+    result = wide & MASK[size]
+    flags.carry = bool(wide >> size)
+    flags.overflow = bool(result & SIGN[size]) != flags.carry
+    return result
+
+def rcr(flags, value, count, size):
+    if count == 0:
+        return value & MASK[size]
+    width = size + 1
+    wide = (int(flags.carry) << size) | (value & MASK[size])
+    n = count % width
+    wide = ((wide >> n) | (wide << (width - n))) & ((1 << width) - 1)
+    result = wide & MASK[size]
+    flags.carry = bool(wide >> size)
+    flags.overflow = bool(result & SIGN[size]) != bool(result & (SIGN[size] >> 1))
+    return result
+
+# Multiplication and division. The accumulator operand is passed in and the
+# (low, high) or (quotient, remainder) halves are returned.
+
+def mul(flags, a, b, size):
+    product = (a & MASK[size]) * (b & MASK[size])
+    high = product >> size
+    flags.carry = flags.overflow = high != 0
+    return product & MASK[size], high
+
+def imul(flags, a, b, size):
+    product = to_signed(a, size) * to_signed(b, size)
+    low = product & MASK[size]
+    flags.carry = flags.overflow = to_signed(low, size) != product
+    return low, (product >> size) & MASK[size]
+
+def div(dividend, divisor, size):
+    """Unsigned divide of a 2*size-bit dividend"""
+    divisor &= MASK[size]
+    if divisor == 0:
+        raise ValueError("Division by zero")
+    quotient, remainder = divmod(dividend & ((1 << (2 * size)) - 1), divisor)
+    if quotient > MASK[size]:
+        raise ValueError("Divide overflow")
+    return quotient, remainder
+
+def idiv(dividend, divisor, size):
+    """Signed divide of a 2*size-bit dividend, truncating toward zero"""
+    divisor = to_signed(divisor, size)
+    if divisor == 0:
+        raise ValueError("Division by zero")
+    dividend = to_signed(dividend, 2 * size)
+    quotient = abs(dividend) // abs(divisor)
+    if (dividend < 0) != (divisor < 0):
+        quotient = -quotient
+    remainder = dividend - quotient * divisor
+    limit = SIGN[size] - 1
+    if not -limit <= quotient <= limit:
+        raise ValueError("Divide overflow")
+    return quotient & MASK[size], remainder & MASK[size]
+
+# Decimal adjust. These take and return the AL (and AH) register values.
+
+def daa(flags, al):
+    old_al, old_carry = al, flags.carry
+    if (al & 0x0F) > 9 or flags.auxiliary:
+        al += 6
+        flags.carry = old_carry or al > 0xFF
+        al &= 0xFF
+        flags.auxiliary = True
+    else:
+        flags.auxiliary = False
+    if old_al > 0x99 or old_carry:
+        al = (al + 0x60) & 0xFF
+        flags.carry = True
+    else:
+        flags.carry = False
+    set_szp(flags, al, 8)
+    return al
+
+def das(flags, al):
+    old_al, old_carry = al, flags.carry
+    if (al & 0x0F) > 9 or flags.auxiliary:
+        al -= 6
+        flags.carry = old_carry or al < 0
+        al &= 0xFF
+        flags.auxiliary = True
+    else:
+        flags.auxiliary = False
+    if old_al > 0x99 or old_carry:
+        al = (al - 0x60) & 0xFF
+        flags.carry = True
+    else:
+        flags.carry = False
+    set_szp(flags, al, 8)
+    return al
+
+def aaa(flags, al, ah):
+    if (al & 0x0F) > 9 or flags.auxiliary:
+        al = (al + 6) & 0xFF
+        ah = (ah + 1) & 0xFF
+        flags.auxiliary = flags.carry = True
+    else:
+        flags.auxiliary = flags.carry = False
+    return al & 0x0F, ah
+
+def aas(flags, al, ah):
+    if (al & 0x0F) > 9 or flags.auxiliary:
+        al = (al - 6) & 0xFF
+        ah = (ah - 1) & 0xFF
+        flags.auxiliary = flags.carry = True
+    else:
+        flags.auxiliary = flags.carry = False
+    return al & 0x0F, ah
+
+def aam(flags, al, base=10):
+    if base == 0:
+        raise ValueError("Division by zero")
+    ah, al = divmod(al, base)
+    set_szp(flags, al, 8)
+    return al, ah
+
+def aad(flags, al, ah, base=10):
+    al = (ah * base + al) & 0xFF
+    set_szp(flags, al, 8)
+    return al, 0
+
+# Dispatch tables used by the emulator
+
+# Two-operand ALU instructions: (function, whether the result is stored)
+BINARY_OPS = {
+    'add': (add, True),
+    'adc': (adc, True),
+    'sub': (sub, True),
+    'sbb': (sbb, True),
+    'cmp': (sub, False),
+    'and': (and_, True),
+    'or': (or_, True),
+    'xor': (xor, True),
+    'test': (and_, False),
+}
+
+UNARY_OPS = {
+    'inc': inc,
+    'dec': dec,
+    'neg': neg,
+    'not': not_,
+}
+
+SHIFT_OPS = {
+    'shl': shl,
+    'sal': shl,
+    'shr': shr,
+    'sar': sar,
+    'rol': rol,
+    'ror': ror,
+    'rcl': rcl,
+    'rcr': rcr,
+}
@@ -0,0 +1,303 @@
+"""Static control-flow analysis of a decoded program.
+
+The program is split into basic blocks at branch targets and after every
+branch, RET, IRET, HLT and INT. Edges follow the resolved branch targets; a CALL
+has an edge to the procedure and one to the instruction after it, which
+stands in for the return. Code whose address is taken with OFFSET, such
+as an interrupt handler installed in the vector table, is treated as an
+additional entry. From the graph the analysis reports
+
+  * unreachable code: instructions no path from the entry reaches,
+  * trivially infinite loops: strongly connected regions with no edge
+    leaving them, no way to terminate (RET, HLT, INT 21h AH=4Ch) and no
+    input, which therefore can never end. A program that takes a code
+    address with OFFSET or sets a vector with INT 21h AH=25h may install
+    an interrupt handler that ends it from inside any loop, so none of
+    its loops is reported,
+  * the maximum static loop nesting, counted over natural loops (the
+    blocks of a back edge whose target dominates its source).
+
+INT services are identified from a MOV AH/AX with a constant earlier in
+the same block. When the service cannot be determined the INT is assumed
+to possibly read input and terminate, so only loops that certainly run
+forever are reported.
+"""
+
+# INT services that end the program: (interrupt, AH)
+TERMINATING_SERVICES = {(0x21, 0x4C), (0x21, 0x00)}
+
+# INT services that point an interrupt vector at program code: (interrupt, AH)
+VECTOR_SERVICES = {(0x21, 0x25)}
+
+# INT services that wait for input: (interrupt, AH)
+INPUT_SERVICES = {(0x21, 0x01), (0x21, 0x07), (0x21, 0x08), (0x21, 0x0A), (0x21, 0x3F),
+                  (0x16, 0x00), (0x16, 0x01), (0x16, 0x10), (0x16, 0x11)}
+
+# Instructions after which control does not continue to the next one
+_ENDS_BLOCK = ('jmp', 'ret', 'iret', 'hlt', 'int', 'call')
+
+class BasicBlock:
+    """Instructions start..end (inclusive) that always execute together"""
+
+    def __init__(self, index, start, end):
+        self.index = index
+        self.start = start
+        self.end = end
+        self.successors = []  # Block indices; None stands for leaving the program
+        self.predecessors = []
+        self.terminates = False  # May end the program or return to an unknown caller
+        self.reads_input = False
+
+    def __repr__(self):
+        return f"BasicBlock({self.start}..{self.end})"
+
+class ControlFlowGraph:
+    """Basic blocks and edges of a decoded program"""
+
+    def __init__(self, program, entry=0):
+        self.program = program
+        self.entry = entry
+        self.blocks = []
+        self.block_at = {}  # Instruction index of a block's first instruction -> block
+        self._build()
+
+    def _is_branch(self, instruction):
+        return instruction.target is not None or instruction.opcode in _ENDS_BLOCK
+
+    def _build(self):
+        program = self.program
+        if not program:
+            return
+        leaders = {self.entry}
+        self.handlers = set()  # Code addresses taken with OFFSET, e.g. interrupt handlers
+        self.sets_vectors = False  # Whether the program may install interrupt handlers
+        for index, instruction in enumerate(program):
+            for arg in instruction.args:
+                if arg.kind == 'imm' and arg.code_address and arg.value < len(program):
+                    self.handlers.add(arg.value)
+                    leaders.add(arg.value)
+            if instruction.target is not None and instruction.target < len(program):
+                leaders.add(instruction.target)
+            if self._is_branch(instruction) and index + 1 < len(program):
+                leaders.add(index + 1)
+        starts = sorted(leaders)
+        for number, start in enumerate(starts):
+            end = (starts[number + 1] if number + 1 < len(starts) else len(program)) - 1
+            block = BasicBlock(number, start, end)
+            self.blocks.append(block)
+            self.block_at[start] = block
+
+        for block in self.blocks:
+            for target in self._exits(block):
+                successor = self.block_at[target].index if target < len(program) else None
+                if successor not in block.successors:
+                    block.successors.append(successor)
+                if successor is not None:
+                    self.blocks[successor].predecessors.append(block.index)
+
+        # A CALL may end the program or read input if its procedure can
+        for block in self.blocks:
+            last = program[block.end]
+            if last.opcode != 'call' or last.target >= len(program):
+                continue
+            for number in self.reachable(self.block_at[last.target].index):
+                callee = self.blocks[number]
+                block.reads_input |= callee.reads_input
+                if callee.terminates and program[callee.end].opcode != 'ret':
+                    block.terminates = True
+
+    def _exits(self, block):
+        """Instruction indices control may pass to after block; sets block flags"""
+        last = self.program[block.end]
+        following = block.end + 1
+        opcode = last.opcode
+        if opcode == 'jmp':
+            return [last.target]
+        if opcode in ('ret', 'iret', 'hlt'):
+            block.terminates = True
+            return []
+        if last.target is not None:  # Conditional branches, LOOP and CALL
+            return [last.target, following]
+        if opcode == 'int':
+            interrupt, service = self._int_service(block)
+            if (interrupt, service) in VECTOR_SERVICES:
+                self.sets_vectors = True
+            if service is None or (interrupt, service) in INPUT_SERVICES:
+                block.reads_input = True
+            if service is None or (interrupt, service) in TERMINATING_SERVICES:
+                block.terminates = True
+                if service is not None:
+                    return []
+        return [following]
+
+    def _int_service(self, block):
+        """(interrupt, AH) of the INT ending block, with AH None if unknown"""
+        last = self.program[block.end]
+        if len(last.args) != 1 or last.args[0].kind != 'imm':
+            return None, None
+        interrupt = last.args[0].value & 0xFF
+        for index in range(block.end - 1, block.start - 1, -1):
+            instruction = self.program[index]
+            args = instruction.args
+            if not args or args[0].kind != 'reg' or args[0].name not in ('ah', 'ax'):
+                continue
+            if instruction.opcode == 'mov' and args[1].kind == 'imm':
+                value = args[1].value
+                return interrupt, (value if args[0].name == 'ah' else value >> 8) & 0xFF
+            return interrupt, None  # AH computed at run time
+        return interrupt, None
+
+    def reachable(self, start=None):
+        """Indices of the blocks reachable from block start (default: the
+        entry and every handler whose address the program takes)"""
+        if not self.blocks:
+            return set()
+        if start is None:
+            seen = {self.block_at[index].index for index in self.handlers | {self.entry}}
+        else:
+            seen = {start}
+        stack = list(seen)
+        while stack:
+            for successor in self.blocks[stack.pop()].successors:
+                if successor is not None and successor not in seen:
+                    seen.add(successor)
+                    stack.append(successor)
+        return seen
+
+    def strongly_connected(self, blocks):
+        """Strongly connected components among the given block indices"""
+        index_of, low, on_stack = {}, {}, set()
+        stack, components = [], []
+        counter = 0
+        for root in sorted(blocks):
+            if root in index_of:
+                continue
+            work = [(root, 0)]
+            while work:
+                node, position = work.pop()
+                if position == 0:
+                    index_of[node] = low[node] = counter
+                    counter += 1
+                    stack.append(node)
+                    on_stack.add(node)
+                successors = [s for s in self.blocks[node].successors
+                              if s is not None and s in blocks]
+                if position < len(successors):
+                    work.append((node, position + 1))
+                    successor = successors[position]
+                    if successor not in index_of:
+                        work.append((successor, 0))
+                    elif successor in on_stack:
+                        low[node] = min(low[node], index_of[successor])
+                    continue
+                if work:
+                    parent = work[-1][0]
+                    low[parent] = min(low[parent], low[node])
+                if low[node] == index_of[node]:
+                    component = []
+                    while True:
+                        member = stack.pop()
+                        on_stack.discard(member)
+                        component.append(member)
+                        if member == node:
+                            break
+                    components.append(sorted(component))
+        return components
+
+    def dominators(self, blocks):
+        """Map each reachable block to the set of blocks that dominate it"""
+        entry = self.block_at[self.entry].index
+        dominators = {block: set(blocks) for block in blocks}
+        dominators[entry] = {entry}
+        changed = True
+        while changed:
+            changed = False
+            for block in sorted(blocks):
+                if block == entry:
+                    continue
+                predecessors = [p for p in self.blocks[block].predecessors if p in blocks]
+                new = set.intersection(*(dominators[p] for p in predecessors)) if predecessors else set()
+                new = new | {block}
+                if new != dominators[block]:
+                    dominators[block] = new
+                    changed = True
+        return dominators
+
+    def natural_loops(self, blocks):
+        """Map each loop header to the blocks of its natural loop"""
+        dominators = self.dominators(blocks)
+        loops = {}
+        for source in blocks:
+            for header in self.blocks[source].successors:
+                if header is None or header not in dominators[source]:
+                    continue
+                body = loops.setdefault(header, {header})
+                stack = [source]
+                while stack:
+                    node = stack.pop()
+                    if node not in body:
+                        body.add(node)
+                        stack.extend(p for p in self.blocks[node].predecessors if p in blocks)
+        return loops
+
+class AnalysisReport:
+    """Findings of analyze_program()"""
+
+    def __init__(self, unreachable, infinite_loops, max_loop_depth, loop_count):
+        self.unreachable = unreachable  # Source lines never reached
+        self.infinite_loops = infinite_loops  # Source lines of each infinite loop
+        self.max_loop_depth = max_loop_depth
+        self.loop_count = loop_count
+
+    @property
+    def has_infinite_loop(self):
+        return bool(self.infinite_loops)
+
+    def as_dict(self):
+        return {
+            'unreachable_lines': self.unreachable,
+            'infinite_loops': self.infinite_loops,
+            'max_loop_depth': self.max_loop_depth,
+            'loops': self.loop_count,
+        }
+
+def _is_code(instruction):
+    return not instruction.is_directive()
+
+def _lines(cfg, block_indices):
+    lines = []
+    for number in sorted(block_indices):
+        block = cfg.blocks[number]
+        for instruction in cfg.program[block.start:block.end + 1]:
+            if _is_code(instruction) and instruction.line is not None:
+                lines.append(instruction.line)
+    return sorted(set(lines))
+
+def analyze_program(program, entry=0):
+    """Run the static checks over a decoded program"""
+    cfg = ControlFlowGraph(program, entry)
+    if not cfg.blocks:
+        return AnalysisReport([], [], 0, 0)
+    reachable = cfg.reachable()
+    unreachable = _lines(cfg, set(range(len(cfg.blocks))) - reachable)
+
+    infinite = []
+    # An installed interrupt handler can end the program from inside any loop
+    interruptible = bool(cfg.handlers) or cfg.sets_vectors
+    for component in ([] if interruptible else cfg.strongly_connected(reachable)):
+        members = set(component)
+        blocks = [cfg.blocks[number] for number in component]
+        if len(component) == 1 and component[0] not in blocks[0].successors:
+            continue  # A single block without a self edge is not a loop
+        if any(block.terminates or block.reads_input for block in blocks):
+            continue
+        if any(successor is None or successor not in members
+               for block in blocks for successor in block.successors):
+            continue
+        infinite.append(_lines(cfg, members))
+
+    loops = cfg.natural_loops(reachable)
+    depth = 0
+    for block in reachable:
+        depth = max(depth, sum(block in body for body in loops.values()))
+    return AnalysisReport(unreachable, infinite, depth, len(loops))
@@ -1,3 +1,350 @@
+import asyncio
+import re
+import struct
+import time
+from collections import OrderedDict, deque
+
+import emu8086_alu as alu
+from emu8086_cfg import analyze_program
+from emu8086_coverage import CoverageMap
+from emu8086_devices import (DeviceScheduler, IntervalTimer, Keyboard, PortBus, TimerPorts,
+                              IRQ_BASE_VECTOR, PIT_CHANNEL0_PORT, PIT_COMMAND_PORT, scan_code)
+from emu8086_dos import DosError, DosFileSystem, ERROR_INVALID_HANDLE
+from emu8086_errors import InputPending
+from emu8086_heatmap import MemoryHeatmap
+from emu8086_memory import SparseMemory
+from emu8086_metrics import HOOK_EVENTS, EmulatorStats
+from emu8086_optimizer import find_counted_loops
+from emu8086_profiler import CallProfiler
+from emu8086_replay import ADDED, END_OF_INPUT, HANDLER, Recording
+from emu8086_state import load_state, save_state
+from emu8086_timing import CLOCK_RATE, estimated_seconds, instruction_cycles
+from emu8086_video import COLUMNS, ROWS, TEXT_MODE, VIDEO_SEGMENT, TextScreen
+
+# Number of instructions run_async executes before yielding to the event loop
+DEFAULT_BATCH_SIZE = 1000
+
+# Initial stack pointer; the stack shares the 64KB segment with the data
+STACK_TOP = 0xFFFE
+
+# Segment of the vectors served by Python; their offset is the vector number.
+# Any other segment points a vector at an instruction index of the program.
+BIOS_SEGMENT = 0xF000
+
+# Initial vector table: every vector served by Python
+BIOS_VECTORS = b''.join(struct.pack('<HH', vector, BIOS_SEGMENT) for vector in range(256))
+
+# SparseMemory methods wrapped on the instance by memory hooks and the heatmap
+MEMORY_ACCESSORS = ('get_byte', 'get_word', 'read', 'find', 'set_byte', 'set_word', 'write')
+
+# BIOS timer ticks per day; INT 1Ah reports the count since midnight
+TICKS_PER_DAY = 0x1800B0
+
+# Element sizes of the data definition directives
+DATA_DIRECTIVES = {'db': 1, 'dw': 2, 'dd': 4}
+DATA_TYPES = {1: 'byte', 2: 'word', 4: 'dword'}
+DATA_FORMATS = {1: 'B', 2: 'H', 4: 'I'}
+
+DATA_PATTERN = re.compile(r'^(?:([a-z_@?$.][\w@?$.]*)\s*:?\s+)?(db|dw|dd)\s+(.+)$',
+                          re.IGNORECASE)
+DUP_PATTERN = re.compile(r'^(.+?)\s+dup\s*\((.*)\)$', re.IGNORECASE | re.DOTALL)
+LABEL_PATTERN = re.compile(r'^([a-z_@?$.][\w@?$.]*)\s*:(?!:)', re.IGNORECASE)
+
+# Conditional jumps and the flag predicate each one tests
+CONDITIONAL_JUMPS = {
+    'je': lambda f: f.zero,
+    'jz': lambda f: f.zero,
+    'jne': lambda f: not f.zero,
+    'jnz': lambda f: not f.zero,
+    'jc': lambda f: f.carry,
+    'jb': lambda f: f.carry,
+    'jnae': lambda f: f.carry,
+    'jnc': lambda f: not f.carry,
+    'jae': lambda f: not f.carry,
+    'jnb': lambda f: not f.carry,
+    'js': lambda f: f.sign,
+    'jns': lambda f: not f.sign,
+    'jo': lambda f: f.overflow,
+    'jno': lambda f: not f.overflow,
+    'jp': lambda f: f.parity,
+    'jpe': lambda f: f.parity,
+    'jnp': lambda f: not f.parity,
+    'jpo': lambda f: not f.parity,
+    'ja': lambda f: not f.carry and not f.zero,
+    'jnbe': lambda f: not f.carry and not f.zero,
+    'jbe': lambda f: f.carry or f.zero,
+    'jna': lambda f: f.carry or f.zero,
+    'jg': lambda f: not f.zero and f.sign == f.overflow,
+    'jnle': lambda f: not f.zero and f.sign == f.overflow,
+    'jl': lambda f: f.sign != f.overflow,
+    'jnge': lambda f: f.sign != f.overflow,
+    'jge': lambda f: f.sign == f.overflow,
+    'jnl': lambda f: f.sign == f.overflow,
+    'jle': lambda f: f.zero or f.sign != f.overflow,
+    'jng': lambda f: f.zero or f.sign != f.overflow,
+}
+
+# LOOP variants and the extra flag condition checked after CX is decremented
+LOOP_CONDITIONS = {
+    'loop': lambda f: True,
+    'loope': lambda f: f.zero,
+    'loopz': lambda f: f.zero,
+    'loopne': lambda f: not f.zero,
+    'loopnz': lambda f: not f.zero,
+}
+
+SEGMENT_REGISTERS = ('cs', 'ds', 'es', 'ss')
+
+# Shift and rotate instructions, whose second operand is a count
+SHIFT_OPCODES = tuple(alu.SHIFT_OPS)
+
+# Instructions whose single operand is a code label
+BRANCH_OPCODES = set(CONDITIONAL_JUMPS) | set(LOOP_CONDITIONS) | {'jmp', 'jcxz', 'call'}
+
+def split_operands(text):
+    """Split an operand list on commas outside quotes, lowering all but quoted text"""
+    operands = []
+    current = []
+    quote = None
+    for char in text:
+        if quote:
+            current.append(char)
+            if char == quote:
+                quote = None
+        elif char in "'\"":
+            quote = char
+            current.append(char)
+        elif char == ',':
+            operands.append(''.join(current).strip())
+            current = []
+        else:
+            current.append(char.lower())
+    operands.append(''.join(current).strip())
+    return operands
+
+def split_data_items(text):
+    """Split a data definition list on commas outside quotes and parentheses"""
+    items = []
+    current = []
+    quote = None
+    depth = 0
+    for char in text:
+        if quote:
+            if char == quote:
+                quote = None
+        elif char in "'\"":
+            quote = char
+        elif char == '(':
+            depth += 1
+        elif char == ')':
+            depth -= 1
+        elif char == ',' and depth == 0:
+            items.append(''.join(current).strip())
+            current = []
+            continue
+        current.append(char)
+    items.append(''.join(current).strip())
+    return items
+
+def strip_comment(line):
+    """Remove a ';' comment, ignoring semicolons inside quotes"""
+    quote = None
+    for i, char in enumerate(line):
+        if quote:
+            if char == quote:
+                quote = None
+        elif char in "'\"":
+            quote = char
+        elif char == ';':
+            return line[:i]
+    return line
+
+def parse_number(text):
+    """Parse a numeric or character literal, returning None if text is not one"""
+    text = text.strip()
+    negative = text.startswith('-')
+    if negative:
+        text = text[1:].strip()
+    if len(text) >= 3 and text[0] == text[-1] and text[0] in "'\"":
+        value = 0
+        for char in text[1:-1]:
+            value = (value << 8) | (ord(char) & 0xFF)
+    elif not text or not text[0].isdigit():
+        return None
+    else:
+        text = text.lower()
+        try:
+            if text.startswith('0x'):
+                value = int(text[2:], 16)
+            elif text.endswith('h'):
+                value = int(text[:-1], 16)
+            elif text.endswith('b'):
+                value = int(text[:-1], 2)
+            elif text.endswith('o') or text.endswith('q'):
+                value = int(text[:-1], 8)
+            elif text.endswith('d'):
+                value = int(text[:-1])
+            else:
+                value = int(text)
+        except ValueError:
+            raise ValueError(f"Invalid number: {text}")
+    return -value if negative else value
+
+# Registers that may appear inside a memory operand
+BASE_REGISTERS = ('bx', 'bp')
+INDEX_REGISTERS = ('si', 'di')
+
+ADDRESS_TERM = re.compile(r'([+-])?\s*([^+\-]+)')
+PTR_PREFIX = re.compile(r'^(byte|word)\s+ptr\s+(.+)$')
+SEGMENT_PREFIX = re.compile(r'^(cs|ds|es|ss)\s*:\s*(.+)$')
+
+# Operand sizes selected by BYTE PTR / WORD PTR
+PTR_SIZES = {'byte': 8, 'word': 16}
+
+def make_address_calculator(registers, displacement):
+    """Build a function computing an effective address from the register file.
+
+    The displacement is folded at load time, so at run time the calculator
+    only adds the current values of the base and index registers.
+    """
+    displacement &= 0xFFFF
+    if not registers:
+        return lambda regs: displacement
+    if len(registers) == 1:
+        base, = registers
+        return lambda regs: (regs[base].value + displacement) & 0xFFFF
+    base, index = registers
+    return lambda regs: (regs[base].value + regs[index].value + displacement) & 0xFFFF
+
+class RegisterOperand:
+    """A register operand"""
+
+    kind = 'reg'
+
+    def __init__(self, text, size):
+        self.text = text
+        self.name = text
+        self.size = size
+
+    def read(self, emu):
+        return emu.registers[self.name].value
+
+    def write(self, emu, value):
+        emu.set_register_value(self.name, value)
+
+class ImmediateOperand:
+    """A constant operand, including folded 'offset var' expressions"""
+
+    kind = 'imm'
+    size = None
+    code_address = False  # True for 'offset label', the label's instruction index
+
+    def __init__(self, text, value):
+        self.text = text
+        self.value = value
+
+    def read(self, emu):
+        return self.value
+
+    def write(self, emu, value):
+        raise ValueError(f"Invalid destination operand: {self.text}")
+
+class MemoryOperand:
+    """A memory operand with a precompiled effective-address calculator.
+
+    size is 8 or 16 once known. It comes from BYTE PTR / WORD PTR when
+    given (explicit_size), otherwise from the register the operand is
+    paired with, otherwise from the type of the variable it names.
+    """
+
+    kind = 'mem'
+
+    def __init__(self, text, registers, displacement, size=None, explicit_size=False,
+                 segment=None):
+        self.text = text
+        self.registers = tuple(registers)
+        self.displacement = displacement & 0xFFFF
+        self.size = size
+        self.explicit_size = explicit_size
+        self.segment = segment  # Segment override
+        self.address = make_address_calculator(self.registers, displacement)
+        if segment is not None:
+            # All segments share one space except video memory, which is
+            # reached through a segment register holding B800h
+            self.read = self._read_segment
+            self.write = self._write_segment
+
+    def read(self, emu):
+        if self.size == 16:
+            return emu.data_segment.get_memory_word(self.address(emu.registers))
+        return emu.data_segment.get_memory_byte(self.address(emu.registers))
+
+    def write(self, emu, value):
+        if self.size == 16:
+            emu.data_segment.set_memory_word(self.address(emu.registers), value)
+        else:
+            emu.data_segment.set_memory_byte(self.address(emu.registers), value)
+
+    def _read_segment(self, emu):
+        memory = emu.segment_memory(self.segment)
+        if self.size == 16:
+            return memory.get_word(self.address(emu.registers))
+        return memory.get_byte(self.address(emu.registers))
+
+    def _write_segment(self, emu, value):
+        memory = emu.segment_memory(self.segment)
+        if self.size == 16:
+            memory.set_word(self.address(emu.registers), value)
+        else:
+            memory.set_byte(self.address(emu.registers), value)
+
+class Instruction:
+    """A decoded instruction with its operands split and branch target resolved"""
+
+    def __init__(self, text, line=None):
+        self.text = text
+        self.line = line  # Source line number (1-based)
+        self.target = None  # Resolved instruction index for branches
+        self.args = []  # Compiled operands, filled in by Emulator.decode_instruction
+        self.loop_plan = None  # Closed-form plan when this closes a counted loop
+        self.fused = None  # Handler running this and the next instruction together
+        self.cycles = 0  # Clock cycles, filled in by Emulator.decode_instruction
+        self.taken_cycles = 0  # Extra cycles when a branch jumps
+        tokens = text.lower().split()
+        self.tokens = tokens
+        self.opcode = tokens[0] if tokens else ''
+        if len(tokens) > 1:
+            self.operands = split_operands(text.split(None, 1)[1])
+        else:
+            self.operands = []
+
+        if self.opcode in BRANCH_OPCODES:
+            if len(self.operands) != 1:
+                raise ValueError(f"{self.opcode.upper()} instruction requires one operand")
+            # Distance hints carry no meaning for label-based jumps
+            label = self.operands[0]
+            for hint in ('short ', 'near ', 'far '):
+                if label.startswith(hint):
+                    label = label[len(hint):].strip()
+            self.operands = [label]
+
+    def resolve_target(self, labels):
+        """Resolve the label operand of a branch to an instruction index"""
+        if self.opcode in BRANCH_OPCODES:
+            label = self.operands[0]
+            if label not in labels:
+                raise ValueError(f"Undefined label: {label}")
+            self.target = labels[label]
+
+    def is_directive(self):
+        """Check for PROC/ENDP/END lines, which execute as no-ops"""
+        tokens = self.tokens
+        return bool(tokens) and (tokens[0] in ('end', 'endp') or
+                                 (len(tokens) > 1 and tokens[1] in ('proc', 'endp')))
+
+    def __str__(self):
+        return self.text
+
 class Register:
     def __init__(self, name, size=16):
         self.name = name
@@ -19,48 +366,111 @@ class Flags:
         self.overflow = False  # Overflow flag (OF)
         self.auxiliary = False # Auxiliary flag (AF)
         self.parity = False   # Parity flag (PF)
+        self.interrupt = True  # Interrupt enable flag (IF), set by DOS
 
-    def update_flags(self, result, size=16):
-        mask = (1 << size) - 1
-        result &= mask
+    # Bit positions in the FLAGS register
+    BITS = (('carry', 0), ('parity', 2), ('auxiliary', 4), ('zero', 6),
+            ('sign', 7), ('interrupt', 9), ('overflow', 11))
 
-        # Zero flag
-        self.zero = (result == 0)
+    def to_word(self):
+        """Pack the flags into a FLAGS register value"""
+        value = 0xF002  # Reserved bits read as 1 on the 8086
+        for name, bit in self.BITS:
+            if getattr(self, name):
+                value |= 1 << bit
+        return value
 
-        # Sign flag
-        self.sign = bool(result & (1 << (size - 1)))
+    def from_word(self, value):
+        """Unpack a FLAGS register value"""
+        for name, bit in self.BITS:
+            setattr(self, name, bool(value & (1 << bit)))
 
-        # Parity flag
-        self.parity = bin(result).count('1') % 2 == 0
+    def update_flags(self, result, size=16):
+        """Set ZF, SF and PF from a result"""
+        alu.set_szp(self, result & alu.MASK[size], size)
 
 class DataSegment:
     def __init__(self):
         self.variables = {}
-        self.memory = bytearray(65536)  # 64KB memory
+        self.memory = SparseMemory(0x10000)  # 64KB, allocated a page at a time
         self.current_offset = 0
 
-    def define_variable(self, name, value, size=1):
-        """Define a variable in the data segment"""
-        name = name.lower().strip()  # Normalize variable names
+    def define_variable(self, name, value, size=1, element_type=None):
+        """Define a variable in the data segment.
+
+        value is raw bytes, a string stored one byte per character, or an
+        integer stored as a little-endian value of size bytes. size is the
+        element size (1 for DB, 2 for DW, 4 for DD). name may be None for
+        data that continues the previous variable.
+        """
         if isinstance(value, str):
-            # Store string in memory
-            for i, char in enumerate(value):
-                if char == '$':  # End of string marker
-                    break
-                self.memory[self.current_offset + i] = ord(char)
-            self.memory[self.current_offset + len(value)] = ord('$')  # Add string terminator
-            size = len(value) + 1
+            data = value.encode('latin-1')
+        elif isinstance(value, int):
+            data = (value & ((1 << (8 * size)) - 1)).to_bytes(size, 'little')
         else:
-            # Store numeric value
-            self.memory[self.current_offset] = value & 0xFF
-
-        # Store variable information
-        self.variables[name] = {
-            'offset': self.current_offset,
-            'size': size,
-            'value': value
-        }
-        self.current_offset += size
+            data = bytes(value)
+
+        offset = self.current_offset
+        end = offset + len(data)
+        if end > len(self.memory):
+            raise ValueError("Data segment overflow")
+        self.memory.write(offset, data)
+
+        if name is not None:
+            name = name.lower().strip()  # Normalize variable names
+            if name in self.variables:
+                raise ValueError(f"Duplicate variable: {name}")
+            self.variables[name] = {
+                'offset': offset,
+                'size': len(data),
+                'element_size': size,
+                'type': element_type or DATA_TYPES[size],
+                'count': len(data) // size,
+            }
+        self.current_offset = end
+        return offset
+
+    def encode_data(self, text, size):
+        """Encode a DB/DW/DD operand list into bytes.
+
+        Supports comma lists of numbers, quoted strings, '?', variable
+        offsets and nested 'N dup(...)' groups. Repeated groups are built
+        with bytes multiplication, so large buffers cost no Python loop.
+        """
+        chunks = []
+        values = []  # Run of numeric elements, packed in one call
+        mask = (1 << (8 * size)) - 1
+        for item in split_data_items(text):
+            if not item:
+                raise ValueError(f"Empty item in data definition: {text}")
+            if item.isdigit():
+                values.append(int(item) & mask)
+                continue
+            dup = DUP_PATTERN.match(item)
+            if dup:
+                count = parse_number(dup.group(1))
+                if count is None or count < 0:
+                    raise ValueError(f"Invalid DUP count: {dup.group(1)}")
+                block = self.encode_data(dup.group(2), size) * count
+            elif item == '?':
+                values.append(0)
+                continue
+            elif size == 1 and len(item) >= 2 and item[0] == item[-1] and item[0] in "'\"":
+                block = item[1:-1].encode('latin-1')
+            else:
+                value = parse_number(item)
+                if value is None:
+                    # A variable name stores that variable's offset
+                    value = self.get_variable_offset(item)
+                values.append(value & mask)
+                continue
+            if values:
+                chunks.append(struct.pack(f'<{len(values)}{DATA_FORMATS[size]}', *values))
+                values = []
+            chunks.append(block)
+        if values:
+            chunks.append(struct.pack(f'<{len(values)}{DATA_FORMATS[size]}', *values))
+        return b''.join(chunks)
 
     def get_variable_offset(self, name):
         """Get the offset of a variable"""
@@ -80,13 +490,82 @@ class DataSegment:
         """Get a byte from memory"""
         if isinstance(offset, str):
             offset = self.get_variable_offset(offset)
-        return self.memory[offset]
+        return self.memory.get_byte(offset)
 
     def set_memory_byte(self, offset, value):
         """Set a byte in memory"""
         if isinstance(offset, str):
             offset = self.get_variable_offset(offset)
-        self.memory[offset] = value & 0xFF
+        self.memory.set_byte(offset, value)
+
+    def get_memory_word(self, offset):
+        """Get a little-endian word from memory; offset 0xFFFF wraps to 0"""
+        if isinstance(offset, str):
+            offset = self.get_variable_offset(offset)
+        return self.memory.get_word(offset)
+
+    def set_memory_word(self, offset, value):
+        """Set a little-endian word in memory"""
+        if isinstance(offset, str):
+            offset = self.get_variable_offset(offset)
+        self.memory.set_word(offset, value)
+
+class ProgramImage:
+    """A parsed program that can be installed into any Emulator.
+
+    Decoded instructions are never modified while a program runs, so they
+    are shared between emulators; the initial data pages are shared
+    copy-on-write.
+    """
+
+    def __init__(self, emu):
+        self.source = emu.source
+        self.instructions = emu.instructions
+        self.program = emu.program
+        self.labels = emu.labels
+        self.variables = emu.data_segment.variables
+        self.data_size = emu.data_segment.current_offset
+        self.memory = emu.data_segment.memory.fork()
+
+    def install(self, emu):
+        emu.source = self.source
+        emu.instructions = self.instructions
+        emu.program = self.program
+        emu.labels = self.labels
+        emu.data_segment = DataSegment()
+        emu.data_segment.variables = self.variables
+        emu.data_segment.current_offset = self.data_size
+        emu.data_segment.memory = self.memory.fork()
+        emu._address_cache = {}
+        emu.current_instruction_index = 0
+        emu.halted = False
+        emu._apply_memory_hooks()
+        if emu.coverage is not None:
+            emu.enable_coverage()
+
+class ProgramCache:
+    """Least-recently-used cache of parsed programs keyed by source text"""
+
+    def __init__(self, max_entries=64):
+        self.max_entries = max_entries
+        self.images = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, source):
+        image = self.images.get(source)
+        if image is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.images.move_to_end(source)
+        return image
+
+    def put(self, source, image):
+        self.images[source] = image
+        self.images.move_to_end(source)
+        while len(self.images) > self.max_entries:
+            self.images.popitem(last=False)
 
 class Emulator:
     def __init__(self):
@@ -100,7 +579,10 @@ class Emulator:
             'di': Register('di'),
             'bp': Register('bp'),
             'sp': Register('sp'),
-            'ds': Register('ds')
+            'cs': Register('cs'),
+            'ds': Register('ds'),
+            'es': Register('es'),
+            'ss': Register('ss')
         }
 
         # Initialize 8-bit registers
@@ -115,6 +597,8 @@ class Emulator:
             'dh': Register('dh', 8)
         })
 
+        self.registers['sp'].set(STACK_TOP)
+
         # Initialize flags
         self.flags = Flags()
         
@@ -134,45 +618,643 @@ class Emulator:
         # I/O handler
         self.io_handler = None
 
+        # Opcode dispatch table
+        self.handlers = self._build_handlers()
+        self._blocking_input = True
+        self._interrupt_return = 0  # Instruction index IRET resumes at
+
+        # Compiled address expressions used by get/set_memory_byte
+        self._address_cache = {}
+
+        # Skip iterations of recognized counted loops in closed form.
+        # Turn off for teaching mode, where every iteration should be visible.
+        self.loop_fast_forward = True
+
+        # Execute common instruction pairs through fused handlers in run()
+        self.superinstructions = True
+
+        # Instruction indices where run() stops
+        self.breakpoints = set()
+        self.at_breakpoint = False
+
+        # Call-graph profiler, created by enable_profiling()
+        self.profiler = None
+
+        # Executed-instruction bitmap, created by enable_coverage()
+        self.coverage = None
+
+        # Recording of input and output, created by start_recording()
+        self.recorder = None
+
+        # Per-byte access counts of data memory, created by enable_heatmap()
+        self.heatmap = None
+
+        # Run statistics (may be shared between emulators) and the
+        # callbacks registered with add_hook(), by event
+        self.stats = EmulatorStats()
+        self.hooks = {event: [] for event in HOOK_EVENTS}
+
         # Add labels dictionary for jumps
         self.labels = {}
         self.current_instruction_index = 0
         self.instructions = []
+        self.program = []  # Decoded form of self.instructions
+        self.source = ''  # Source text of the loaded program
+
+        # Execution state
+        self.halted = False
+        self.waiting_for_input = False
+        self.instruction_count = 0
+        self.input_buffer = deque()  # BIOS type-ahead buffer
+        self.output_buffer = []
+        self._input_event = None
+
+        # Emulated clock and the devices driven by it
+        self.cycles = 0
+        self.scheduler = DeviceScheduler()
+        self.timer = IntervalTimer(self)
+        self.keyboard = Keyboard(self)
+        self.pending_irqs = []
+        self.bios_ticks = 0
+        self.timer.start(self.cycles)
+
+        # I/O ports reached by IN and OUT
+        self.ports = PortBus()
+        self.timer_ports = TimerPorts(self)
+        self.ports.register(self.timer_ports, PIT_CHANNEL0_PORT, PIT_COMMAND_PORT)
+
+        # Text screen at B800h
+        self.screen = TextScreen()
+
+        # DOS file handles; file services are refused until set_sandbox()
+        self.files = DosFileSystem()
+
+        # Built-in interrupt services by vector
+        self.interrupt_services = self._builtin_services()
+        # Python handlers of single functions, by vector and then AH
+        self.function_services = {}
+
+        # Interrupt vector table: 256 offset:segment pairs in low memory
+        self.vector_table = SparseMemory(0x400)
+        self._reset_vectors()
 
     def set_io_handler(self, handler):
         """Set the I/O handler for input/output operations"""
         self.io_handler = handler
 
+    def _builtin_services(self):
+        return {
+            0x08: self.handle_int_08h,
+            0x09: self.handle_int_09h,
+            0x10: self.handle_int_10h,
+            0x16: self.handle_int_16h,
+            0x1A: self.handle_int_1ah,
+            0x1C: self.handle_int_1ch,
+            0x21: self.handle_int_21h,
+        }
+
+    def unload(self):
+        """Reset and drop everything attached since the emulator was created:
+        the program, I/O handler, breakpoints, hooks, profiling, coverage,
+        heatmap, recording, sandbox, and services and port devices installed
+        from Python. The statistics object is kept."""
+        self.io_handler = None
+        self.recorder = None
+        self.profiler = None
+        self.coverage = None
+        self.heatmap = None
+        self.hooks = {event: [] for event in HOOK_EVENTS}
+        self.__dict__.pop('step', None)
+        self.breakpoints = set()
+        self.loop_fast_forward = True
+        self.superinstructions = True
+        self.interrupt_services = self._builtin_services()
+        self.function_services = {}
+        self.ports = PortBus()
+        self.ports.register(self.timer_ports, PIT_CHANNEL0_PORT, PIT_COMMAND_PORT)
+        self.files.close_all()
+        self.files = DosFileSystem()
+        self.reset()
+        self.source = ''
+        self.instructions = []
+        self.program = []
+        self.labels = {}
+
     def reset(self):
         """Reset the emulator state"""
         for reg in self.registers.values():
             reg.set(0)
+        self.registers['sp'].set(STACK_TOP)
         self.flags = Flags()
         self.data_segment = DataSegment()
+        self._address_cache = {}
         self.ip = 0
         self.current_segment = None
         self.current_proc = None
+        self.current_instruction_index = 0
+        self.halted = False
+        self.waiting_for_input = False
+        self.at_breakpoint = False
+        self.instruction_count = 0
+        self.input_buffer.clear()
+        self.output_buffer = []
+        self.cycles = 0
+        self.scheduler.clear()
+        self.keyboard.clear()
+        self.pending_irqs = []
+        self.bios_ticks = 0
+        self.timer.start(self.cycles)
+        self.files.close_all()
+        self._reset_vectors()
+        self.screen.reset()
+        self._apply_memory_hooks()
+        if self.profiler is not None:
+            self.enable_profiling()
+        if self.coverage is not None:
+            self.enable_coverage()
+
+    def fork(self):
+        """Create a child emulator that continues from the current state.
+
+        Memory pages are shared copy-on-write and the decoded program is
+        shared outright, so a fork costs little more than copying the
+        registers. Input and unread output, pending device events and
+        interrupt services and port devices installed from Python are carried
+        over (the devices are shared), and open files are reopened at the
+        same positions. The
+        child has no I/O handler, breakpoints and coverage marks are copied
+        and profiling is off.
+        """
+        child = Emulator()
+        for name, register in self.registers.items():
+            child.registers[name].value = register.value
+        child.flags.__dict__.update(self.flags.__dict__)
+
+        child.data_segment.variables = self.data_segment.variables
+        child.data_segment.current_offset = self.data_segment.current_offset
+        child.data_segment.memory = self.data_segment.memory.fork()
+        child._address_cache = dict(self._address_cache)
+
+        child.source = self.source
+        child.labels = self.labels
+        child.instructions = self.instructions
+        child.program = self.program
+        child.current_segment = self.current_segment
+        child.current_proc = self.current_proc
+        child.current_instruction_index = self.current_instruction_index
+        child.halted = self.halted
+        child.waiting_for_input = self.waiting_for_input
+        child.instruction_count = self.instruction_count
+        child.input_buffer = deque(self.input_buffer)
+        child.output_buffer = list(self.output_buffer)
+        child.loop_fast_forward = self.loop_fast_forward
+        child.superinstructions = self.superinstructions
+        child.breakpoints = set(self.breakpoints)
+        if self.coverage is not None:
+            child.coverage = bytearray(self.coverage)
+
+        child.cycles = self.cycles
+        child.scheduler.clear()
+        child.timer.divisor = self.timer.divisor
+        child.timer.start_at(self.timer.next_tick)
+        self.keyboard.copy_to(child.keyboard)
+        child.pending_irqs = list(self.pending_irqs)
+        child.bios_ticks = self.bios_ticks
+        child.files = self.files.fork()
+        self.screen.copy_to(child.screen)
+        for vector, service in self.interrupt_services.items():
+            if getattr(service, '__self__', None) is not self:
+                child.interrupt_services[vector] = service
+        child.function_services = {vector: dict(functions)
+                                   for vector, functions in self.function_services.items()}
+        child.vector_table = self.vector_table.fork()
+        for port, device in self.ports.devices.items():
+            if device is not self.timer_ports:
+                child.ports.register(device, port)
+        return child
+
+    def set_sandbox(self, root):
+        """Serve the DOS file services from files inside directory root"""
+        self.files.close_all()
+        self.files = DosFileSystem(root)
+
+    def enable_coverage(self):
+        """Start marking executed instructions, clearing earlier marks"""
+        self.coverage = bytearray(len(self.program))
+
+    def disable_coverage(self):
+        self.coverage = None
+
+    def get_coverage(self, name='program.asm'):
+        """CoverageMap holding the run recorded since coverage was enabled"""
+        coverage = CoverageMap(self.program, name)
+        if self.coverage is not None:
+            coverage.add_run(self.coverage)
+        return coverage
+
+    def enable_heatmap(self, heatmap=None):
+        """Count reads and writes of every data memory byte in heatmap, or
+        in a new MemoryHeatmap. The counts are kept across reset() and
+        program loads until the heatmap is enabled again."""
+        self.heatmap = heatmap if heatmap is not None else MemoryHeatmap(len(self.data_segment.memory))
+        self._apply_memory_hooks()
+        return self.heatmap
+
+    def disable_heatmap(self):
+        self.heatmap = None
+        self._apply_memory_hooks()
+
+    def enable_profiling(self):
+        """Start recording a per-procedure call profile"""
+        self.profiler = CallProfiler(self.entry_name(), self.instruction_count)
+        return self.profiler
+
+    def disable_profiling(self):
+        self.profiler = None
+
+    def entry_name(self):
+        """Name of the first procedure in the program, used as the profile root"""
+        for instruction in self.program:
+            if len(instruction.tokens) > 1 and instruction.tokens[1] == 'proc':
+                return instruction.tokens[0]
+        return 'main'
+
+    def get_profile(self):
+        """Per-procedure calls and inclusive/exclusive instructions and time"""
+        if self.profiler is None:
+            raise ValueError("Profiling is not enabled")
+        return self.profiler.report(self.instruction_count)
+
+    def get_collapsed_stacks(self, metric='instructions'):
+        """Profile in collapsed-stack format for flame graph tools"""
+        if self.profiler is None:
+            raise ValueError("Profiling is not enabled")
+        return self.profiler.collapsed_stacks(self.instruction_count, metric)
+
+    def start_recording(self):
+        """Record input events and output for replay; call after loading
+        the program and before running it"""
+        return Recording.start(self)
+
+    def stop_recording(self):
+        """Finish and return the recording"""
+        if self.recorder is None:
+            raise ValueError("Recording is not active")
+        return self.recorder.stop(self)
+
+    def get_stats(self):
+        """Run statistics as a dict (see emu8086_metrics.EmulatorStats)"""
+        return self.stats.as_dict(len(self.data_segment.memory.pages))
+
+    def add_hook(self, event, callback):
+        """Call callback on an event named in emu8086_metrics.HOOK_EVENTS.
+
+        Instruction hooks make run() step one instruction at a time, without
+        fused pairs; a fast-forwarded loop is still a single step. Memory
+        write hooks see writes to the data segment. Nothing is checked on
+        the hot paths while no hook of an event is registered.
+        """
+        if event not in self.hooks:
+            raise ValueError(f"Unknown hook event: {event}")
+        self.hooks[event].append(callback)
+        self._apply_hooks()
+
+    def remove_hook(self, event, callback):
+        self.hooks[event].remove(callback)
+        self._apply_hooks()
+
+    def _apply_hooks(self):
+        if self.hooks['before_instruction'] or self.hooks['after_instruction']:
+            self.step = self._hooked_step
+        else:
+            self.__dict__.pop('step', None)
+        self._apply_memory_hooks()
+
+    def _hooked_step(self, blocking_input=True, fuse=False):
+        """step() with the instruction hooks around it"""
+        if self.is_finished():
+            return False
+        index = self.current_instruction_index
+        for hook in self.hooks['before_instruction']:
+            hook(self, index)
+        running = Emulator.step(self, blocking_input)
+        for hook in self.hooks['after_instruction']:
+            hook(self, index)
+        return running
+
+    def _apply_memory_hooks(self):
+        """Wrap the access methods of data memory while memory write hooks
+        are registered or the heatmap is on, and restore the class methods
+        otherwise"""
+        memory = self.data_segment.memory
+        for name in MEMORY_ACCESSORS:
+            memory.__dict__.pop(name, None)
+        heatmap = self.heatmap
+        observers = list(self.hooks['memory_write'])
+        if heatmap is not None:
+            observers.append(lambda emu, address, length: heatmap.count_writes(address, length))
+            get_byte, get_word, read, find = memory.get_byte, memory.get_word, memory.read, memory.find
+
+            def counted_get_byte(address):
+                heatmap.count_reads(address, 1)
+                return get_byte(address)
+
+            def counted_get_word(address):
+                heatmap.count_reads(address, 2)
+                return get_word(address)
+
+            def counted_read(address, length):
+                heatmap.count_reads(address, length)
+                return read(address, length)
+
+            def counted_find(value, address, end=None):
+                found = find(value, address, end)
+                last = found if found >= 0 else (memory.size if end is None else end) - 1
+                heatmap.count_reads(address, last - address + 1)
+                return found
+
+            memory.get_byte = counted_get_byte
+            memory.get_word = counted_get_word
+            memory.read = counted_read
+            memory.find = counted_find
+        if not observers:
+            return
+        set_byte, set_word, write = memory.set_byte, memory.set_word, memory.write
+
+        def hooked_set_byte(address, value):
+            set_byte(address, value)
+            for hook in observers:
+                hook(self, address, 1)
+
+        def hooked_set_word(address, value):
+            set_word(address, value)
+            for hook in observers:
+                hook(self, address, 2)
+
+        def hooked_write(address, data):
+            write(address, data)
+            for hook in observers:
+                hook(self, address, len(data))
+
+        memory.set_byte = hooked_set_byte
+        memory.set_word = hooked_set_word
+        memory.write = hooked_write
+
+    def add_input(self, text):
+        """Queue input characters for INT 21h input services"""
+        self.stats.input_bytes += len(text)
+        if self.recorder is not None:
+            self.recorder.record_input(ADDED, self.instruction_count, text, self.cycles)
+        self.input_buffer.extend(text)
+        if self._input_event is not None:
+            self._input_event.set()
+
+    def get_output(self):
+        """Return and clear output produced while no I/O handler was set"""
+        output = ''.join(self.output_buffer)
+        self.output_buffer = []
+        return output
+
+    def write_output(self, text):
+        """Send output to the I/O handler, or buffer it if there is none"""
+        self.stats.output_bytes += len(text)
+        if self.recorder is not None:
+            self.recorder.record_output(text)
+        if self.io_handler:
+            self.io_handler.handle_output(text)
+        else:
+            self.output_buffer.append(text)
+
+    def is_finished(self):
+        """Check whether the program has terminated or run off its end"""
+        return self.halted or self.current_instruction_index >= len(self.instructions)
+
+    def step(self, blocking_input=True, fuse=False):
+        """Execute the instruction at the current index and advance.
+
+        Returns False once the program has finished. If the instruction
+        needs input that is not available, the index is left unchanged,
+        waiting_for_input is set and InputPending is raised. With fuse set,
+        a fused instruction pair executes in one dispatch unless a
+        breakpoint sits on its second instruction.
+        """
+        if self.is_finished():
+            return False
+        if self.cycles >= self.scheduler.next_deadline:
+            self.scheduler.run_due(self.cycles)
+        if self.pending_irqs and self.flags.interrupt:
+            self.service_irqs(at_boundary=True)
+        index = self.current_instruction_index
+        instruction = self.program[index]
+        if self.coverage is not None:
+            self.coverage[index] = 1
+        plan = instruction.loop_plan
+        if (plan is not None and self.loop_fast_forward
+                and not self._breakpoint_between(plan.head, index)
+                and plan.fast_forward(self)):
+            return True
+        try:
+            if (fuse and instruction.fused is not None
+                    and not (self.breakpoints and index + 1 in self.breakpoints)):
+                second = self.program[index + 1]
+                result = instruction.fused(self, instruction, second)
+                if self.coverage is not None:
+                    self.coverage[index + 1] = 1
+                if result != "jump":
+                    self.current_instruction_index += 2
+                else:
+                    self.cycles += second.taken_cycles
+                self.instruction_count += 2
+                self.cycles += instruction.cycles + second.cycles
+            else:
+                result = self.execute_instruction(instruction, blocking_input)
+                if result != "jump":
+                    self.current_instruction_index += 1
+                else:
+                    self.cycles += instruction.taken_cycles
+                self.instruction_count += 1
+                self.cycles += instruction.cycles
+        except InputPending:
+            self.waiting_for_input = True
+            raise
+        self.waiting_for_input = False
+        return not self.is_finished()
+
+    def _breakpoint_between(self, first, last):
+        """Check for a breakpoint on any instruction index in [first, last]"""
+        return bool(self.breakpoints) and any(first <= index <= last
+                                              for index in self.breakpoints)
+
+    def set_breakpoint(self, index):
+        """Stop run() before executing the instruction at index"""
+        self.breakpoints.add(index)
+
+    def clear_breakpoint(self, index):
+        self.breakpoints.discard(index)
+
+    def run(self, max_instructions=None, blocking_input=True):
+        """Run until the program finishes, needs input or hits the limit.
+
+        Returns the number of instructions executed. A fast-forwarded loop
+        counts all of its skipped instructions, so it may overshoot the limit.
+        """
+        start, start_cycles = self.instruction_count, self.cycles
+        start_time = time.perf_counter()
+        self.at_breakpoint = False
+        first = True
+        while max_instructions is None or self.instruction_count - start < max_instructions:
+            if (self.breakpoints and not first
+                    and self.current_instruction_index in self.breakpoints):
+                self.at_breakpoint = True
+                break
+            first = False
+            try:
+                running = self.step(blocking_input, self.superinstructions)
+            except InputPending:
+                break
+            if not running:
+                break
+        self.ports.flush()
+        stats = self.stats
+        stats.runs += 1
+        stats.run_seconds += time.perf_counter() - start_time
+        stats.instructions += self.instruction_count - start
+        stats.cycles += self.cycles - start_cycles
+        return self.instruction_count - start
+
+    def sync_devices(self):
+        """Apply the buffered side effects of port devices, as run() does on return"""
+        self.ports.flush()
+
+    def estimated_time(self, clock_rate=CLOCK_RATE):
+        """Seconds the cycles executed so far take on a real clock_rate machine"""
+        return estimated_seconds(self.cycles, clock_rate)
+
+    def _pace_delay(self, start_time, start_cycles, clock_rate):
+        """Seconds to wait for the wall clock to catch up with the emulated one"""
+        due = start_time + (self.cycles - start_cycles) / clock_rate
+        return max(due - time.perf_counter(), 0)
+
+    def run_paced(self, clock_rate=CLOCK_RATE, max_instructions=None, blocking_input=True,
+                  batch_size=DEFAULT_BATCH_SIZE):
+        """Run no faster than a real machine with the given clock rate.
+
+        Instructions are executed in batches of batch_size; after each batch
+        the thread sleeps until the wall clock catches up with the cycles
+        executed. Returns the number of instructions executed.
+        """
+        start_time, start_cycles = time.perf_counter(), self.cycles
+        executed = 0
+        while not self.is_finished():
+            limit = batch_size
+            if max_instructions is not None:
+                limit = min(limit, max_instructions - executed)
+                if limit <= 0:
+                    break
+            executed += self.run(limit, blocking_input)
+            if self.at_breakpoint or self.waiting_for_input:
+                break
+            time.sleep(self._pace_delay(start_time, start_cycles, clock_rate))
+        return executed
+
+    async def run_async(self, batch_size=DEFAULT_BATCH_SIZE, max_instructions=None,
+                        stop_on_input=False, clock_rate=None):
+        """Run the program cooperatively on the current event loop.
+
+        Instructions are executed in batches of batch_size, yielding to the
+        event loop between batches. INT 21h input never blocks: when the
+        input buffer is empty the coroutine suspends until add_input()
+        delivers more characters, or returns if stop_on_input is set.
+        With clock_rate set, each pause between batches lasts until real
+        time catches up with a machine of that clock rate.
+        Returns the number of instructions executed.
+        """
+        if self._input_event is None:
+            self._input_event = asyncio.Event()
+        start_time, start_cycles = time.perf_counter(), self.cycles
+        executed = 0
+        while not self.is_finished():
+            limit = batch_size
+            if max_instructions is not None:
+                limit = min(limit, max_instructions - executed)
+                if limit <= 0:
+                    break
+            executed += self.run(limit, blocking_input=False)
+            if self.at_breakpoint:
+                break
+            if self.waiting_for_input:
+                if stop_on_input:
+                    break
+                self._input_event.clear()
+                if not self.input_buffer:
+                    await self._input_event.wait()
+                    # Time spent waiting for input is not made up for
+                    start_time, start_cycles = time.perf_counter(), self.cycles
+            elif clock_rate:
+                await asyncio.sleep(self._pace_delay(start_time, start_cycles, clock_rate))
+            else:
+                await asyncio.sleep(0)
+        return executed
+
+    def load_program(self, code, cache=None):
+        """Parse a program, or install it from cache when it was parsed before.
+
+        Returns True when the program came from the cache.
+        """
+        image = cache.get(code) if cache is not None else None
+        if image is not None:
+            self.stats.program_cache_hits += 1
+            image.install(self)
+            return True
+        self.parse_program(code)
+        if cache is not None:
+            self.stats.program_cache_misses += 1
+            cache.put(code, ProgramImage(self))
+        return False
+
+    def save_state(self, path):
+        """Write a checkpoint of the complete run state to path"""
+        save_state(self, path)
+
+    def load_state(self, path, cache=None):
+        """Resume from a checkpoint written by save_state().
+
+        The program is parsed again from the saved source, or taken from
+        cache. Open files, port devices and services installed from Python
+        are not restored.
+        """
+        load_state(self, path, cache)
 
     def parse_program(self, code):
         """Parse the assembly program and set up segments"""
+        start_time = time.perf_counter()
         lines = [line.strip() for line in code.split('\n')]
         current_segment = None
+        self.source = code
         self.instructions = []
+        self.program = []
         self.labels = {}
+        self._address_cache = {}
+        self.data_segment = DataSegment()
+        self.current_instruction_index = 0
+        self.halted = False
         instruction_index = 0
         
-        for line in lines:
+        for line_number, line in enumerate(lines, 1):
             if not line or line.startswith(';'):
                 continue
 
             # Remove comments
-            line = line.split(';')[0].strip()
+            line = strip_comment(line).strip()
             
             # Check for labels
-            if ':' in line and 'db' not in line:
-                label = line.split(':')[0].strip()
+            match = LABEL_PATTERN.match(line)
+            if match and current_segment == 'code':
+                label = match.group(1).lower()
+                if label in self.labels:
+                    raise ValueError(f"Line {line_number}: Duplicate label: {label}")
                 self.labels[label] = instruction_index
-                line = line.split(':')[1].strip()
+                line = line[match.end():].strip()
                 if not line:  # If line only contains label
                     continue
             
@@ -196,29 +1278,46 @@ class Emulator:
                 current_segment = 'code'
             
             elif current_segment == 'data':
-                if len(tokens) >= 3 and tokens[1] == 'db':
-                    var_name = tokens[0]
-                    if var_name.endswith(','):
-                        var_name = var_name[:-1]
-                    
-                    if line.find("'") != -1:
-                        value = line[line.find("'"):line.rfind("'") + 1]
-                        value = value.strip("'")
-                    else:
-                        value = tokens[2]
-                        if value == '?':
-                            value = 0
-                        elif value.isdigit():
-                            value = int(value)
-                        else:
-                            value = 0
-                    
-                    self.data_segment.define_variable(var_name, value)
+                match = DATA_PATTERN.match(line)
+                if not match:
+                    raise ValueError(f"Line {line_number}: Invalid data definition: {line}")
+                var_name, directive, items = match.groups()
+                size = DATA_DIRECTIVES[directive.lower()]
+                try:
+                    data = self.data_segment.encode_data(items, size)
+                    self.data_segment.define_variable(var_name, data, size)
+                except ValueError as e:
+                    raise ValueError(f"Line {line_number}: {e}")
             
             elif current_segment == 'code' and line:
-                self.instructions.append(line)
+                # Procedure names are call targets
+                if len(tokens) > 1 and tokens[1] == 'proc':
+                    if tokens[0] in self.labels:
+                        raise ValueError(f"Line {line_number}: Duplicate label: {tokens[0]}")
+                    self.labels[tokens[0]] = instruction_index
+                self.instructions.append((line, line_number))
                 instruction_index += 1
 
+        # Decode once all labels and variables are known, so branch targets
+        # and address expressions are resolved before execution starts
+        for text, line_number in self.instructions:
+            try:
+                self.program.append(self.decode_instruction(text, line_number))
+            except ValueError as e:
+                raise ValueError(f"Line {line_number}: {e}")
+        self.instructions = [text for text, _ in self.instructions]
+        find_counted_loops(self.program)
+        self.fuse_program()
+        self._apply_memory_hooks()
+        if self.coverage is not None:
+            self.enable_coverage()
+        self.stats.programs_parsed += 1
+        self.stats.parse_seconds += time.perf_counter() - start_time
+
+    def analyze(self):
+        """Static control-flow checks of the loaded program (an AnalysisReport)"""
+        return analyze_program(self.program)
+
     def get_register_value(self, reg_name):
         """Get the value of a register"""
         reg_name = reg_name.lower().strip()
@@ -261,499 +1360,933 @@ class Emulator:
         else:
             raise ValueError(f"Invalid register name: {reg_name}")
 
-    def execute_instruction(self, instruction):
-        """Execute a single assembly instruction"""
-        tokens = instruction.lower().split()
+    def decode_instruction(self, text, line=None):
+        """Decode one line of code into an Instruction with compiled operands"""
+        instruction = Instruction(text, line)
+        if instruction.is_directive():
+            return instruction
+        if instruction.opcode not in self.handlers:
+            raise ValueError(f"Unsupported instruction: {instruction.opcode}")
+        instruction.resolve_target(self.labels)
+        if instruction.target is None:
+            args = [self.compile_operand(operand) for operand in instruction.operands]
+            if len(args) == 2 and instruction.opcode not in ('lea',) + SHIFT_OPCODES:
+                self._match_operand_sizes(instruction, *args)
+            instruction.args = args
+        instruction.cycles, instruction.taken_cycles = instruction_cycles(
+            instruction.opcode, instruction.args, CONDITIONAL_JUMPS)
+        return instruction
+
+    @staticmethod
+    def _match_operand_sizes(instruction, dest, source):
+        """Size a memory operand from the register it is paired with"""
+        for memory, other in ((dest, source), (source, dest)):
+            if memory.kind != 'mem' or other.kind != 'reg':
+                continue
+            if memory.explicit_size and memory.size != other.size:
+                raise ValueError(f"Operand size mismatch: {instruction.text}")
+            memory.size = other.size
+
+    def compile_operand(self, text):
+        """Compile operand text into a register, immediate or memory operand.
+
+        Symbols and constant terms are folded here, once, so executing the
+        instruction never parses strings.
+        """
+        text = text.strip()
+        if text in self.registers:
+            return RegisterOperand(text, self.registers[text].size)
+        if text == '@data':  # Simplified data segment handling
+            return ImmediateOperand(text, 0)
+        if text.startswith('offset '):
+            label = text[7:].strip()
+            if label in self.labels and label not in self.data_segment.variables:
+                operand = ImmediateOperand(text, self.labels[label])
+                operand.code_address = True
+                return operand
+            registers, displacement, _ = self.parse_address(text[7:])
+            if registers:
+                raise ValueError(f"OFFSET cannot use registers: {text}")
+            return ImmediateOperand(text, displacement)
+        value = parse_number(text)
+        if value is not None:
+            return ImmediateOperand(text, value)
+
+        size = None
+        match = PTR_PREFIX.match(text)
+        if match:
+            size = PTR_SIZES[match.group(1)]
+            text = match.group(2).strip()
+        segment = None
+        match = SEGMENT_PREFIX.match(text)
+        if match:
+            segment, text = match.group(1), match.group(2).strip()
+
+        registers, displacement, is_memory = self.parse_address(text)
+        if not is_memory:
+            if size is not None or segment is not None:
+                raise ValueError(f"Invalid memory operand: {text}")
+            return ImmediateOperand(text, displacement)
+        explicit = size is not None
+        if size is None:
+            size = self._variable_size(text)
+        return MemoryOperand(text, registers, displacement, size, explicit, segment)
+
+    def _variable_size(self, text):
+        """Operand size implied by the first variable named in an expression"""
+        for match in ADDRESS_TERM.finditer(text.replace('[', '+').replace(']', '+')):
+            variable = self.data_segment.variables.get(match.group(2).strip())
+            if variable is not None:
+                # A DD variable is used through its low word, as with WORD PTR
+                return 8 if variable['element_size'] == 1 else 16
+        return None
+
+    def parse_address(self, text):
+        """Split an address expression into registers and a folded displacement.
+
+        Accepts forms such as 'var', 'var+3', '[bx+si+4]', 'var[bx]' and
+        '[bx][di]'. Returns (registers, displacement, is_memory).
+        """
+        is_memory = '[' in text
+        expression = text.replace('[', '+').replace(']', '+')
+        registers = []
+        displacement = 0
+        for match in ADDRESS_TERM.finditer(expression):
+            sign, term = match.group(1), match.group(2).strip()
+            if not term:
+                continue
+            negative = sign == '-'
+            if term in BASE_REGISTERS or term in INDEX_REGISTERS:
+                if negative:
+                    raise ValueError(f"Registers cannot be subtracted: {text}")
+                registers.append(term)
+                is_memory = True
+                continue
+            value = parse_number(term)
+            if value is None:
+                if term not in self.data_segment.variables:
+                    raise ValueError(f"Undefined variable: {term}")
+                value = self.data_segment.variables[term]['offset']
+                is_memory = True
+            displacement += -value if negative else value
+
+        bases = [r for r in registers if r in BASE_REGISTERS]
+        indexes = [r for r in registers if r in INDEX_REGISTERS]
+        if len(bases) > 1 or len(indexes) > 1:
+            raise ValueError(f"Invalid base/index combination: {text}")
+        return bases + indexes, displacement, is_memory
+
+    def execute_instruction(self, instruction, blocking_input=True):
+        """Execute a single assembly instruction (source text or Instruction)"""
+        if isinstance(instruction, str):
+            instruction = self.decode_instruction(instruction)
+        tokens = instruction.tokens
         if not tokens:
             return
 
         # Handle procedure declarations
-        if len(tokens) > 1 and tokens[1] == 'proc':
-            self.current_proc = tokens[0]
-            return
-        elif tokens[0] == 'endp':
-            self.current_proc = None
-            return
-        elif tokens[0] == 'end':
+        if instruction.is_directive():
+            if len(tokens) > 1 and tokens[1] == 'proc':
+                self.current_proc = tokens[0]
+            elif 'endp' in tokens[:2]:
+                self.current_proc = None
             return
 
-        opcode = tokens[0].strip()
-        if len(tokens) > 1:
-            operands = [op.strip() for op in ' '.join(tokens[1:]).split(',')]
-        else:
-            operands = []
+        self._blocking_input = blocking_input
+        return self.handlers[instruction.opcode](instruction)
 
-        if opcode == 'mov':
-            if len(operands) != 2:
-                raise ValueError("MOV instruction requires two operands")
-            dest, source = operands
-            
-            # Handle destination
-            if dest in self.registers:
-                # Moving to register
-                source = source.strip()
-                if source == '@data':  # Special case for data segment
-                    value = 0  # Simplified data segment handling
-                elif source.endswith('b'):  # Binary number
-                    try:
-                        value = int(source[:-1], 2)
-                    except ValueError:
-                        raise ValueError(f"Invalid binary number: {source}")
-                elif source.startswith('0x'):
-                    value = int(source[2:], 16)
-                elif source.endswith('h'):  # Handle hexadecimal values
-                    value = int(source[:-1], 16)
-                elif source.isdigit():
-                    value = int(source)
-                elif source in self.registers:
-                    value = self.get_register_value(source)
-                else:
-                    # Try to get value from memory variable
-                    try:
-                        value = self.data_segment.get_memory_byte(source)
-                    except ValueError:
-                        raise ValueError(f"Invalid source operand: {source}")
-                self.set_register_value(dest, value)
-            else:
-                # Moving to memory
-                try:
-                    if source in self.registers:
-                        value = self.get_register_value(source)
-                    elif source.endswith('b'):  # Binary number
-                        try:
-                            value = int(source[:-1], 2)
-                        except ValueError:
-                            raise ValueError(f"Invalid binary number: {source}")
-                    elif source.startswith('0x'):
-                        value = int(source[2:], 16)
-                    elif source.endswith('h'):
-                        value = int(source[:-1], 16)
-                    elif source.isdigit():
-                        value = int(source)
-                    else:
-                        value = self.data_segment.get_memory_byte(source)
-                    self.data_segment.set_memory_byte(dest, value)
-                except ValueError as e:
-                    raise ValueError(f"Invalid operand: {str(e)}")
+    # Operand access
 
-        elif opcode == 'add':
-            if len(operands) != 2:
-                raise ValueError("ADD instruction requires two operands")
-            dest, source = operands
-            
-            # Get destination value
-            if dest in self.registers:
-                dest_val = self.get_register_value(dest)
-            else:
-                try:
-                    dest_offset = self.data_segment.get_variable_offset(dest)
-                    dest_val = self.data_segment.get_memory_byte(dest_offset)
-                except ValueError:
-                    raise ValueError(f"Invalid destination operand: {dest}")
-            
-            # Get source value
-            source = source.strip()
-            if source.startswith('0x'):
-                source_val = int(source[2:], 16)
-            elif source.endswith('h'):  # Handle hexadecimal values
-                source_val = int(source[:-1], 16)
-            elif source.isdigit():
-                source_val = int(source)
-            elif source == "'0'":  # Handle ASCII '0'
-                source_val = ord('0')
-            elif source in self.registers:
-                source_val = self.get_register_value(source)
-            else:
-                try:
-                    source_offset = self.data_segment.get_variable_offset(source)
-                    source_val = self.data_segment.get_memory_byte(source_offset)
-                except ValueError:
-                    raise ValueError(f"Invalid source operand: {source}")
-            
-            result = dest_val + source_val
-            
-            # Store result
-            if dest in self.registers:
-                self.set_register_value(dest, result)
-            else:
-                self.data_segment.set_memory_byte(dest_offset, result)
-            
-            self.flags.update_flags(result)
+    def read_operand(self, operand):
+        """Get the value of an operand (compiled or source text)"""
+        if isinstance(operand, str):
+            operand = self.compile_operand(operand)
+        return operand.read(self)
 
-        elif opcode == 'sub':
-            if len(operands) != 2:
-                raise ValueError("SUB instruction requires two operands")
-            dest, source = operands
-            
-            # Get destination value
-            if dest in self.registers:
-                dest_val = self.get_register_value(dest)
-            else:
-                try:
-                    dest_offset = self.data_segment.get_variable_offset(dest)
-                    dest_val = self.data_segment.get_memory_byte(dest_offset)
-                except ValueError:
-                    raise ValueError(f"Invalid destination operand: {dest}")
-            
-            # Get source value
-            source = source.strip()
-            if source.startswith('0x'):
-                source_val = int(source[2:], 16)
-            elif source.endswith('h'):  # Handle hexadecimal values
-                source_val = int(source[:-1], 16)
-            elif source.isdigit():
-                source_val = int(source)
-            elif source == "'0'":  # Handle ASCII '0'
-                source_val = ord('0')
-            elif source in self.registers:
-                source_val = self.get_register_value(source)
-            else:
-                try:
-                    source_offset = self.data_segment.get_variable_offset(source)
-                    source_val = self.data_segment.get_memory_byte(source_offset)
-                except ValueError:
-                    raise ValueError(f"Invalid source operand: {source}")
-            
-            result = dest_val - source_val
-            
-            # Store result
-            if dest in self.registers:
-                self.set_register_value(dest, result)
-            else:
-                self.data_segment.set_memory_byte(dest_offset, result)
-            
-            self.flags.update_flags(result)
-
-        elif opcode == 'lea':
-            if len(operands) != 2:
-                raise ValueError("LEA instruction requires two operands")
-            dest, source = operands
-            # Get the offset of the variable and store it in the destination register
-            offset = self.data_segment.get_variable_offset(source)
-            self.set_register_value(dest, offset)
-
-        elif opcode == 'int':
-            if len(operands) != 1:
-                raise ValueError("INT instruction requires one operand")
-            interrupt = operands[0].strip()
-            if interrupt == '21h' or interrupt == '21':
-                self.handle_int_21h()
-            else:
-                raise ValueError(f"Unsupported interrupt: {interrupt}")
+    def write_operand(self, operand, value):
+        """Store a value into a register or memory operand (compiled or source text)"""
+        if isinstance(operand, str):
+            operand = self.compile_operand(operand)
+        operand.write(self, value)
 
-        elif opcode == 'cmp':
-            if len(operands) != 2:
-                raise ValueError("CMP instruction requires two operands")
-            dest, source = operands
-            
-            # Get destination value
-            if dest in self.registers:
-                dest_val = self.get_register_value(dest)
-            else:
-                try:
-                    dest_offset = self.data_segment.get_variable_offset(dest)
-                    dest_val = self.data_segment.get_memory_byte(dest_offset)
-                except ValueError:
-                    raise ValueError(f"Invalid destination operand: {dest}")
-            
-            # Get source value
-            source = source.strip()
-            if source.startswith("'") and source.endswith("'"):
-                source_val = ord(source[1])
-            elif source.startswith('0x'):
-                source_val = int(source[2:], 16)
-            elif source.endswith('h'):
-                source_val = int(source[:-1], 16)
-            elif source.isdigit():
-                source_val = int(source)
-            elif source in self.registers:
-                source_val = self.get_register_value(source)
-            else:
-                try:
-                    source_offset = self.data_segment.get_variable_offset(source)
-                    source_val = self.data_segment.get_memory_byte(source_offset)
-                except ValueError:
-                    raise ValueError(f"Invalid source operand: {source}")
-            
-            # Update flags based on comparison
-            result = dest_val - source_val
-            self.flags.zero = (result == 0)
-            self.flags.sign = bool(result & 0x80)
-            self.flags.carry = (dest_val < source_val)
-
-        elif opcode == 'je':
-            if not self.flags.zero:
-                return
-            if len(operands) != 1:
-                raise ValueError("JE instruction requires one operand")
-            label = operands[0]
-            if label in self.labels:
-                self.current_instruction_index = self.labels[label]
-                return "jump"
-
-        elif opcode == 'jmp':
-            if len(operands) != 1:
-                raise ValueError("JMP instruction requires one operand")
-            label = operands[0]
-            if label in self.labels:
-                self.current_instruction_index = self.labels[label]
-                return "jump"
-
-        elif opcode == 'mul':
-            if len(operands) != 1:
-                raise ValueError("MUL instruction requires one operand")
-            source = operands[0]
-            
-            # Get source value
-            if source in self.registers:
-                source_val = self.get_register_value(source)
-            else:
-                try:
-                    source_offset = self.data_segment.get_variable_offset(source)
-                    source_val = self.data_segment.get_memory_byte(source_offset)
-                except ValueError:
-                    raise ValueError(f"Invalid source operand: {source}")
-            
-            # Multiply AL by source
-            al_val = self.get_register_value('al')
-            result = al_val * source_val
-            
-            # Store result in AX
-            self.set_register_value('ax', result)
-            
-            # Update flags
-            self.flags.update_flags(result, 16)
+    def _require_operands(self, instruction, count):
+        if len(instruction.args) != count:
+            expected = "one operand" if count == 1 else "two operands"
+            raise ValueError(f"{instruction.opcode.upper()} instruction requires {expected}")
+        return instruction.args
 
-        elif opcode == 'div':
-            if len(operands) != 1:
-                raise ValueError("DIV instruction requires one operand")
-            source = operands[0]
-            
-            # Get source value
-            if source in self.registers:
-                source_val = self.get_register_value(source)
-            else:
-                try:
-                    source_offset = self.data_segment.get_variable_offset(source)
-                    source_val = self.data_segment.get_memory_byte(source_offset)
-                except ValueError:
-                    raise ValueError(f"Invalid source operand: {source}")
-            
-            # Check for division by zero
-            if source_val == 0:
-                raise ValueError("Division by zero")
-            
-            # Get AX value
-            ax_val = self.get_register_value('ax')
-            
-            # Perform division
-            quotient = ax_val // source_val
-            remainder = ax_val % source_val
-            
-            # Store results
+    # Superinstructions. A fused handler takes the two instructions of a pair,
+    # does their combined work and, like a normal handler, returns "jump" when
+    # it has set current_instruction_index itself.
+
+    def fuse_program(self):
+        """Attach fused handlers to common instruction pairs"""
+        for first, second in zip(self.program, self.program[1:]):
+            first.fused = self._match_fusion(first, second)
+        if self.program:
+            self.program[-1].fused = None
+
+    @staticmethod
+    def _match_fusion(first, second):
+        if first.is_directive() or second.is_directive():
+            return None
+        if first.opcode == 'cmp' and len(first.args) == 2 and second.opcode in CONDITIONAL_JUMPS:
+            return Emulator._fused_cmp_jcc
+        if (first.opcode == 'dec' and len(first.args) == 1 and first.args[0].kind == 'reg'
+                and second.opcode in ('jnz', 'jne') and second.loop_plan is None):
+            return Emulator._fused_dec_jnz
+        if first.opcode != 'mov' or len(first.args) != 2:
+            return None
+        dest, source = first.args
+        if (dest.kind == 'reg' and dest.name == 'ah' and source.kind == 'imm'
+                and second.opcode == 'int' and len(second.args) == 1
+                and second.args[0].kind == 'imm' and second.args[0].value == 0x21):
+            return Emulator._fused_dos_call
+        if (dest.kind == 'reg' and dest.size == 16 and source.kind == 'imm'
+                and second.opcode == 'mov' and len(second.args) == 2
+                and second.args[0].kind == 'reg' and second.args[0].name in SEGMENT_REGISTERS
+                and second.args[1].kind == 'reg' and second.args[1].name == dest.name):
+            return Emulator._fused_load_segment
+        return None
+
+    def _fused_cmp_jcc(self, compare, jump):
+        dest, source = compare.args
+        alu.sub(self.flags, dest.read(self), source.read(self), dest.size or source.size or 8)
+        if CONDITIONAL_JUMPS[jump.opcode](self.flags):
+            self.current_instruction_index = jump.target
+            return "jump"
+
+    def _fused_dec_jnz(self, decrement, jump):
+        register = decrement.args[0]
+        value = alu.dec(self.flags, register.read(self), register.size)
+        self.set_register_value(register.name, value)
+        if value:
+            self.current_instruction_index = jump.target
+            return "jump"
+
+    def _fused_dos_call(self, move, interrupt):
+        self.set_register_value('ah', move.args[1].value)
+        index = self.current_instruction_index
+        try:
+            self.call_vector(0x21, index + 2, self._blocking_input)
+        except InputPending:
+            # The MOV has completed; resume at the INT once input arrives
+            self.current_instruction_index += 1
+            self.instruction_count += 1
+            self.cycles += move.cycles
+            raise
+        if self.current_instruction_index != index:
+            return "jump"
+
+    def _fused_load_segment(self, move, load):
+        value = move.args[1].value
+        self.set_register_value(move.args[0].name, value)
+        self.set_register_value(load.args[0].name, value)
+
+    # Instruction handlers. Each takes a decoded Instruction and returns
+    # "jump" when it has set current_instruction_index itself.
+
+    def _build_handlers(self):
+        handlers = {
+            'mov': self._op_mov,
+            'lea': self._op_lea,
+            'xchg': self._op_xchg,
+            'int': self._op_int,
+            'nop': self._op_nop,
+            'hlt': self._op_hlt,
+            'mul': self._op_mul,
+            'imul': self._op_mul,
+            'div': self._op_div,
+            'idiv': self._op_div,
+            'cbw': self._op_cbw,
+            'cwd': self._op_cwd,
+            'daa': self._op_daa,
+            'das': self._op_daa,
+            'aaa': self._op_aaa,
+            'aas': self._op_aaa,
+            'aam': self._op_aam,
+            'aad': self._op_aad,
+            'clc': self._op_flag,
+            'stc': self._op_flag,
+            'cmc': self._op_flag,
+            'cli': self._op_flag,
+            'sti': self._op_flag,
+            'jmp': self._op_jmp,
+            'jcxz': self._op_jcxz,
+            'push': self._op_push,
+            'pop': self._op_pop,
+            'pushf': self._op_pushf,
+            'popf': self._op_popf,
+            'call': self._op_call,
+            'ret': self._op_ret,
+            'iret': self._op_iret,
+            'in': self._op_in,
+            'out': self._op_out,
+        }
+        for opcode in alu.BINARY_OPS:
+            handlers[opcode] = self._op_binary
+        for opcode in alu.UNARY_OPS:
+            handlers[opcode] = self._op_unary
+        for opcode in alu.SHIFT_OPS:
+            handlers[opcode] = self._op_shift
+        for opcode in CONDITIONAL_JUMPS:
+            handlers[opcode] = self._op_jcc
+        for opcode in LOOP_CONDITIONS:
+            handlers[opcode] = self._op_loop
+        return handlers
+
+    def _op_nop(self, instruction):
+        pass
+
+    def _op_hlt(self, instruction):
+        self.halted = True
+
+    def _op_mov(self, instruction):
+        dest, source = self._require_operands(instruction, 2)
+        dest.write(self, source.read(self))
+
+    def _op_lea(self, instruction):
+        dest, source = self._require_operands(instruction, 2)
+        if source.kind != 'mem':
+            raise ValueError(f"LEA requires a memory operand: {source.text}")
+        # Store the effective address of the operand in the destination register
+        dest.write(self, source.address(self.registers))
+
+    def _op_xchg(self, instruction):
+        dest, source = self._require_operands(instruction, 2)
+        dest_val = dest.read(self)
+        dest.write(self, source.read(self))
+        source.write(self, dest_val)
+
+    def _op_binary(self, instruction):
+        dest, source = self._require_operands(instruction, 2)
+        operation, store = alu.BINARY_OPS[instruction.opcode]
+        size = dest.size or source.size or 8
+        result = operation(self.flags, dest.read(self), source.read(self), size)
+        if store:
+            dest.write(self, result)
+
+    def _op_unary(self, instruction):
+        dest, = self._require_operands(instruction, 1)
+        result = alu.UNARY_OPS[instruction.opcode](self.flags, dest.read(self), dest.size or 8)
+        dest.write(self, result)
+
+    def _op_shift(self, instruction):
+        args = instruction.args
+        if len(args) not in (1, 2):
+            raise ValueError(f"{instruction.opcode.upper()} instruction requires "
+                             "one or two operands")
+        dest = args[0]
+        count = args[1].read(self) & 0xFF if len(args) == 2 else 1
+        if len(args) == 2 and args[1].kind == 'reg':
+            self.cycles += 4 * count
+        result = alu.SHIFT_OPS[instruction.opcode](self.flags, dest.read(self), count,
+                                                   dest.size or 8)
+        dest.write(self, result)
+
+    def _op_mul(self, instruction):
+        source, = self._require_operands(instruction, 1)
+        operation = alu.imul if instruction.opcode == 'imul' else alu.mul
+        if (source.size or 8) == 8:
+            low, high = operation(self.flags, self.get_register_value('al'),
+                                  source.read(self), 8)
+            self.set_register_value('ax', (high << 8) | low)
+        else:
+            low, high = operation(self.flags, self.get_register_value('ax'),
+                                  source.read(self), 16)
+            self.set_register_value('ax', low)
+            self.set_register_value('dx', high)
+
+    def _op_div(self, instruction):
+        source, = self._require_operands(instruction, 1)
+        operation = alu.idiv if instruction.opcode == 'idiv' else alu.div
+        if (source.size or 8) == 8:
+            quotient, remainder = operation(self.get_register_value('ax'),
+                                            source.read(self), 8)
             self.set_register_value('al', quotient)
             self.set_register_value('ah', remainder)
+        else:
+            dividend = (self.get_register_value('dx') << 16) | self.get_register_value('ax')
+            quotient, remainder = operation(dividend, source.read(self), 16)
+            self.set_register_value('ax', quotient)
+            self.set_register_value('dx', remainder)
 
-        elif opcode == 'aam':
-            # ASCII adjust after multiplication
-            al_val = self.get_register_value('al')
-            ah_val = al_val // 10
-            al_val = al_val % 10
-            self.set_register_value('ah', ah_val)
-            self.set_register_value('al', al_val)
-            
-            # Update flags
-            self.flags.update_flags((ah_val << 8) | al_val, 16)
+    def _op_cbw(self, instruction):
+        self.set_register_value('ah', 0xFF if self.get_register_value('al') & 0x80 else 0)
 
-        elif opcode == 'and':
-            if len(operands) != 2:
-                raise ValueError("AND instruction requires two operands")
-            dest, source = operands
-            
-            # Get destination value
-            if dest in self.registers:
-                dest_val = self.get_register_value(dest)
-            else:
-                try:
-                    dest_offset = self.data_segment.get_variable_offset(dest)
-                    dest_val = self.data_segment.get_memory_byte(dest_offset)
-                except ValueError:
-                    raise ValueError(f"Invalid destination operand: {dest}")
-            
-            # Get source value
-            source = source.strip()
-            if source.endswith('b'):  # Binary number
-                source_val = int(source[:-1], 2)
-            elif source.startswith('0x'):
-                source_val = int(source[2:], 16)
-            elif source.endswith('h'):
-                source_val = int(source[:-1], 16)
-            elif source.isdigit():
-                source_val = int(source)
-            elif source in self.registers:
-                source_val = self.get_register_value(source)
-            else:
-                try:
-                    source_offset = self.data_segment.get_variable_offset(source)
-                    source_val = self.data_segment.get_memory_byte(source_offset)
-                except ValueError:
-                    raise ValueError(f"Invalid source operand: {source}")
-            
-            # Perform AND operation
-            result = dest_val & source_val
-            
-            # Store result
-            if dest in self.registers:
-                self.set_register_value(dest, result)
-            else:
-                self.data_segment.set_memory_byte(dest_offset, result)
-            
-            # Update flags
-            self.flags.update_flags(result)
+    def _op_cwd(self, instruction):
+        self.set_register_value('dx', 0xFFFF if self.get_register_value('ax') & 0x8000 else 0)
 
-        elif opcode == 'or':
-            if len(operands) != 2:
-                raise ValueError("OR instruction requires two operands")
-            dest, source = operands
-            
-            # Get destination value
-            if dest in self.registers:
-                dest_val = self.get_register_value(dest)
-            else:
-                try:
-                    dest_offset = self.data_segment.get_variable_offset(dest)
-                    dest_val = self.data_segment.get_memory_byte(dest_offset)
-                except ValueError:
-                    raise ValueError(f"Invalid destination operand: {dest}")
-            
-            # Get source value
-            source = source.strip()
-            if source.endswith('b'):  # Binary number
-                source_val = int(source[:-1], 2)
-            elif source.startswith('0x'):
-                source_val = int(source[2:], 16)
-            elif source.endswith('h'):
-                source_val = int(source[:-1], 16)
-            elif source.isdigit():
-                source_val = int(source)
-            elif source in self.registers:
-                source_val = self.get_register_value(source)
-            else:
-                try:
-                    source_offset = self.data_segment.get_variable_offset(source)
-                    source_val = self.data_segment.get_memory_byte(source_offset)
-                except ValueError:
-                    raise ValueError(f"Invalid source operand: {source}")
-            
-            # Perform OR operation
-            result = dest_val | source_val
-            
-            # Store result
-            if dest in self.registers:
-                self.set_register_value(dest, result)
-            else:
-                self.data_segment.set_memory_byte(dest_offset, result)
-            
-            # Update flags
-            self.flags.update_flags(result)
+    def _op_daa(self, instruction):
+        operation = alu.das if instruction.opcode == 'das' else alu.daa
+        self.set_register_value('al', operation(self.flags, self.get_register_value('al')))
 
-        elif opcode == 'xor':
-            if len(operands) != 2:
-                raise ValueError("XOR instruction requires two operands")
-            dest, source = operands
-            
-            # Get destination value
-            if dest in self.registers:
-                dest_val = self.get_register_value(dest)
-            else:
-                try:
-                    dest_offset = self.data_segment.get_variable_offset(dest)
-                    dest_val = self.data_segment.get_memory_byte(dest_offset)
-                except ValueError:
-                    raise ValueError(f"Invalid destination operand: {dest}")
-            
-            # Get source value
-            source = source.strip()
-            if source.endswith('b'):  # Binary number
-                source_val = int(source[:-1], 2)
-            elif source.startswith('0x'):
-                source_val = int(source[2:], 16)
-            elif source.endswith('h'):
-                source_val = int(source[:-1], 16)
-            elif source.isdigit():
-                source_val = int(source)
-            elif source in self.registers:
-                source_val = self.get_register_value(source)
-            else:
-                try:
-                    source_offset = self.data_segment.get_variable_offset(source)
-                    source_val = self.data_segment.get_memory_byte(source_offset)
-                except ValueError:
-                    raise ValueError(f"Invalid source operand: {source}")
-            
-            # Perform XOR operation
-            result = dest_val ^ source_val
-            
-            # Store result
-            if dest in self.registers:
-                self.set_register_value(dest, result)
+    def _op_aaa(self, instruction):
+        operation = alu.aas if instruction.opcode == 'aas' else alu.aaa
+        al, ah = operation(self.flags, self.get_register_value('al'),
+                           self.get_register_value('ah'))
+        self.set_register_value('ax', (ah << 8) | al)
+
+    def _op_aam(self, instruction):
+        # ASCII adjust after multiplication
+        base = instruction.args[0].read(self) if instruction.args else 10
+        al, ah = alu.aam(self.flags, self.get_register_value('al'), base & 0xFF)
+        self.set_register_value('ax', (ah << 8) | al)
+
+    def _op_aad(self, instruction):
+        # ASCII adjust before division
+        base = instruction.args[0].read(self) if instruction.args else 10
+        al, ah = alu.aad(self.flags, self.get_register_value('al'),
+                         self.get_register_value('ah'), base & 0xFF)
+        self.set_register_value('ax', (ah << 8) | al)
+
+    def _op_flag(self, instruction):
+        opcode = instruction.opcode
+        if opcode == 'clc':
+            self.flags.carry = False
+        elif opcode == 'stc':
+            self.flags.carry = True
+        elif opcode == 'cmc':
+            self.flags.carry = not self.flags.carry
+        elif opcode == 'cli':
+            self.flags.interrupt = False
+        else:
+            self.flags.interrupt = True
+            self.service_irqs()
+
+    def _op_int(self, instruction):
+        interrupt, = self._require_operands(instruction, 1)
+        if interrupt.kind != 'imm':
+            raise ValueError(f"INT requires an immediate operand: {interrupt.text}")
+        index = self.current_instruction_index
+        self.call_vector(interrupt.value & 0xFF, index + 1, self._blocking_input)
+        if self.current_instruction_index != index:
+            return "jump"
+
+    def _op_iret(self, instruction):
+        self.current_instruction_index = self.pop_word()
+        self.registers['cs'].set(self.pop_word())
+        self.flags.from_word(self.pop_word())
+        return "jump"
+
+    def _op_jmp(self, instruction):
+        self.current_instruction_index = instruction.target
+        return "jump"
+
+    def _op_jcc(self, instruction):
+        if CONDITIONAL_JUMPS[instruction.opcode](self.flags):
+            self.current_instruction_index = instruction.target
+            return "jump"
+
+    def _op_jcxz(self, instruction):
+        if self.get_register_value('cx') == 0:
+            self.current_instruction_index = instruction.target
+            return "jump"
+
+    def segment_memory(self, segment):
+        """Memory addressed through a segment register: video memory when
+        it holds B800h, otherwise the shared data space"""
+        if self.registers[segment].value == VIDEO_SEGMENT:
+            return self.screen.memory
+        return self.data_segment.memory
+
+    def operand_memory(self, operand):
+        """Memory a memory operand addresses, following its segment override"""
+        if operand.segment is not None:
+            return self.segment_memory(operand.segment)
+        return self.data_segment.memory
+
+    # Port I/O
+
+    def _port_number(self, instruction, operand):
+        if operand.kind == 'imm' and 0 <= operand.value <= 0xFF:
+            return operand.value
+        if operand.kind == 'reg' and operand.name == 'dx':
+            return self.registers['dx'].value
+        raise ValueError(f"Port must be an 8-bit constant or DX: {instruction.text}")
+
+    def _port_data(self, instruction, operand):
+        if operand.kind != 'reg' or operand.name not in ('al', 'ax'):
+            raise ValueError(f"Port data must be in AL or AX: {instruction.text}")
+        return operand
+
+    def _op_in(self, instruction):
+        dest, port = self._require_operands(instruction, 2)
+        dest = self._port_data(instruction, dest)
+        dest.write(self, self.ports.read(self._port_number(instruction, port), dest.size))
+        self.stats.port_read_bytes += dest.size
+
+    def _op_out(self, instruction):
+        port, source = self._require_operands(instruction, 2)
+        source = self._port_data(instruction, source)
+        self.ports.write(self._port_number(instruction, port), source.read(self), source.size)
+        self.stats.port_write_bytes += source.size
+
+    # Stack
+
+    def push_word(self, value):
+        """Push a word onto the stack"""
+        sp = (self.registers['sp'].get() - 2) & 0xFFFF
+        self.registers['sp'].set(sp)
+        self.data_segment.set_memory_word(sp, value)
+
+    def pop_word(self):
+        """Pop a word from the stack"""
+        sp = self.registers['sp'].get()
+        value = self.data_segment.get_memory_word(sp)
+        self.registers['sp'].set(sp + 2)
+        return value
+
+    def _op_push(self, instruction):
+        source, = self._require_operands(instruction, 1)
+        if source.kind == 'mem':
+            value = self.operand_memory(source).get_word(source.address(self.registers))
+        elif source.size == 8:
+            raise ValueError(f"PUSH requires a 16-bit operand: {source.text}")
+        else:
+            value = source.read(self)
+        self.push_word(value)
+
+    def _op_pop(self, instruction):
+        dest, = self._require_operands(instruction, 1)
+        if dest.kind == 'mem':
+            self.operand_memory(dest).set_word(dest.address(self.registers), self.pop_word())
+        elif dest.size == 8:
+            raise ValueError(f"POP requires a 16-bit operand: {dest.text}")
+        else:
+            dest.write(self, self.pop_word())
+
+    def _op_pushf(self, instruction):
+        self.push_word(self.flags.to_word())
+
+    def _op_popf(self, instruction):
+        self.flags.from_word(self.pop_word())
+        if self.flags.interrupt:
+            self.service_irqs()
+
+    def _op_call(self, instruction):
+        # The return address is the index of the next instruction
+        self.push_word(self.current_instruction_index + 1)
+        if self.profiler is not None:
+            self.profiler.enter(instruction.operands[0], self.instruction_count + 1)
+        self.current_instruction_index = instruction.target
+        return "jump"
+
+    def _op_ret(self, instruction):
+        if len(instruction.args) > 1:
+            raise ValueError("RET instruction takes at most one operand")
+        self.current_instruction_index = self.pop_word()
+        if instruction.args:
+            sp = self.registers['sp'].get() + instruction.args[0].read(self)
+            self.registers['sp'].set(sp)
+        if self.profiler is not None:
+            self.profiler.exit(self.instruction_count + 1)
+        return "jump"
+
+    def _op_loop(self, instruction):
+        # LOOP decrements CX without affecting flags
+        cx = (self.get_register_value('cx') - 1) & 0xFFFF
+        self.set_register_value('cx', cx)
+        if cx != 0 and LOOP_CONDITIONS[instruction.opcode](self.flags):
+            self.current_instruction_index = instruction.target
+            return "jump"
+
+    # Interrupt vectors
+
+    def _reset_vectors(self):
+        self.vector_table.write(0, BIOS_VECTORS)
+
+    def get_vector(self, vector):
+        """(segment, offset) stored for an interrupt vector"""
+        address = vector * 4
+        return self.vector_table.get_word(address + 2), self.vector_table.get_word(address)
+
+    def set_vector(self, vector, segment, offset):
+        """Point an interrupt vector at program code (offset is an
+        instruction index) or, with BIOS_SEGMENT, at a Python service"""
+        address = vector * 4
+        self.vector_table.set_word(address, offset)
+        self.vector_table.set_word(address + 2, segment)
+
+    def is_hooked(self, vector):
+        """Check whether a vector points at program code"""
+        return self.vector_table.get_word(vector * 4 + 2) != BIOS_SEGMENT
+
+    def register_service(self, vector, handler, function=None):
+        """Serve INT vector from Python with handler(blocking_input).
+
+        With function given, handler serves only calls with that value in
+        AH and other functions fall through to the handler of the vector.
+        """
+        if function is None:
+            self.interrupt_services[vector] = handler
+        else:
+            self.function_services.setdefault(vector, {})[function] = handler
+
+    def unregister_service(self, vector, function=None):
+        if function is None:
+            self.interrupt_services.pop(vector, None)
+        else:
+            self.function_services.get(vector, {}).pop(function, None)
+
+    def call_vector(self, vector, return_index, blocking_input=True):
+        """Run INT vector the way the CPU does.
+
+        A vector hooked by the program pushes FLAGS, CS and return_index,
+        clears IF and continues at the handler, which returns with IRET.
+        A BIOS vector runs the Python service named by its offset: the
+        handler registered for the function in AH if there is one, else
+        the handler of the whole vector. The call is counted, and the
+        interrupt hooks run, once it has entered the handler or the service
+        has returned, so a service retried after InputPending counts once.
+        """
+        ah = self.get_register_value('ah')
+        table = self.vector_table
+        address = vector * 4
+        offset = table.get_word(address)
+        if table.get_word(address + 2) != BIOS_SEGMENT:
+            self.push_word(self.flags.to_word())
+            self.push_word(self.registers['cs'].get())
+            self.push_word(return_index)
+            self.flags.interrupt = False
+            self.current_instruction_index = offset
+            self._count_interrupt(vector, ah)
+            return
+        service = None
+        functions = self.function_services.get(offset)
+        if functions:
+            service = functions.get(ah)
+        if service is None:
+            service = self.interrupt_services.get(offset)
+            if service is None:
+                raise ValueError(f"Unsupported interrupt: {vector:02X}h")
+        self._interrupt_return = return_index
+        service(blocking_input)
+        self._count_interrupt(vector, ah)
+
+    def _count_interrupt(self, vector, ah):
+        interrupts = self.stats.interrupts
+        interrupts[vector, ah] = interrupts.get((vector, ah), 0) + 1
+        for hook in self.hooks['interrupt']:
+            hook(self, vector, ah)
+
+    # Hardware interrupts
+
+    def raise_irq(self, line):
+        """Request a hardware interrupt on an IRQ line"""
+        if line not in self.pending_irqs:
+            self.pending_irqs.append(line)
+        if self.flags.interrupt:
+            self.service_irqs()
+
+    def service_irqs(self, at_boundary=False):
+        """Service pending interrupt requests, lowest line first.
+
+        Requests that would enter program code wait for the next
+        instruction boundary, where step() services them.
+        """
+        while self.pending_irqs and self.flags.interrupt:
+            line = min(self.pending_irqs)
+            vector = IRQ_BASE_VECTOR + line
+            if not at_boundary and (self.is_hooked(vector)
+                                    or (vector == 0x08 and self.is_hooked(0x1C))):
+                return
+            self.pending_irqs.remove(line)
+            self.call_vector(vector, self.current_instruction_index, False)
+
+    def handle_int_08h(self, blocking_input=True):
+        """Timer tick: count it and call the user timer hook (INT 1Ch)"""
+        self.bios_ticks += 1
+        if self.bios_ticks >= TICKS_PER_DAY:
+            self.bios_ticks = 0
+        self.call_vector(0x1C, self._interrupt_return, blocking_input)
+
+    def handle_int_1ch(self, blocking_input=True):
+        """User timer hook; does nothing unless replaced"""
+
+    def handle_int_09h(self, blocking_input=True):
+        """Keyboard: move the latched keystroke into the type-ahead buffer"""
+        char = self.keyboard.read_latched()
+        if char is not None:
+            self.input_buffer.append(char)
+
+    def read_key(self, blocking_input=True, remove=True):
+        """Take (or with remove False, peek at) the next key, or return None.
+
+        When a read finds the type-ahead buffer empty but keystrokes are
+        scheduled, the clock runs forward to them as the BIOS wait loop would. Otherwise a
+        blocking read asks the I/O handler and a non-blocking one raises
+        InputPending; a peek returns None.
+        """
+        while (remove and not self.input_buffer and self.keyboard.scheduled
+               and self.flags.interrupt):
+            self.cycles = max(self.cycles, self.scheduler.next_deadline)
+            self.scheduler.run_due(self.cycles)
+        if self.input_buffer:
+            return self.input_buffer.popleft() if remove else self.input_buffer[0]
+        if not remove:
+            return None
+        if self.io_handler and blocking_input:
+            return self._handler_input()
+        raise InputPending()
+
+    def _line_ready(self):
+        return '\r' in self.input_buffer or '\n' in self.input_buffer
+
+    def read_line(self, limit, blocking_input=True):
+        """Take one line of input, at most limit characters, without its ending.
+
+        Nothing is consumed until the whole line has been typed, so a
+        non-blocking read that raises InputPending can simply be retried.
+        Characters past limit are dropped, as DOS ignores them. A blocking
+        read asks the I/O handler for more input; a reply of several
+        characters counts as a complete line.
+        """
+        buffer = self.input_buffer
+        while not self._line_ready() and self.keyboard.scheduled and self.flags.interrupt:
+            self.cycles = max(self.cycles, self.scheduler.next_deadline)
+            self.scheduler.run_due(self.cycles)
+        while not self._line_ready():
+            if not (self.io_handler and blocking_input):
+                raise InputPending()
+            text = self._handler_input()
+            if not text:
+                break  # End of input ends the line
+            buffer.extend(text)
+            if len(text) > 1 and not self._line_ready():
+                buffer.append('\r')
+        chars = []
+        while buffer:
+            char = buffer.popleft()
+            if char in '\r\n':
+                if char == '\r' and buffer and buffer[0] == '\n':
+                    buffer.popleft()
+                break
+            if len(chars) < limit:
+                chars.append(char)
+        return ''.join(chars)
+
+    def handle_int_10h(self, blocking_input=True):
+        """Handle INT 10h text-mode video services (page 0 only)"""
+        service = self.get_register_value('ah')
+        screen = self.screen
+        if service == 0x00:  # Set video mode: any mode clears the text screen
+            screen.clear()
+        elif service == 0x01:  # Set cursor shape
+            screen.cursor_shape = self.get_register_value('cx')
+        elif service == 0x02:  # Set cursor position
+            screen.set_cursor(self.get_register_value('dh'), self.get_register_value('dl'))
+        elif service == 0x03:  # Get cursor position and shape
+            self.set_register_value('dh', screen.cursor_row)
+            self.set_register_value('dl', screen.cursor_column)
+            self.set_register_value('cx', screen.cursor_shape)
+        elif service in (0x06, 0x07):  # Scroll window up or down
+            scroll = screen.scroll_up if service == 0x06 else screen.scroll_down
+            scroll(self.get_register_value('al'), self.get_register_value('bh'),
+                   self.get_register_value('ch'), self.get_register_value('cl'),
+                   self.get_register_value('dh'), self.get_register_value('dl'))
+        elif service == 0x08:  # Read character and attribute at the cursor
+            char, attribute = screen.cell(screen.cursor_row, screen.cursor_column)
+            self.set_register_value('ax', char | (attribute << 8))
+        elif service in (0x09, 0x0A):  # Write character (and attribute) CX times
+            char = self.get_register_value('al')
+            attribute = self.get_register_value('bl') if service == 0x09 else None
+            cell = screen.cursor_row * COLUMNS + screen.cursor_column
+            for position in range(cell, min(cell + self.get_register_value('cx'), ROWS * COLUMNS)):
+                screen.put(position // COLUMNS, position % COLUMNS, char, attribute)
+        elif service == 0x0E:  # Teletype output, also sent to the console output
+            char = self.get_register_value('al')
+            screen.teletype(char)
+            self.write_output(bytes((char,)).decode('cp437'))
+        elif service == 0x0F:  # Get video mode
+            self.set_register_value('al', TEXT_MODE)
+            self.set_register_value('ah', COLUMNS)
+            self.set_register_value('bh', 0)
+        else:
+            raise ValueError(f"Unsupported INT 10h service: {service:02X}h")
+
+    def _handler_input(self):
+        """Ask the I/O handler for input, counting and recording what it returns"""
+        text = self.io_handler.handle_input()
+        if text:
+            self.stats.input_bytes += len(text)
+        if self.recorder is not None:
+            if text:
+                self.recorder.record_input(HANDLER, self.instruction_count, text, self.cycles)
             else:
-                self.data_segment.set_memory_byte(dest_offset, result)
-            
-            # Update flags
-            self.flags.update_flags(result)
+                self.recorder.record_input(END_OF_INPUT, self.instruction_count, '',
+                                           self.cycles)
+        return text
+
+    def handle_int_16h(self, blocking_input=True):
+        """Handle INT 16h keyboard services"""
+        service = self.get_register_value('ah')
+        if service in (0x00, 0x10, 0x01, 0x11):
+            char = self.read_key(blocking_input, remove=service in (0x00, 0x10))
+            if service in (0x01, 0x11):
+                self.flags.zero = char is None
+            if char:
+                self.set_register_value('ax', (scan_code(char[0]) << 8) | ord(char[0]))
+        elif service in (0x02, 0x12):  # Shift flags
+            self.set_register_value('al', 0)
+        else:
+            raise ValueError(f"Unsupported INT 16h service: {service:02X}h")
+
+    def handle_int_1ah(self, blocking_input=True):
+        """Handle INT 1Ah time services"""
+        service = self.get_register_value('ah')
+        if service == 0:  # Read tick count
+            self.set_register_value('cx', self.bios_ticks >> 16)
+            self.set_register_value('dx', self.bios_ticks & 0xFFFF)
+            self.set_register_value('al', 0)
+        elif service == 1:  # Set tick count
+            self.bios_ticks = (self.get_register_value('cx') << 16) | self.get_register_value('dx')
+        else:
+            raise ValueError(f"Unsupported INT 1Ah service: {service:02X}h")
 
-    def handle_int_21h(self):
+    def handle_int_21h(self, blocking_input=True):
         """Handle INT 21h services"""
         service = self.get_register_value('ah')
         
         if service == 1:  # Single character input
-            if self.io_handler:
-                char = self.io_handler.handle_input()
-                if char:
-                    self.set_register_value('al', ord(char[0]))
-                    self.io_handler.handle_output(char[0] + '\n')
+            char = self.read_key(blocking_input)
+            if char:
+                self.set_register_value('al', ord(char[0]))
+                self.write_output(char[0] + '\n')
             
         elif service == 2:  # Display character
             char = chr(self.get_register_value('dl'))
-            if self.io_handler:
-                self.io_handler.handle_output(char)
+            self.write_output(char)
             
         elif service == 9:  # Display string
             offset = self.get_register_value('dx')
             # Read string from memory until '$'
-            output = ""
-            while True:
-                char = chr(self.data_segment.get_memory_byte(offset))
-                if char == '$':
-                    break
-                output += char
-                offset += 1
-            if self.io_handler:
-                self.io_handler.handle_output(output)
+            memory = self.data_segment.memory
+            end = memory.find(ord('$'), offset)
+            if end < 0:
+                raise ValueError(f"String at {offset:04X}h has no '$' terminator")
+            self.write_output(memory.read(offset, end - offset).decode('latin-1'))
                 
+        elif service == 0x0A:  # Buffered line input
+            offset = self.get_register_value('dx')
+            memory = self.data_segment.memory
+            size = memory.get_byte(offset)
+            if size:
+                line = self.read_line(size - 1, blocking_input)
+                memory.set_byte(offset + 1, len(line))
+                memory.write(offset + 2, line.encode('latin-1', 'replace') + b'\r')
+                self.write_output(line + '\n')
+
+        elif service == 0x25:  # Set interrupt vector to DS:DX
+            self.set_vector(self.get_register_value('al'), self.get_register_value('ds'),
+                            self.get_register_value('dx'))
+
+        elif service == 0x35:  # Get interrupt vector into ES:BX
+            segment, offset = self.get_vector(self.get_register_value('al'))
+            self.set_register_value('es', segment)
+            self.set_register_value('bx', offset)
+
+        elif 0x3C <= service <= 0x42:  # File handle services
+            try:
+                self.set_register_value('ax', self.dos_file_service(service, blocking_input))
+                self.flags.carry = False
+            except DosError as error:
+                self.set_register_value('ax', error.code)
+                self.flags.carry = True
+
         elif service == 0x4c:  # Program termination
-            if self.io_handler:
-                self.io_handler.handle_output("\nProgram terminated.\n")
+            self.halted = True
+            self.write_output("\nProgram terminated.\n")
+
+    def read_asciiz(self, offset):
+        """The zero-terminated string at offset in the data segment"""
+        memory = self.data_segment.memory
+        end = memory.find(0, offset)
+        if end < 0:
+            raise ValueError(f"String at {offset:04X}h has no zero terminator")
+        return memory.read(offset, end - offset).decode('latin-1')
+
+    def dos_file_service(self, service, blocking_input=True):
+        """Run INT 21h service 3Ch-42h and return AX; raises DosError.
+
+        Reads and writes move the whole DS:DX buffer in one transfer
+        between the file and emulated memory. Handle 0 reads a line of
+        console input and handles 1 and 2 write to the output.
+        """
+        files = self.files
+        memory = self.data_segment.memory
+        handle = self.get_register_value('bx')
+        count = self.get_register_value('cx')
+        offset = self.get_register_value('dx')
+        if service == 0x3C:  # Create
+            return files.create(self.read_asciiz(offset))
+        if service == 0x3D:  # Open
+            return files.open(self.read_asciiz(offset), self.get_register_value('al'))
+        if service == 0x3E:  # Close
+            if handle > 4:
+                files.close(handle)
+            return 0
+        if service == 0x3F:  # Read
+            if handle == 0:
+                data = (self.read_line(count, blocking_input) + '\r\n').encode('latin-1', 'replace')[:count]
+            elif handle > 4:
+                data = files.read(handle, count)
+                self.stats.file_read_bytes += len(data)
+            else:
+                raise DosError(ERROR_INVALID_HANDLE)
+            memory.write(offset, data)
+            return len(data)
+        if service == 0x40:  # Write
+            data = memory.read(offset, count)
+            if handle in (1, 2):
+                self.write_output(data.decode('latin-1'))
+                return count
+            if handle > 4:
+                self.stats.file_write_bytes += count
+                return files.write(handle, data)
+            raise DosError(ERROR_INVALID_HANDLE)
+        if service == 0x41:  # Delete
+            files.delete(self.read_asciiz(offset))
+            return 0
+        # Seek: CX:DX from the origin in AL, new position returned in DX:AX
+        position = files.seek(handle, (count << 16) | offset, self.get_register_value('al'))
+        self.set_register_value('dx', (position >> 16) & 0xFFFF)
+        return position & 0xFFFF
+
+    def resolve_address(self, address):
+        """Turn an address (offset or expression such as 'var+2') into an offset.
+
+        Expressions are compiled once and cached, so repeated lookups only
+        evaluate the register part.
+        """
+        if not isinstance(address, str):
+            return address
+        operand = self._address_cache.get(address)
+        if operand is None:
+            operand = self.compile_operand(address.lower())
+            if operand.kind != 'mem':
+                raise ValueError(f"Not a memory address: {address}")
+            self._address_cache[address] = operand
+        return operand.address(self.registers)
 
     def get_memory_byte(self, address):
         """Get a byte from memory with support for offsets"""
-        if isinstance(address, str) and '+' in address:
-            base, offset = address.split('+')
-            base_addr = self.data_segment.get_variable_offset(base)
-            offset_val = int(offset)
-            return self.data_segment.get_memory_byte(base_addr + offset_val)
-        return self.data_segment.get_memory_byte(address)
+        return self.data_segment.get_memory_byte(self.resolve_address(address))
 
     def set_memory_byte(self, address, value):
         """Set a byte in memory with support for offsets"""
-        if isinstance(address, str) and '+' in address:
-            base, offset = address.split('+')
-            base_addr = self.data_segment.get_variable_offset(base)
-            offset_val = int(offset)
-            self.data_segment.set_memory_byte(base_addr + offset_val, value)
-        else:
-            self.data_segment.set_memory_byte(address, value)
+        self.data_segment.set_memory_byte(self.resolve_address(address), value)
+
+    def peek_memory(self, offset, length):
+        """Bytes of data memory read past the memory hooks, so debugger views
+        do not show up in the heatmap"""
+        memory = self.data_segment.memory
+        return type(memory).read(memory, offset, length)
+
+    def get_registers_state(self):
+        """Get the current values of the 16-bit registers"""
+        return {name.upper(): reg.get() for name, reg in self.registers.items()
+                if reg.size == 16}
 
     def get_flags_state(self):
         """Get the current state of all flags"""
@@ -763,5 +2296,6 @@ class Emulator:
             'CF': int(self.flags.carry),
             'OF': int(self.flags.overflow),
             'AF': int(self.flags.auxiliary),
-            'PF': int(self.flags.parity)
+            'PF': int(self.flags.parity),
+            'IF': int(self.flags.interrupt)
         } 
\ No newline at end of file
@@ -0,0 +1,75 @@
+"""Line coverage of assembly programs.
+
+While coverage is enabled the emulator marks every executed instruction in
+a bytearray with one entry per decoded instruction, which costs a single
+store per step. A CoverageMap turns such bitmaps into per-source-line
+counts, merges the runs of one program over many input tapes and exports
+the result as JSON or in the lcov tracefile format read by genhtml and
+most coverage viewers.
+"""
+
+import json
+
+class CoverageMap:
+    """Executed lines of one program, accumulated over any number of runs.
+
+    The count of a line is the number of runs that executed it.
+    """
+
+    def __init__(self, program, name='program.asm'):
+        self.name = name  # Source file name used in reports
+        self.lines = {}  # Source line -> instruction indices on that line
+        for index, instruction in enumerate(program):
+            if instruction.line is not None and not instruction.is_directive():
+                self.lines.setdefault(instruction.line, []).append(index)
+        self.counts = {line: 0 for line in self.lines}
+        self.runs = 0
+
+    def add_run(self, bitmap):
+        """Merge the executed-instruction bitmap of one run"""
+        for line, indices in self.lines.items():
+            if any(bitmap[index] for index in indices):
+                self.counts[line] += 1
+        self.runs += 1
+
+    def merge(self, other):
+        """Add the runs of another map of the same program"""
+        for line, count in other.counts.items():
+            self.counts[line] = self.counts.get(line, 0) + count
+        self.runs += other.runs
+
+    def covered(self):
+        return sorted(line for line, count in self.counts.items() if count)
+
+    def missed(self):
+        return sorted(line for line, count in self.counts.items() if not count)
+
+    def as_dict(self):
+        return {
+            'file': self.name,
+            'runs': self.runs,
+            'lines_found': len(self.counts),
+            'lines_hit': len(self.covered()),
+            'lines': {str(line): count for line, count in sorted(self.counts.items())},
+            'missed': self.missed(),
+        }
+
+    def to_json(self):
+        return json.dumps(self.as_dict(), indent=2)
+
+    def to_lcov(self):
+        """One lcov record (SF ... end_of_record) for this program"""
+        records = ["TN:", f"SF:{self.name}"]
+        records.extend(f"DA:{line},{count}" for line, count in sorted(self.counts.items()))
+        records.append(f"LF:{len(self.counts)}")
+        records.append(f"LH:{len(self.covered())}")
+        records.append("end_of_record")
+        return '\n'.join(records) + '\n'
+
+def write_coverage(path, maps):
+    """Write coverage maps to path: JSON for a .json file, lcov otherwise"""
+    with open(path, 'w') as f:
+        if path.endswith('.json'):
+            json.dump([coverage.as_dict() for coverage in maps], f, indent=2)
+        else:
+            f.write(''.join(coverage.to_lcov() for coverage in maps))
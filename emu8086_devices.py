@@ -0,0 +1,337 @@
+"""Event-driven devices: the scheduler, the interval timer and the keyboard.
+
+Devices do not run on every instruction. Each one schedules its next event
+at an emulated cycle count on a heap owned by the DeviceScheduler, and the
+emulator compares its cycle counter with the earliest deadline between
+instructions. Only when that deadline has passed are the due events popped
+and run, so idle devices cost nothing and a periodic device costs one heap
+operation per period.
+
+An event raises a hardware interrupt request through Emulator.raise_irq().
+The request is serviced at once when IF is set and is held pending until
+STI or POPF sets it otherwise, as the 8259 interrupt controller would.
+
+IN and OUT reach devices through the PortBus, which maps each port to its
+device in a dictionary. A device may buffer the visible effects of its
+port writes and apply them in flush(), which the emulator calls at sync
+points: when run() returns and on Emulator.sync_devices().
+"""
+
+import heapq
+import itertools
+from collections import deque
+
+from emu8086_replay import KEYSTROKE
+
+NEVER = float('inf')
+
+# The 8253 PIT is clocked at 1.193182 MHz, a quarter of the 4.77 MHz CPU clock
+PIT_FREQUENCY = 1193182
+CYCLES_PER_PIT_TICK = 4
+
+# Value read from a port no device answers
+OPEN_BUS = 0xFF
+
+# PIT ports: channel 0 counter and the mode/command register
+PIT_CHANNEL0_PORT = 0x40
+PIT_COMMAND_PORT = 0x43
+
+# Hardware interrupt lines and the vector each one raises
+IRQ_TIMER = 0
+IRQ_KEYBOARD = 1
+IRQ_BASE_VECTOR = 0x08
+
+# Scan codes of the US keyboard layout, by the unshifted and shifted
+# characters each key produces
+_KEY_ROWS = (
+    (0x02, "1234567890-=", "!@#$%^&*()_+"),
+    (0x10, "qwertyuiop[]", "QWERTYUIOP{}"),
+    (0x1E, "asdfghjkl;'`", 'ASDFGHJKL:"~'),
+    (0x2B, "\\zxcvbnm,./", "|ZXCVBNM<>?"),
+)
+SCAN_CODES = {'\x1b': 0x01, '\b': 0x0E, '\t': 0x0F, '\r': 0x1C, '\n': 0x1C, ' ': 0x39}
+for _first, _plain, _shifted in _KEY_ROWS:
+    for _offset, (_char, _shifted_char) in enumerate(zip(_plain, _shifted)):
+        SCAN_CODES[_char] = SCAN_CODES[_shifted_char] = _first + _offset
+
+def scan_code(char):
+    """Scan code of the key that types char, or 0 when there is none"""
+    return SCAN_CODES.get(char, 0)
+
+class DeviceScheduler:
+    """Pending device events in a heap keyed by emulated cycle"""
+
+    def __init__(self):
+        self.events = []
+        self.next_deadline = NEVER
+        self._sequence = itertools.count()  # Keeps same-cycle events in order
+
+    def schedule(self, deadline, callback):
+        """Call callback(deadline) once the cycle counter reaches deadline"""
+        heapq.heappush(self.events, (deadline, next(self._sequence), callback))
+        if deadline < self.next_deadline:
+            self.next_deadline = deadline
+
+    def run_due(self, now):
+        """Run every event whose deadline is at or before now"""
+        events = self.events
+        while events and events[0][0] <= now:
+            deadline, _, callback = heapq.heappop(events)
+            callback(deadline)
+        self.next_deadline = events[0][0] if events else NEVER
+
+    def clear(self):
+        self.events = []
+        self.next_deadline = NEVER
+
+class IntervalTimer:
+    """Channel 0 of the 8253 PIT, raising IRQ 0 (INT 08h) once per period.
+
+    The BIOS programs a divisor of 65536, which gives the familiar 18.2 Hz
+    tick. Changing the divisor restarts the countdown.
+    """
+
+    def __init__(self, emu, divisor=65536):
+        self.emu = emu
+        self.divisor = divisor
+        self.generation = 0  # Invalidates events scheduled before a restart
+        self.next_tick = None  # Cycle of the next timer interrupt
+
+    @property
+    def period(self):
+        """Cycles between two timer interrupts"""
+        return self.divisor * CYCLES_PER_PIT_TICK
+
+    def start(self, now):
+        self.start_at(now + self.period)
+
+    def start_at(self, deadline):
+        """Restart the countdown so the next interrupt comes at deadline"""
+        self.generation += 1
+        self._schedule(deadline, self.generation)
+
+    def _schedule(self, deadline, generation):
+        self.next_tick = deadline
+        self.emu.scheduler.schedule(deadline, lambda due: self._tick(due, generation))
+
+    def set_divisor(self, divisor, now):
+        self.divisor = divisor or 65536
+        self.start(now)
+
+    def _tick(self, deadline, generation):
+        if generation != self.generation:
+            return
+        self._schedule(deadline + self.period, generation)
+        self.emu.raise_irq(IRQ_TIMER)
+
+class Keyboard:
+    """Keyboard controller delivering keystrokes through IRQ 1 (INT 09h).
+
+    Keys typed with type() are latched in the controller at their scheduled
+    cycle; the INT 09h handler moves them into the BIOS type-ahead buffer
+    read by INT 16h and the DOS input services. A recording in progress
+    records each keystroke as it is pressed.
+    """
+
+    def __init__(self, emu):
+        self.emu = emu
+        self.latched = deque()
+        self.scheduled = []  # (cycle, character) of keystrokes still to come
+
+    def type(self, text, at=None, interval=0):
+        """Schedule keystrokes, the first at cycle at (default: now)"""
+        start = self.emu.cycles if at is None else at
+        for position, char in enumerate(text):
+            self._schedule(start + position * interval, char)
+
+    def _schedule(self, deadline, char):
+        keystroke = (deadline, char)
+        self.scheduled.append(keystroke)
+        self.emu.scheduler.schedule(deadline, lambda due: self._press(keystroke))
+
+    def _press(self, keystroke):
+        self.scheduled.remove(keystroke)
+        self.press(keystroke[1])
+
+    def press(self, char):
+        """Latch a keystroke now and raise IRQ 1"""
+        emu = self.emu
+        if emu.recorder is not None:
+            emu.recorder.record_input(KEYSTROKE, emu.instruction_count, char, emu.cycles)
+        self.latched.append(char)
+        emu.raise_irq(IRQ_KEYBOARD)
+
+    def read_latched(self):
+        """Take the oldest keystroke from the controller, as INT 09h does"""
+        return self.latched.popleft() if self.latched else None
+
+    def copy_to(self, keyboard):
+        """Give another keyboard the same latched and scheduled keystrokes"""
+        keyboard.latched = deque(self.latched)
+        for deadline, char in self.scheduled:
+            keyboard._schedule(deadline, char)
+
+    def clear(self):
+        self.latched.clear()
+        self.scheduled = []
+
+class PortDevice:
+    """Base class of devices on the port bus.
+
+    read() and write() see one byte or word (size 8 or 16) at a port the
+    device was registered for. flush() applies buffered side effects.
+    """
+
+    def read(self, port, size):
+        return OPEN_BUS if size == 8 else 0xFFFF
+
+    def write(self, port, value, size):
+        pass
+
+    def flush(self):
+        pass
+
+class PortBus:
+    """The I/O port space, mapping each port to the device behind it"""
+
+    def __init__(self):
+        self.devices = {}  # port -> device
+        self.attached = []  # Devices in registration order, for flush()
+
+    def register(self, device, first, last=None):
+        """Attach device to ports first..last (inclusive)"""
+        last = first if last is None else last
+        for port in range(first, last + 1):
+            self.devices[port & 0xFFFF] = device
+        if device not in self.attached:
+            self.attached.append(device)
+
+    def unregister(self, device):
+        self.devices = {port: owner for port, owner in self.devices.items()
+                        if owner is not device}
+        if device in self.attached:
+            self.attached.remove(device)
+
+    def read(self, port, size=8):
+        device = self.devices.get(port)
+        if device is None:
+            return OPEN_BUS if size == 8 else 0xFFFF
+        return device.read(port, size)
+
+    def write(self, port, value, size=8):
+        device = self.devices.get(port)
+        if device is not None:
+            device.write(port, value, size)
+
+    def flush(self):
+        for device in self.attached:
+            device.flush()
+
+class TimerPorts(PortDevice):
+    """The PIT channel 0 ports, programming the IntervalTimer.
+
+    A mode command on port 43h selects low byte, high byte or both (low
+    first) for channel 0; writing the last byte of a new count reloads the
+    divisor. Reads return the count latched by a latch command, or the
+    running count.
+    """
+
+    def __init__(self, emu):
+        self.emu = emu
+        self.access = 3  # 1 low byte, 2 high byte, 3 low then high
+        self.low = None  # Low byte written while waiting for the high byte
+        self.latched = None
+        self.read_high = False
+
+    def _count(self):
+        timer = self.emu.timer
+        remaining = (timer.next_tick - self.emu.cycles) // CYCLES_PER_PIT_TICK
+        return max(remaining, 0) & 0xFFFF
+
+    def write(self, port, value, size):
+        value &= 0xFF
+        if port == PIT_COMMAND_PORT:
+            if value >> 6:
+                return  # Channels 1 and 2 are not connected
+            access = (value >> 4) & 3
+            if access == 0:  # Counter latch
+                self.latched = self._count()
+            else:
+                self.access, self.low, self.read_high = access, None, False
+            return
+        if port != PIT_CHANNEL0_PORT:
+            return
+        if self.access == 1:
+            divisor = value
+        elif self.access == 2:
+            divisor = value << 8
+        elif self.low is None:
+            self.low = value
+            return
+        else:
+            divisor, self.low = self.low | (value << 8), None
+        self.emu.timer.set_divisor(divisor, self.emu.cycles)
+
+    def read(self, port, size):
+        if port != PIT_CHANNEL0_PORT:
+            return OPEN_BUS
+        count = self._count() if self.latched is None else self.latched
+        if self.access == 2 or (self.access == 3 and self.read_high):
+            value = count >> 8
+            self.latched = None
+        else:
+            value = count & 0xFF
+            if self.access == 1:
+                self.latched = None
+        if self.access == 3:
+            self.read_high = not self.read_high
+        return value
+
+class PortLog(PortDevice):
+    """Records every byte written to its ports.
+
+    Writes are buffered and appended to entries, or handed to sink as one
+    list, only when the bus is flushed.
+    """
+
+    def __init__(self, sink=None):
+        self.sink = sink
+        self.entries = []  # (port, value) of flushed writes
+        self.pending = []
+
+    def write(self, port, value, size):
+        self.pending.append((port, value))
+
+    def flush(self):
+        if not self.pending:
+            return
+        pending, self.pending = self.pending, []
+        if self.sink is not None:
+            self.sink(pending)
+        else:
+            self.entries.extend(pending)
+
+class LedDisplay(PortDevice):
+    """A bank of LEDs, one output port per 8 LEDs.
+
+    Port writes only update the latched state; on_change(states) is called
+    on flush when the state differs from the one last shown.
+    """
+
+    def __init__(self, first_port, digits=1, on_change=None):
+        self.first_port = first_port
+        self.state = [0] * digits
+        self.shown = list(self.state)
+        self.on_change = on_change
+
+    def write(self, port, value, size):
+        self.state[port - self.first_port] = value & 0xFF
+
+    def read(self, port, size):
+        return self.state[port - self.first_port]
+
+    def flush(self):
+        if self.state != self.shown:
+            self.shown = list(self.state)
+            if self.on_change is not None:
+                self.on_change(self.shown)
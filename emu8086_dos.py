@@ -0,0 +1,183 @@
+"""DOS file handles backed by real files in a sandbox directory.
+
+Programs name files by ASCIIZ strings that are resolved inside the sandbox
+root; absolute paths, drive letters and '..' cannot reach outside it. No
+file service works until a root is configured.
+
+Transfers move whole buffers: a read copies the requested bytes from the
+file straight into emulated memory a page at a time, and large files
+opened for reading are memory-mapped so a read is a single slice of the
+mapping.
+"""
+
+import mmap
+import os
+
+# Handles 0-4 are the standard devices (input, output, error, aux, printer)
+FIRST_FILE_HANDLE = 5
+MAX_OPEN_FILES = 20
+
+# Files at least this large are memory-mapped when opened for reading
+MMAP_THRESHOLD = 64 * 1024
+
+# DOS error codes, returned in AX with CF set
+ERROR_INVALID_FUNCTION = 0x01
+ERROR_FILE_NOT_FOUND = 0x02
+ERROR_PATH_NOT_FOUND = 0x03
+ERROR_TOO_MANY_OPEN_FILES = 0x04
+ERROR_ACCESS_DENIED = 0x05
+ERROR_INVALID_HANDLE = 0x06
+ERROR_INVALID_ACCESS = 0x0C
+
+# Open modes by the access code in AL
+ACCESS_MODES = {0: 'rb', 1: 'r+b', 2: 'r+b'}
+
+class DosError(Exception):
+    """A failed DOS call; code is the DOS error number"""
+
+    def __init__(self, code):
+        super().__init__(f"DOS error {code:02X}h")
+        self.code = code
+
+class DosFile:
+    """An open file handle"""
+
+    def __init__(self, path, access, file):
+        self.path = path
+        self.access = access  # 0 read, 1 write, 2 read/write
+        self.file = file
+        self.map = None
+        if access == 0:
+            size = os.fstat(file.fileno()).st_size
+            if size >= MMAP_THRESHOLD:
+                self.map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def read(self, count):
+        if self.map is not None:
+            position = self.file.tell()
+            data = self.map[position:position + count]
+            self.file.seek(position + len(data))
+            return data
+        return self.file.read(count)
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+        self.file.close()
+
+class DosFileSystem:
+    """The open file table of one emulator"""
+
+    def __init__(self, root=None):
+        self.root = os.path.realpath(root) if root else None
+        self.handles = {}
+
+    def resolve(self, name):
+        """Path of a DOS file name inside the sandbox"""
+        if self.root is None:
+            raise DosError(ERROR_ACCESS_DENIED)
+        name = name.replace('\\', '/')
+        if len(name) >= 2 and name[1] == ':':
+            name = name[2:]  # Drive letters all name the sandbox
+        path = os.path.realpath(os.path.join(self.root, name.lstrip('/')))
+        if os.path.commonpath([self.root, path]) != self.root or path == self.root:
+            raise DosError(ERROR_ACCESS_DENIED)
+        if not os.path.isdir(os.path.dirname(path)):
+            raise DosError(ERROR_PATH_NOT_FOUND)
+        return path
+
+    def _add(self, path, access, file):
+        for handle in range(FIRST_FILE_HANDLE, FIRST_FILE_HANDLE + MAX_OPEN_FILES):
+            if handle not in self.handles:
+                self.handles[handle] = DosFile(path, access, file)
+                return handle
+        file.close()
+        raise DosError(ERROR_TOO_MANY_OPEN_FILES)
+
+    def _file(self, handle):
+        entry = self.handles.get(handle)
+        if entry is None:
+            raise DosError(ERROR_INVALID_HANDLE)
+        return entry
+
+    def create(self, name):
+        """Create or truncate a file, open for reading and writing"""
+        path = self.resolve(name)
+        if len(self.handles) >= MAX_OPEN_FILES:
+            raise DosError(ERROR_TOO_MANY_OPEN_FILES)
+        try:
+            file = open(path, 'w+b')
+        except OSError:
+            raise DosError(ERROR_ACCESS_DENIED)
+        return self._add(path, 2, file)
+
+    def open(self, name, access):
+        if access & 0x07 not in ACCESS_MODES:
+            raise DosError(ERROR_INVALID_ACCESS)
+        path = self.resolve(name)
+        if not os.path.isfile(path):
+            raise DosError(ERROR_FILE_NOT_FOUND)
+        if len(self.handles) >= MAX_OPEN_FILES:
+            raise DosError(ERROR_TOO_MANY_OPEN_FILES)
+        try:
+            file = open(path, ACCESS_MODES[access & 0x07])
+        except OSError:
+            raise DosError(ERROR_ACCESS_DENIED)
+        return self._add(path, access & 0x07, file)
+
+    def close(self, handle):
+        self._file(handle).close()
+        del self.handles[handle]
+
+    def read(self, handle, count):
+        entry = self._file(handle)
+        if entry.access == 1:
+            raise DosError(ERROR_ACCESS_DENIED)
+        return entry.read(count)
+
+    def write(self, handle, data):
+        entry = self._file(handle)
+        if entry.access == 0:
+            raise DosError(ERROR_ACCESS_DENIED)
+        if not data:
+            entry.file.truncate()  # A zero-length write truncates at the pointer
+            return 0
+        entry.file.write(data)
+        return len(data)
+
+    def seek(self, handle, offset, origin):
+        """Move the file pointer; origin 0 start, 1 current, 2 end"""
+        if origin not in (0, 1, 2):
+            raise DosError(ERROR_INVALID_FUNCTION)
+        entry = self._file(handle)
+        if origin != 0 and offset >= 0x80000000:
+            offset -= 1 << 32  # CX:DX is signed relative to the pointer or the end
+        try:
+            return entry.file.seek(offset, origin)
+        except (OSError, ValueError):
+            raise DosError(ERROR_INVALID_FUNCTION)
+
+    def delete(self, name):
+        path = self.resolve(name)
+        if not os.path.isfile(path):
+            raise DosError(ERROR_FILE_NOT_FOUND)
+        try:
+            os.remove(path)
+        except OSError:
+            raise DosError(ERROR_ACCESS_DENIED)
+
+    def close_all(self):
+        for entry in self.handles.values():
+            entry.close()
+        self.handles = {}
+
+    def fork(self):
+        """A file table with the same root whose handles reopen the same
+        files at the same positions"""
+        table = DosFileSystem()
+        table.root = self.root
+        for handle, entry in self.handles.items():
+            file = open(entry.path, ACCESS_MODES[entry.access])
+            file.seek(entry.file.tell())
+            table.handles[handle] = DosFile(entry.path, entry.access, file)
+        return table
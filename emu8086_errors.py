@@ -0,0 +1,4 @@
+"""Exceptions shared by the emulator core and the modules it uses."""
+
+class InputPending(Exception):
+    """Raised when the program needs input that has not been delivered yet"""
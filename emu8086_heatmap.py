@@ -0,0 +1,132 @@
+"""Per-byte read and write counts of emulated memory.
+
+Counters are array('I') pages of the same 256 bytes as SparseMemory,
+allocated the first time a byte of the page is read or written, so a
+program that touches a few variables and its stack holds a few pages of
+counters rather than 64K of them. The touched pages are also the memory a
+session actually needs. An access covering a whole page only adds to a
+per-page count, which is folded into the counters when they are read, and
+a partial page is updated with one slice assignment, so bulk transfers
+such as 64K DOS file reads cost one step per page rather than a Python
+loop per byte.
+
+A heatmap saves as CSV (address, reads, writes for every touched byte) or,
+for a .json path, as JSON with a summary and the same rows.
+"""
+
+import json
+from array import array
+from itertools import repeat
+from operator import add
+
+from emu8086_memory import PAGE_BITS, PAGE_MASK, PAGE_SIZE
+
+# A page of zero counters, copied for each newly touched page
+ZERO_COUNTERS = array('I', bytes(4 * PAGE_SIZE))
+
+class MemoryHeatmap:
+    """Read and write counters for every byte of a memory of size bytes"""
+
+    def __init__(self, size=0x10000):
+        self.size = size
+        self.wrap = size - 1
+        self.reads = {}   # page number -> array('I') of PAGE_SIZE counters
+        self.writes = {}
+        self._whole_reads = {}  # page number -> accesses of the whole page not yet folded in
+        self._whole_writes = {}
+
+    def _count(self, pages, whole, address, length):
+        while length > 0:
+            number = address >> PAGE_BITS
+            offset = address & PAGE_MASK
+            count = min(PAGE_SIZE - offset, length)
+            if count == PAGE_SIZE:
+                whole[number] = whole.get(number, 0) + 1
+            else:
+                counters = pages.get(number)
+                if counters is None:
+                    counters = pages[number] = array('I', ZERO_COUNTERS)
+                end = offset + count
+                counters[offset:end] = array('I', map(add, counters[offset:end], repeat(1)))
+            address = (address + count) & self.wrap
+            length -= count
+
+    def _fold(self):
+        """Add the whole-page counts to the counters"""
+        for pages, whole in ((self.reads, self._whole_reads), (self.writes, self._whole_writes)):
+            for number, times in whole.items():
+                counters = pages.get(number, ZERO_COUNTERS)
+                pages[number] = array('I', map(add, counters, repeat(times)))
+            whole.clear()
+
+    def count_reads(self, address, length=1):
+        self._count(self.reads, self._whole_reads, address, length)
+
+    def count_writes(self, address, length=1):
+        self._count(self.writes, self._whole_writes, address, length)
+
+    def reads_at(self, address):
+        self._fold()
+        counters = self.reads.get(address >> PAGE_BITS)
+        return 0 if counters is None else counters[address & PAGE_MASK]
+
+    def writes_at(self, address):
+        self._fold()
+        counters = self.writes.get(address >> PAGE_BITS)
+        return 0 if counters is None else counters[address & PAGE_MASK]
+
+    def pages(self):
+        """Sorted numbers of the pages read or written"""
+        self._fold()
+        return sorted(self.reads.keys() | self.writes.keys())
+
+    def peak(self):
+        """Highest read plus write count of any byte"""
+        return max((max(map(add, self.reads.get(number, ZERO_COUNTERS),
+                             self.writes.get(number, ZERO_COUNTERS)))
+                    for number in self.pages()), default=0)
+
+    def rows(self):
+        """(address, reads, writes) for every byte read or written, by address"""
+        for number in self.pages():
+            reads = self.reads.get(number, ZERO_COUNTERS)
+            writes = self.writes.get(number, ZERO_COUNTERS)
+            base = number << PAGE_BITS
+            for offset in range(PAGE_SIZE):
+                if reads[offset] or writes[offset]:
+                    yield base + offset, reads[offset], writes[offset]
+
+    def add(self, other):
+        """Add the counts of another heatmap"""
+        self._fold()
+        other._fold()
+        for mine, theirs in ((self.reads, other.reads), (self.writes, other.writes)):
+            for number, counters in theirs.items():
+                total = mine.get(number)
+                if total is None:
+                    mine[number] = array('I', counters)
+                else:
+                    total[:] = array('I', map(add, total, counters))
+
+    def summary(self):
+        rows = list(self.rows())
+        return {
+            'page_size': PAGE_SIZE,
+            'pages': len(self.pages()),
+            'bytes_touched': len(rows),
+            'bytes_read': sum(1 for row in rows if row[1]),
+            'bytes_written': sum(1 for row in rows if row[2]),
+            'reads': sum(row[1] for row in rows),
+            'writes': sum(row[2] for row in rows),
+        }
+
+    def save(self, path):
+        """Write the heatmap as CSV, or as JSON for a .json path"""
+        with open(path, 'w') as f:
+            if path.endswith('.json'):
+                json.dump({'summary': self.summary(),
+                           'bytes': [list(row) for row in self.rows()]}, f)
+            else:
+                f.write('address,reads,writes\n')
+                for address, reads, writes in self.rows():
+                    f.write(f"{address:04X},{reads},{writes}\n")
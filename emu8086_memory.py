@@ -0,0 +1,236 @@
+"""Sparse, page-granular emulated memory.
+
+The address space is split into 256-byte pages that are allocated on the
+first write of a non-zero byte. Every other page reads from one shared,
+read-only zero page, so an emulator that touches a few hundred bytes holds
+a few hundred bytes instead of a full 64KB buffer. Bulk reads, writes and
+searches work a page at a time, so a contiguous run costs one slice per
+page rather than one call per byte.
+
+DirtyMemory additionally marks written bytes (or cells of several bytes)
+in a bitmap, so a display can redraw only what changed.
+
+fork() shares every page copy-on-write: shared pages are frozen as bytes
+objects, which read exactly like bytearrays, and the first write to one
+fails with TypeError and swaps in a private copy. Writes to private pages
+pay nothing for this.
+"""
+
+import struct
+
+PAGE_BITS = 8
+PAGE_SIZE = 1 << PAGE_BITS
+PAGE_MASK = PAGE_SIZE - 1
+
+# Backs every page that has never been written
+ZERO_PAGE = bytes(PAGE_SIZE)
+
+WORD = struct.Struct('<H')
+
+class SparseMemory:
+    """Byte-addressable memory of size bytes (a power of two).
+
+    Addresses wrap around at size, so a word at the last byte continues
+    at address 0 as it does within an 8086 segment.
+    """
+
+    def __init__(self, size=0x10000):
+        self.size = size
+        self.wrap = size - 1
+        # page number -> bytearray of PAGE_SIZE bytes, or bytes while shared
+        self.pages = {}
+
+    def __len__(self):
+        return self.size
+
+    def _writable_page(self, number):
+        page = self.pages.get(number)
+        if page is None:
+            page = self.pages[number] = bytearray(PAGE_SIZE)
+        elif not isinstance(page, bytearray):
+            page = self.pages[number] = bytearray(page)  # Copy on write
+        return page
+
+    def get_byte(self, address):
+        page = self.pages.get(address >> PAGE_BITS)
+        return 0 if page is None else page[address & PAGE_MASK]
+
+    def set_byte(self, address, value):
+        page = self.pages.get(address >> PAGE_BITS)
+        if page is None:
+            if not value & 0xFF:
+                return  # Already zero; keep the page unallocated
+            page = self._writable_page(address >> PAGE_BITS)
+        try:
+            page[address & PAGE_MASK] = value & 0xFF
+        except TypeError:
+            self._writable_page(address >> PAGE_BITS)[address & PAGE_MASK] = value & 0xFF
+
+    def get_word(self, address):
+        """Little-endian word; one struct read unless it straddles two pages"""
+        offset = address & PAGE_MASK
+        if offset != PAGE_MASK:
+            return WORD.unpack_from(self.pages.get(address >> PAGE_BITS, ZERO_PAGE), offset)[0]
+        # Bytes through the class, past any access wrapper set on the instance
+        get_byte = type(self).get_byte
+        return get_byte(self, address) | (get_byte(self, (address + 1) & self.wrap) << 8)
+
+    def set_word(self, address, value):
+        offset = address & PAGE_MASK
+        if offset != PAGE_MASK:
+            page = self.pages.get(address >> PAGE_BITS)
+            if page is None:
+                if not value & 0xFFFF:
+                    return
+                page = self._writable_page(address >> PAGE_BITS)
+            try:
+                WORD.pack_into(page, offset, value & 0xFFFF)
+            except TypeError:
+                WORD.pack_into(self._writable_page(address >> PAGE_BITS), offset, value & 0xFFFF)
+        else:
+            set_byte = type(self).set_byte
+            set_byte(self, address, value)
+            set_byte(self, (address + 1) & self.wrap, value >> 8)
+
+    def _chunks(self, address, length):
+        """(page number, offset in page, length) runs covering a range"""
+        while length > 0:
+            offset = address & PAGE_MASK
+            count = min(PAGE_SIZE - offset, length)
+            yield address >> PAGE_BITS, offset, count
+            address = (address + count) & self.wrap
+            length -= count
+
+    def read(self, address, length):
+        """Read length bytes starting at address"""
+        pages = self.pages
+        return b''.join(pages.get(number, ZERO_PAGE)[offset:offset + count]
+                        for number, offset, count in self._chunks(address, length))
+
+    def write(self, address, data):
+        """Write a bytes-like object starting at address"""
+        data = memoryview(data)
+        position = 0
+        for number, offset, count in self._chunks(address, len(data)):
+            chunk = data[position:position + count]
+            position += count
+            if number not in self.pages and not any(chunk):
+                continue
+            self._writable_page(number)[offset:offset + count] = chunk
+
+    def find(self, value, address, end=None):
+        """Address of the first byte equal to value in [address, end), or -1"""
+        end = self.size if end is None else end
+        pages = self.pages
+        for number, offset, count in self._chunks(address, end - address):
+            page = pages.get(number, ZERO_PAGE)
+            found = page.find(value, offset, offset + count)
+            if found >= 0:
+                return (number << PAGE_BITS) + found
+        return -1
+
+    def _empty(self):
+        """A memory of the same kind and size with no pages"""
+        return SparseMemory(self.size)
+
+    def copy(self):
+        """An independent copy holding only the allocated pages"""
+        memory = self._empty()
+        memory.pages = {number: bytearray(page) for number, page in self.pages.items()}
+        return memory
+
+    def fork(self):
+        """Copy-on-write copy: both sides share every page until one writes it"""
+        pages = self.pages
+        for number, page in pages.items():
+            if isinstance(page, bytearray):
+                pages[number] = bytes(page)
+        memory = self._empty()
+        memory.pages = dict(pages)
+        return memory
+
+    def allocated_bytes(self):
+        return len(self.pages) * PAGE_SIZE
+
+class DirtyMemory(SparseMemory):
+    """SparseMemory that marks what was written in a dirty bitmap.
+
+    The bitmap has one byte per unit of 1 << unit_bits bytes, such as a
+    character cell of text video memory, covering only the first tracked
+    bytes (default: all of them); writes past them are not marked.
+    take_dirty() returns the units written since the last call, found with
+    bytearray.find so that a frame with few changes costs little to scan.
+    A new memory counts as wholly dirty, and the bitmap is allocated only
+    when a unit is written after a take_dirty().
+    """
+
+    def __init__(self, size=0x10000, unit_bits=0, tracked=None):
+        super().__init__(size)
+        self.unit_bits = unit_bits
+        self.units = (size if tracked is None else tracked) >> unit_bits
+        self.dirty = None  # Bitmap, allocated on the first mark
+        self.all_dirty = True
+
+    def _bitmap(self):
+        if self.dirty is None:
+            self.dirty = bytearray(self.units)
+        return self.dirty
+
+    def _mark(self, first, last):
+        """Mark units first..last (inclusive), ignoring untracked ones"""
+        last = min(last, self.units - 1)
+        if first <= last and not self.all_dirty:
+            self._bitmap()[first:last + 1] = b'\x01' * (last - first + 1)
+
+    def set_byte(self, address, value):
+        super().set_byte(address, value)
+        unit = (address & self.wrap) >> self.unit_bits
+        self._mark(unit, unit)
+
+    def set_word(self, address, value):
+        super().set_word(address, value)
+        bits = self.unit_bits
+        first, second = (address & self.wrap) >> bits, ((address + 1) & self.wrap) >> bits
+        self._mark(first, first)
+        self._mark(second, second)
+
+    def write(self, address, data):
+        super().write(address, data)
+        bits = self.unit_bits
+        for start, length in self._runs(address, len(data)):
+            self._mark(start >> bits, (start + length - 1) >> bits)
+
+    def _runs(self, address, length):
+        """(address, length) pieces of a range that do not wrap around"""
+        address &= self.wrap
+        while length > 0:
+            count = min(self.size - address, length)
+            yield address, count
+            address, length = 0, length - count
+
+    def mark_all(self):
+        self.all_dirty = True
+        self.dirty = None
+
+    def take_dirty(self):
+        """Units written since the last call, in address order"""
+        if self.all_dirty:
+            self.all_dirty = False
+            self.dirty = None
+            return list(range(self.units))
+        dirty = self.dirty
+        units = []
+        if dirty is None:
+            return units
+        unit = dirty.find(1)
+        while unit >= 0:
+            units.append(unit)
+            unit = dirty.find(1, unit + 1)
+        self.dirty = None
+        return units
+
+    def _empty(self):
+        memory = DirtyMemory(self.size, self.unit_bits, self.units << self.unit_bits)
+        memory.all_dirty = self.all_dirty
+        memory.dirty = None if self.dirty is None else bytearray(self.dirty)
+        return memory
@@ -0,0 +1,96 @@
+"""Run statistics of emulators and their Prometheus and JSON exposition.
+
+Every Emulator counts into an EmulatorStats object. The counters are
+plain integer additions on paths that already do far more work (a run,
+a parse, an INT, an output call, a port access), so they are always on.
+Several emulators may share one EmulatorStats, as the session server's
+pool does, to report totals.
+
+Per-instruction and per-write hooks are not counted here; they are
+registered with Emulator.add_hook() for the events in HOOK_EVENTS and
+cost nothing while none are registered.
+"""
+
+import json
+
+# Events accepted by Emulator.add_hook() and the arguments of their callbacks
+HOOK_EVENTS = (
+    'before_instruction',  # callback(emu, index)
+    'after_instruction',   # callback(emu, index)
+    'interrupt',           # callback(emu, vector, ah)
+    'memory_write',        # callback(emu, address, length)
+)
+
+# Exported metrics: (key, Prometheus type, help text)
+METRICS = (
+    ('instructions', 'counter', "Instructions executed by run()"),
+    ('cycles', 'counter', "Emulated 8086 clock cycles executed by run()"),
+    ('runs', 'counter', "Calls of run()"),
+    ('run_seconds', 'counter', "Wall-clock seconds spent in run()"),
+    ('instructions_per_second', 'gauge', "Instructions per second of run() time"),
+    ('programs_parsed', 'counter', "Programs parsed from source"),
+    ('parse_seconds', 'counter', "Wall-clock seconds spent parsing programs"),
+    ('program_cache_hits', 'counter', "Programs installed from a ProgramCache"),
+    ('program_cache_misses', 'counter', "Programs parsed after a ProgramCache miss"),
+    ('input_bytes', 'counter', "Characters of program input received"),
+    ('output_bytes', 'counter', "Characters of program output written"),
+    ('port_read_bytes', 'counter', "Bytes read from I/O ports"),
+    ('port_write_bytes', 'counter', "Bytes written to I/O ports"),
+    ('file_read_bytes', 'counter', "Bytes read from DOS files"),
+    ('file_write_bytes', 'counter', "Bytes written to DOS files"),
+    ('memory_pages', 'gauge', "Data memory pages written by the current programs"),
+)
+
+class EmulatorStats:
+    """Counters accumulated over the lifetime of one or more emulators"""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.instructions = 0
+        self.cycles = 0
+        self.runs = 0
+        self.run_seconds = 0.0
+        self.programs_parsed = 0
+        self.parse_seconds = 0.0
+        self.program_cache_hits = 0
+        self.program_cache_misses = 0
+        self.interrupts = {}  # (vector, AH) -> count
+        self.input_bytes = 0
+        self.output_bytes = 0
+        self.port_read_bytes = 0
+        self.port_write_bytes = 0
+        self.file_read_bytes = 0
+        self.file_write_bytes = 0
+
+    @property
+    def instructions_per_second(self):
+        return self.instructions / self.run_seconds if self.run_seconds else 0.0
+
+    def as_dict(self, memory_pages=0):
+        stats = {key: getattr(self, key) for key, _, _ in METRICS if key != 'memory_pages'}
+        stats['memory_pages'] = memory_pages
+        stats['interrupts'] = {f"{vector:02X}h/{service:02X}h": count for (vector, service), count
+                               in sorted(self.interrupts.items())}
+        return stats
+
+def format_json(stats):
+    """Statistics from EmulatorStats.as_dict() as a JSON document"""
+    return json.dumps(stats, indent=2) + '\n'
+
+def format_prometheus(stats, prefix='neoemu86'):
+    """Statistics from EmulatorStats.as_dict() in the Prometheus text format"""
+    lines = []
+    for key, kind, help_text in METRICS:
+        name = f"{prefix}_{key}_total" if kind == 'counter' else f"{prefix}_{key}"
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        lines.append(f"{name} {stats[key]}")
+    name = f"{prefix}_interrupts_total"
+    lines.append(f"# HELP {name} Software and hardware interrupts by vector and AH")
+    lines.append(f"# TYPE {name} counter")
+    for label, count in stats['interrupts'].items():
+        vector, service = label.split('/')
+        lines.append(f'{name}{{vector="{vector}",ah="{service}"}} {count}')
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,178 @@
+"""Algebraic fast-forward of simple counted loops.
+
+A counted loop is a straight-line body closed by either
+
+    head:  <body>            head:  <body>
+           loop head                dec reg
+                                    jnz head
+
+where every body instruction only updates general purpose registers by
+constants or by registers that the body never writes (ADD, SUB, INC,
+DEC, MOV, XOR/SUB of a register with itself, NOP), and the counter is
+not otherwise used. Such bodies touch no memory and do no I/O, so the
+register state after N iterations has a closed form.
+
+When the closing branch is about to start another iteration with K
+iterations left, the plan applies K - 1 iterations at once and lets the
+interpreter run the final one normally. The flags are therefore exactly
+those the last iteration produces, and the instruction count advances
+and the cycle counter advance as if every skipped instruction had executed.
+A skip never reaches the next device event: the iterations before it are
+skipped, the rest run normally until the event has fired, and the loop is
+fast-forwarded again from there, so timer interrupts arrive on the same
+instruction as without fast-forward.
+"""
+
+# General purpose registers and the 16-bit register each one belongs to
+REGISTER_FAMILIES = {
+    'ax': 'ax', 'al': 'ax', 'ah': 'ax',
+    'bx': 'bx', 'bl': 'bx', 'bh': 'bx',
+    'cx': 'cx', 'cl': 'cx', 'ch': 'cx',
+    'dx': 'dx', 'dl': 'dx', 'dh': 'dx',
+    'si': 'si', 'di': 'di', 'bp': 'bp',
+}
+
+class LoopPlan:
+    """Closed-form description of one counted loop"""
+
+    def __init__(self, head, counter, form, updates, iteration_length,
+                 iteration_cycles=0, branch_cycles=0):
+        self.head = head
+        self.counter = counter
+        self.form = form  # 'loop' or 'dec'
+        # register -> (mode, constant, [(sign, source register)]); mode is
+        # 'add' for a per-iteration increment or 'set' for a fixed end value
+        self.updates = updates
+        self.iteration_length = iteration_length
+        self.iteration_cycles = iteration_cycles
+        self.branch_cycles = branch_cycles
+
+    def fast_forward(self, emu):
+        """Skip all but the last remaining iteration, or as many as end
+        before the next device event.
+
+        Called with the closing branch as the current instruction. Returns
+        False, leaving the state untouched, when no iteration can be skipped
+        or the branch will not be taken.
+        """
+        registers = emu.registers
+        if self.form == 'loop':
+            remaining = (registers['cx'].value - 1) & 0xFFFF
+        else:
+            if emu.flags.zero:
+                return False
+            remaining = registers[self.counter].value
+        if remaining < 2:
+            return False
+
+        skipped = remaining - 1
+        # Stay below the next scheduled event so it fires at its instruction
+        budget = emu.scheduler.next_deadline - emu.cycles - self.branch_cycles - 1
+        if budget < skipped * self.iteration_cycles:
+            skipped = int(budget // self.iteration_cycles)
+            if skipped < 1:
+                return False
+        for register, (mode, constant, sources) in self.updates.items():
+            delta = constant
+            for sign, source in sources:
+                delta += sign * registers[source].value
+            if mode == 'add':
+                emu.set_register_value(register, registers[register].value + skipped * delta)
+            else:
+                emu.set_register_value(register, delta)
+        emu.set_register_value(self.counter, remaining - skipped)
+
+        emu.current_instruction_index = self.head
+        emu.instruction_count += 1 + skipped * self.iteration_length
+        emu.cycles += self.branch_cycles + skipped * self.iteration_cycles
+        return True
+
+def _analyze_body(body, counter):
+    """Return the register updates made by one pass over body, or None"""
+    updates = {}
+    names = {}  # family -> the one register name used for it in the body
+    sources = set()
+
+    def use(register):
+        family = REGISTER_FAMILIES.get(register)
+        if family is None or family == REGISTER_FAMILIES[counter]:
+            return False
+        return names.setdefault(family, register) == register
+
+    for instruction in body:
+        opcode, args = instruction.opcode, instruction.args
+        if opcode == 'nop':
+            continue
+        if not args or args[0].kind != 'reg' or not use(args[0].name):
+            return None
+        dest = args[0].name
+
+        if opcode in ('inc', 'dec') and len(args) == 1:
+            mode, constant, terms = updates.get(dest, ('add', 0, []))
+            updates[dest] = (mode, constant + (1 if opcode == 'inc' else -1), terms)
+            continue
+        if opcode not in ('mov', 'add', 'sub', 'xor') or len(args) != 2:
+            return None
+
+        source = args[1]
+        if source.kind == 'reg' and source.name == dest and opcode in ('xor', 'sub'):
+            updates[dest] = ('set', 0, [])
+            continue
+        if opcode == 'xor':
+            return None
+        if source.kind == 'imm':
+            value, term = source.value, None
+        elif source.kind == 'reg' and use(source.name):
+            value, term = 0, source.name
+            sources.add(source.name)
+        else:
+            return None
+
+        sign = -1 if opcode == 'sub' else 1
+        if opcode == 'mov':
+            updates[dest] = ('set', value, [(1, term)] if term else [])
+        else:
+            mode, constant, terms = updates.get(dest, ('add', 0, []))
+            terms = terms + [(sign, term)] if term else terms
+            updates[dest] = (mode, constant + sign * value, terms)
+
+    # Sources must be loop-invariant
+    if any(source in updates for source in sources):
+        return None
+    return updates
+
+def find_counted_loops(program):
+    """Attach a LoopPlan to the closing branch of every recognized loop.
+
+    Returns the number of loops found.
+    """
+    found = 0
+    for index, instruction in enumerate(program):
+        instruction.loop_plan = None
+        head = instruction.target
+        if head is None or head > index:
+            continue
+
+        if instruction.opcode == 'loop':
+            counter, form, body = 'cx', 'loop', program[head:index]
+            extra = 1
+        elif instruction.opcode in ('jnz', 'jne') and index > head:
+            previous = program[index - 1]
+            if (previous.opcode != 'dec' or len(previous.args) != 1
+                    or previous.args[0].kind != 'reg'
+                    or previous.args[0].name not in REGISTER_FAMILIES):
+                continue
+            counter, form, body = previous.args[0].name, 'dec', program[head:index - 1]
+            extra = 2
+        else:
+            continue
+
+        updates = _analyze_body(body, counter)
+        if updates is None:
+            continue
+        # Every skipped iteration ends with the closing branch taken
+        cycles = sum(step.cycles for step in program[head:index + 1]) + instruction.taken_cycles
+        instruction.loop_plan = LoopPlan(head, counter, form, updates, len(body) + extra,
+                                         cycles, instruction.cycles + instruction.taken_cycles)
+        found += 1
+    return found
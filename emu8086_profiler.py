@@ -0,0 +1,134 @@
+"""Call-graph profiler fed by the emulator's shadow call stack.
+
+The emulator reports every CALL and RET together with its running
+instruction count, so the profiler does no work for ordinary
+instructions. For each procedure it accumulates the number of calls and
+the inclusive and exclusive instruction counts and wall-clock time.
+Results can be exported in the collapsed-stack format read by flame
+graph tools (one "root;caller;callee count" line per distinct stack).
+"""
+
+import time
+
+class Frame:
+    """An active procedure on the shadow call stack"""
+
+    def __init__(self, name, path, start_count, start_time):
+        self.name = name
+        self.path = path
+        self.start_count = start_count
+        self.start_time = start_time
+        self.child_count = 0
+        self.child_time = 0.0
+
+    def copy(self):
+        frame = Frame(self.name, self.path, self.start_count, self.start_time)
+        frame.child_count = self.child_count
+        frame.child_time = self.child_time
+        return frame
+
+class ProcedureStats:
+    """Accumulated cost of one procedure"""
+
+    def __init__(self):
+        self.calls = 0
+        self.inclusive_instructions = 0
+        self.exclusive_instructions = 0
+        self.inclusive_time = 0.0
+        self.exclusive_time = 0.0
+
+    def copy(self):
+        stats = ProcedureStats()
+        stats.__dict__.update(self.__dict__)
+        return stats
+
+    def as_dict(self):
+        return dict(self.__dict__)
+
+class CallProfiler:
+    def __init__(self, root='main', start_count=0, clock=time.perf_counter):
+        self.clock = clock
+        self.stats = {}
+        self.collapsed = {}  # path -> [exclusive instructions, exclusive time]
+        self.frames = [Frame(root, root, start_count, clock())]
+
+    def enter(self, name, count):
+        """Record a call to name at the given instruction count"""
+        parent = self.frames[-1]
+        self.frames.append(Frame(name, f"{parent.path};{name}", count, self.clock()))
+
+    def exit(self, count):
+        """Record a return at the given instruction count"""
+        # A RET without a matching CALL leaves the root frame in place
+        if len(self.frames) > 1:
+            self._close(self.frames.pop(), self.frames, self.stats, self.collapsed,
+                        count, self.clock())
+
+    @staticmethod
+    def _close(frame, frames, stats, collapsed, count, now):
+        inclusive_count = count - frame.start_count
+        inclusive_time = now - frame.start_time
+        exclusive_count = inclusive_count - frame.child_count
+        exclusive_time = inclusive_time - frame.child_time
+
+        entry = stats.get(frame.name)
+        if entry is None:
+            entry = stats[frame.name] = ProcedureStats()
+        entry.calls += 1
+        entry.exclusive_instructions += exclusive_count
+        entry.exclusive_time += exclusive_time
+        # Recursive activations are already covered by the outermost one
+        if not any(active.name == frame.name for active in frames):
+            entry.inclusive_instructions += inclusive_count
+            entry.inclusive_time += inclusive_time
+
+        totals = collapsed.setdefault(frame.path, [0, 0.0])
+        totals[0] += exclusive_count
+        totals[1] += exclusive_time
+
+        if frames:
+            frames[-1].child_count += inclusive_count
+            frames[-1].child_time += inclusive_time
+
+    def _snapshot(self, count):
+        """Stats and collapsed stacks as if every open frame returned now"""
+        now = self.clock()
+        stats = {name: entry.copy() for name, entry in self.stats.items()}
+        collapsed = {path: list(totals) for path, totals in self.collapsed.items()}
+        frames = [frame.copy() for frame in self.frames]
+        while frames:
+            self._close(frames.pop(), frames, stats, collapsed, count, now)
+        return stats, collapsed
+
+    def report(self, count):
+        """Per-procedure statistics up to the given instruction count"""
+        stats, _ = self._snapshot(count)
+        return {name: entry.as_dict() for name, entry in stats.items()}
+
+    def format_report(self, count):
+        """Human-readable table sorted by inclusive instruction count"""
+        stats, _ = self._snapshot(count)
+        lines = [f"{'Procedure':<24}{'Calls':>8}{'Incl. instr':>14}{'Excl. instr':>14}"
+                 f"{'Incl. ms':>12}{'Excl. ms':>12}"]
+        for name, entry in sorted(stats.items(),
+                                  key=lambda item: -item[1].inclusive_instructions):
+            lines.append(f"{name:<24}{entry.calls:>8}{entry.inclusive_instructions:>14}"
+                         f"{entry.exclusive_instructions:>14}"
+                         f"{entry.inclusive_time * 1000:>12.3f}"
+                         f"{entry.exclusive_time * 1000:>12.3f}")
+        return '\n'.join(lines)
+
+    def collapsed_stacks(self, count, metric='instructions'):
+        """Collapsed-stack lines for flame graph tools.
+
+        metric is 'instructions' for exclusive instruction counts or 'time'
+        for exclusive time in microseconds.
+        """
+        _, collapsed = self._snapshot(count)
+        index = 0 if metric == 'instructions' else 1
+        lines = []
+        for path, totals in sorted(collapsed.items()):
+            value = totals[index] if index == 0 else int(round(totals[index] * 1e6))
+            if value > 0:
+                lines.append(f"{path} {value}")
+        return '\n'.join(lines) + ('\n' if lines else '')
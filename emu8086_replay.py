@@ -0,0 +1,238 @@
+"""Deterministic record and replay of program I/O.
+
+A Recording captures everything a run depends on from the outside: the
+program source, the run options, every input event with the instruction
+count and cycle at which it arrived, and all output. Input events are of
+three kinds: text queued with Emulator.add_input() (non-blocking runs,
+jobs, the server), text returned by the I/O handler during a blocking read
+(console and GUI sessions), and keystrokes pressed on the keyboard device
+(scheduled with keyboard.type() and delivered through INT 09h).
+
+replay() runs the program again with no UI. Queued input is delivered
+when the instruction count reaches the recorded value, or earlier if the
+program is already waiting for it; a keystroke is pressed at its recorded
+instruction count, with the clock first moved on to its recorded cycle
+as a BIOS wait for a key does; handler input is answered in order from
+the recording. The replayed output can then be compared byte for
+byte with the recorded output, which makes a recording both a regression
+test and a benchmark workload.
+
+The file is a small header followed by a zlib-compressed body of
+length-prefixed fields.
+"""
+
+import struct
+import time
+import zlib
+from collections import deque
+
+from emu8086_errors import InputPending
+
+MAGIC = b'NEO86REC'
+VERSION = 2
+
+HEADER = struct.Struct('<8sH')
+LENGTH = struct.Struct('<I')
+# Kind, instruction count, cycles
+EVENT = struct.Struct('<BQQ')
+# Option bits, event count, final instruction count, final cycles
+SUMMARY = struct.Struct('<BIQQ')
+
+# Input event kinds
+ADDED = 0  # Queued with add_input()
+HANDLER = 1  # Returned by the I/O handler
+END_OF_INPUT = 2  # The I/O handler had no more input
+KEYSTROKE = 3  # Pressed on the keyboard device
+
+# Kinds replay() delivers by instruction count
+QUEUED = (ADDED, KEYSTROKE)
+
+# Option bits
+FAST_FORWARD = 1
+SUPERINSTRUCTIONS = 2
+
+class InputEvent:
+    """Input that reached the program at an instruction count and cycle"""
+
+    def __init__(self, kind, count, text='', cycles=0):
+        self.kind = kind
+        self.count = count
+        self.text = text
+        self.cycles = cycles
+
+    def __repr__(self):
+        return f"InputEvent({self.kind}, {self.count}, {self.text!r}, {self.cycles})"
+
+class Recording:
+    """Inputs and output of one run of a program"""
+
+    def __init__(self, source='', fast_forward=True, superinstructions=True):
+        self.source = source
+        self.fast_forward = fast_forward
+        self.superinstructions = superinstructions
+        self.events = []
+        self.output = []  # Output text in the order it was written
+        self.instruction_count = 0
+        self.cycles = 0
+
+    @classmethod
+    def start(cls, emu):
+        """Begin recording emu, which should have its program loaded and not yet run"""
+        recording = cls(emu.source, emu.loop_fast_forward, emu.superinstructions)
+        emu.recorder = recording
+        return recording
+
+    def stop(self, emu):
+        self.instruction_count = emu.instruction_count
+        self.cycles = emu.cycles
+        emu.recorder = None
+        return self
+
+    def record_input(self, kind, count, text, cycles=0):
+        self.events.append(InputEvent(kind, count, text, cycles))
+
+    def record_output(self, text):
+        self.output.append(text)
+
+    def output_text(self):
+        return ''.join(self.output)
+
+    def save(self, path):
+        options = ((FAST_FORWARD if self.fast_forward else 0)
+                   | (SUPERINSTRUCTIONS if self.superinstructions else 0))
+        parts = [SUMMARY.pack(options, len(self.events), self.instruction_count, self.cycles),
+                 _blob(self.source)]
+        for event in self.events:
+            parts.append(EVENT.pack(event.kind, event.count, event.cycles))
+            parts.append(_blob(event.text))
+        parts.append(_blob(self.output_text()))
+        with open(path, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, VERSION))
+            f.write(zlib.compress(b''.join(parts)))
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as f:
+            data = f.read()
+        if len(data) < HEADER.size or HEADER.unpack_from(data)[0] != MAGIC:
+            raise ValueError("Not a recording file")
+        version = HEADER.unpack_from(data)[1]
+        if version != VERSION:
+            raise ValueError(f"Unsupported recording version: {version}")
+        try:
+            body = zlib.decompress(data[HEADER.size:])
+            options, count, instructions, cycles = SUMMARY.unpack_from(body)
+            offset = SUMMARY.size
+            source, offset = _read_blob(body, offset)
+            recording = cls(source, bool(options & FAST_FORWARD),
+                            bool(options & SUPERINSTRUCTIONS))
+            for _ in range(count):
+                kind, at, cycles_at = EVENT.unpack_from(body, offset)
+                text, offset = _read_blob(body, offset + EVENT.size)
+                recording.events.append(InputEvent(kind, at, text, cycles_at))
+            output, offset = _read_blob(body, offset)
+        except (zlib.error, struct.error):
+            raise ValueError("Recording file is corrupt")
+        recording.output = [output]
+        recording.instruction_count = instructions
+        recording.cycles = cycles
+        return recording
+
+def _blob(text):
+    data = text.encode('utf-8')
+    return LENGTH.pack(len(data)) + data
+
+def _read_blob(body, offset):
+    length, = LENGTH.unpack_from(body, offset)
+    start = offset + LENGTH.size
+    if start + length > len(body):
+        raise struct.error("blob past end of data")
+    return body[start:start + length].decode('utf-8'), start + length
+
+class ReplayIO:
+    """I/O handler answering blocking reads from the recorded events"""
+
+    def __init__(self, events):
+        self.events = events
+        self.output = []
+
+    def handle_input(self):
+        events = self.events
+        if events and events[0].kind == END_OF_INPUT:
+            events.popleft()
+            return None
+        if events and events[0].kind == HANDLER:
+            return events.popleft().text
+        # The recorded run had to wait for queued input here
+        raise InputPending()
+
+    def handle_output(self, text):
+        self.output.append(text)
+
+class ReplayResult:
+    """Outcome of replay()"""
+
+    def __init__(self, recording, output, emu, seconds):
+        self.expected = recording.output_text()
+        self.output = output
+        self.instruction_count = emu.instruction_count
+        self.cycles = emu.cycles
+        self.seconds = seconds
+        self.recorded_instructions = recording.instruction_count
+
+    @property
+    def matches(self):
+        """Output identical byte for byte, after the same number of instructions"""
+        return (self.output.encode('utf-8') == self.expected.encode('utf-8')
+                and self.instruction_count == self.recorded_instructions)
+
+    def first_difference(self):
+        """Offset of the first differing output character, or None"""
+        for offset, (got, expected) in enumerate(zip(self.output, self.expected)):
+            if got != expected:
+                return offset
+        if len(self.output) != len(self.expected):
+            return min(len(self.output), len(self.expected))
+        return None
+
+    @property
+    def instructions_per_second(self):
+        return self.instruction_count / self.seconds if self.seconds else 0.0
+
+def _deliver(emu, event):
+    """Give the program a queued input event"""
+    if event.kind == ADDED:
+        emu.add_input(event.text)
+    else:
+        emu.cycles = max(emu.cycles, event.cycles)
+        emu.scheduler.run_due(emu.cycles)
+        emu.keyboard.press(event.text)
+
+def replay(recording, emu):
+    """Run a recording's program on emu, feeding it the recorded input.
+
+    Returns a ReplayResult.
+    """
+    emu.reset()
+    emu.load_program(recording.source)
+    emu.loop_fast_forward = recording.fast_forward
+    emu.superinstructions = recording.superinstructions
+    events = deque(recording.events)
+    handler = ReplayIO(events)
+    emu.set_io_handler(handler)
+    start = time.perf_counter()
+    while not emu.is_finished():
+        while events and events[0].kind in QUEUED and events[0].count <= emu.instruction_count:
+            _deliver(emu, events.popleft())
+        limit = None
+        if events and events[0].kind in QUEUED:
+            limit = events[0].count - emu.instruction_count
+        emu.run(limit)
+        if emu.waiting_for_input:
+            if not (events and events[0].kind in QUEUED):
+                break  # The recorded run ended waiting for input here
+            _deliver(emu, events.popleft())
+        elif limit is None or emu.at_breakpoint:
+            break
+    seconds = time.perf_counter() - start
+    return ReplayResult(recording, ''.join(handler.output), emu, seconds)
@@ -0,0 +1,548 @@
+"""Local multi-session emulator server.
+
+Speaks JSON over HTTP/1.1 on a loopback address or a Unix socket so that
+front-ends can drive many emulator sessions from one warm process:
+
+    POST   /sessions                 create a session (optional "source")
+    GET    /sessions/<id>            read registers, flags and status
+    DELETE /sessions/<id>            close a session
+    POST   /sessions/<id>/load       {"source": "..."}
+    POST   /sessions/<id>/run        {"max_instructions": N}
+    POST   /sessions/<id>/step       {"count": N}
+    POST   /sessions/<id>/input      {"text": "..."}
+    GET    /status                   server, pool and emulator statistics
+    GET    /metrics                  emulator statistics as Prometheus text
+
+Every response except /metrics is a JSON object. Output produced by the program since the
+previous request is returned in its "output" field.
+"""
+
+import argparse
+import asyncio
+import ipaddress
+import json
+import os
+import socket
+import stat
+import time
+import uuid
+import http.client
+
+from emu8086_core import Emulator, ProgramCache
+from emu8086_metrics import EmulatorStats, format_prometheus
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8086
+MAX_REQUEST_BODY = 1024 * 1024
+
+HTTP_REASONS = {
+    200: 'OK',
+    201: 'Created',
+    400: 'Bad Request',
+    404: 'Not Found',
+    405: 'Method Not Allowed',
+    413: 'Payload Too Large',
+    429: 'Too Many Requests',
+    500: 'Internal Server Error',
+    503: 'Service Unavailable',
+}
+
+class ServerError(Exception):
+    """Error that is reported to the client with an HTTP status"""
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+class SessionLimits:
+    """Resource limits enforced for every session"""
+
+    def __init__(self, max_instructions=1_000_000, max_instructions_per_request=100_000,
+                 max_output=64 * 1024, max_source=256 * 1024, idle_timeout=600,
+                 reject_infinite_loops=False):
+        self.max_instructions = max_instructions
+        self.max_instructions_per_request = max_instructions_per_request
+        self.max_output = max_output
+        self.max_source = max_source
+        self.idle_timeout = idle_timeout
+        # Refuse programs the static analysis proves never terminate
+        self.reject_infinite_loops = reject_infinite_loops
+
+class EmulatorPool:
+    """Pool of pre-warmed Emulator instances reused across sessions"""
+
+    def __init__(self, size=16, stats=None):
+        self.size = size
+        self.stats = stats or EmulatorStats()  # Shared by every emulator of the pool
+        self.idle = [self._new_emulator() for _ in range(size)]
+        self.created = size
+        self.reused = 0
+
+    def _new_emulator(self):
+        emulator = Emulator()
+        emulator.stats = self.stats
+        return emulator
+
+    def acquire(self):
+        """Take an emulator from the pool, creating one if it is empty"""
+        if self.idle:
+            self.reused += 1
+            return self.idle.pop()
+        self.created += 1
+        return self._new_emulator()
+
+    def release(self, emulator):
+        """Clear an emulator back to its new state and return it to the pool"""
+        emulator.unload()
+        if len(self.idle) < self.size:
+            self.idle.append(emulator)
+
+class Session:
+    """A single emulator session owned by a client.
+
+    The session is its emulator's I/O handler, so the output limit is
+    enforced as output is written: the program is halted as soon as it
+    exceeds max_output.
+    """
+
+    def __init__(self, session_id, emulator, limits, programs=None):
+        self.id = session_id
+        self.emulator = emulator
+        self.limits = limits
+        self.programs = programs  # ProgramCache shared by all sessions
+        self.lock = asyncio.Lock()
+        self.loaded = False
+        self.analysis = None
+        self.output = []  # Output not yet returned to the client
+        self.output_size = 0
+        self.output_truncated = False
+        self.closed = False
+        self.last_used = time.monotonic()
+        emulator.set_io_handler(self)
+
+    def handle_input(self):
+        return None  # Input only arrives through send_input()
+
+    def handle_output(self, text):
+        room = self.limits.max_output - self.output_size
+        if len(text) > room:
+            text = text[:max(room, 0)]
+            self.output_truncated = True
+            self.emulator.halted = True
+        self.output_size += len(text)
+        self.output.append(text)
+
+    def touch(self):
+        self.last_used = time.monotonic()
+
+    def load(self, source):
+        """Parse a program into the session's emulator"""
+        if not isinstance(source, str):
+            raise ServerError(400, "'source' must be a string")
+        if len(source) > self.limits.max_source:
+            raise ServerError(413, "Program source exceeds the session limit")
+        self.emulator.reset()
+        try:
+            self.emulator.load_program(source, self.programs)
+        except ValueError as e:
+            raise ServerError(400, str(e))
+        analysis = self.emulator.analyze()
+        if analysis.has_infinite_loop and self.limits.reject_infinite_loops:
+            lines = ', '.join(str(loop[0]) for loop in analysis.infinite_loops)
+            raise ServerError(400, f"Program never terminates: infinite loop at line {lines}")
+        self.analysis = analysis.as_dict()
+        self.loaded = True
+        self.output = []
+        self.output_size = 0
+        self.output_truncated = False
+
+    def _budget(self, requested):
+        """Number of instructions the session may still execute"""
+        if not self.loaded:
+            raise ServerError(400, "No program loaded")
+        remaining = self.limits.max_instructions - self.emulator.instruction_count
+        if remaining <= 0:
+            raise ServerError(429, "Session instruction limit reached")
+        return min(requested, remaining, self.limits.max_instructions_per_request)
+
+    async def run(self, max_instructions=None):
+        """Run until the program finishes, waits for input or hits a limit"""
+        if max_instructions is None:
+            max_instructions = self.limits.max_instructions_per_request
+        budget = self._budget(_positive_int(max_instructions, 'max_instructions'))
+        try:
+            return await self.emulator.run_async(max_instructions=budget,
+                                                 stop_on_input=True)
+        except ValueError as e:
+            raise ServerError(400, str(e))
+
+    def step(self, count=1):
+        """Execute up to count instructions without suspending"""
+        budget = self._budget(_positive_int(count, 'count'))
+        try:
+            return self.emulator.run(budget, blocking_input=False)
+        except ValueError as e:
+            raise ServerError(400, str(e))
+
+    def send_input(self, text):
+        if not isinstance(text, str) or not text:
+            raise ServerError(400, "'text' must be a non-empty string")
+        self.emulator.add_input(text)
+
+    def state(self):
+        """Snapshot of the session, including output produced since the last call"""
+        emu = self.emulator
+        output = ''.join(self.output)
+        self.output = []
+        index = emu.current_instruction_index
+        return {
+            'session': self.id,
+            'loaded': self.loaded,
+            'halted': emu.halted,
+            'finished': emu.is_finished() if self.loaded else False,
+            'waiting_for_input': emu.waiting_for_input,
+            'instruction_index': index,
+            'instruction': emu.instructions[index] if index < len(emu.instructions) else None,
+            'instruction_count': emu.instruction_count,
+            'cycles': emu.cycles,
+            'registers': emu.get_registers_state(),
+            'flags': emu.get_flags_state(),
+            'output': output,
+            'output_truncated': self.output_truncated,
+            'analysis': self.analysis,
+        }
+
+def _positive_int(value, name):
+    if not isinstance(value, int) or isinstance(value, bool) or value <= 0:
+        raise ServerError(400, f"'{name}' must be a positive integer")
+    return value
+
+def is_local_host(host):
+    """Check that a host name or address refers to the loopback interface"""
+    if host == 'localhost':
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+class EmulatorServer:
+    """Asyncio HTTP server that manages emulator sessions"""
+
+    def __init__(self, pool_size=16, max_sessions=256, limits=None):
+        self.stats = EmulatorStats()
+        self.pool = EmulatorPool(pool_size, self.stats)
+        self.programs = ProgramCache()
+        self.max_sessions = max_sessions
+        self.limits = limits or SessionLimits()
+        self.sessions = {}
+        self.server = None
+        self._reaper = None
+
+    # Session management
+
+    def create_session(self):
+        if len(self.sessions) >= self.max_sessions:
+            raise ServerError(503, "Too many sessions")
+        session = Session(uuid.uuid4().hex, self.pool.acquire(), self.limits,
+                          self.programs)
+        self.sessions[session.id] = session
+        return session
+
+    def get_session(self, session_id):
+        session = self.sessions.get(session_id)
+        if session is None:
+            raise ServerError(404, f"Unknown session: {session_id}")
+        session.touch()
+        return session
+
+    async def close_session(self, session_id):
+        """Close a session, waiting for a request in progress on it to stop
+        before its emulator goes back to the pool"""
+        session = self.sessions.pop(session_id, None)
+        if session is None:
+            raise ServerError(404, f"Unknown session: {session_id}")
+        session.closed = True
+        session.emulator.halted = True  # Ends a run at its next batch
+        async with session.lock:
+            self.pool.release(session.emulator)
+
+    async def reap_idle_sessions(self):
+        """Close sessions that have been idle longer than the limit"""
+        deadline = time.monotonic() - self.limits.idle_timeout
+        for session_id, session in list(self.sessions.items()):
+            if (session.last_used < deadline and not session.lock.locked()
+                    and session_id in self.sessions):
+                await self.close_session(session_id)
+
+    async def _reap_forever(self):
+        interval = max(1, min(60, self.limits.idle_timeout / 2))
+        while True:
+            await asyncio.sleep(interval)
+            await self.reap_idle_sessions()
+
+    def get_stats(self):
+        """Statistics of all emulators the server has run, as a dict"""
+        pages = sum(len(session.emulator.data_segment.memory.pages)
+                    for session in self.sessions.values())
+        return self.stats.as_dict(pages)
+
+    # Request handling
+
+    async def handle_request(self, method, path, body):
+        """Dispatch a decoded request and return (status, payload)"""
+        parts = [part for part in path.split('?')[0].split('/') if part]
+
+        if parts == ['status'] and method == 'GET':
+            return 200, {
+                'sessions': len(self.sessions),
+                'max_sessions': self.max_sessions,
+                'pool_idle': len(self.pool.idle),
+                'pool_created': self.pool.created,
+                'pool_reused': self.pool.reused,
+                'program_cache_hits': self.programs.hits,
+                'program_cache_misses': self.programs.misses,
+                'stats': self.get_stats(),
+            }
+
+        if parts == ['metrics'] and method == 'GET':
+            return 200, format_prometheus(self.get_stats())
+
+        if not parts or parts[0] != 'sessions':
+            raise ServerError(404, f"Unknown path: {path}")
+
+        if len(parts) == 1:
+            if method != 'POST':
+                raise ServerError(405, "Use POST to create a session")
+            session = self.create_session()
+            if 'source' in body:
+                try:
+                    session.load(body['source'])
+                except ServerError:
+                    await self.close_session(session.id)
+                    raise
+            return 201, session.state()
+
+        session = self.get_session(parts[1])
+
+        if len(parts) == 2:
+            if method == 'GET':
+                return 200, session.state()
+            if method == 'DELETE':
+                await self.close_session(session.id)
+                return 200, {'session': session.id, 'closed': True}
+            raise ServerError(405, "Use GET or DELETE on a session")
+
+        if len(parts) != 3 or method != 'POST':
+            raise ServerError(404, f"Unknown path: {path}")
+
+        action = parts[2]
+        async with session.lock:
+            if session.closed:
+                raise ServerError(404, f"Unknown session: {session.id}")
+            if action == 'load':
+                session.load(body.get('source'))
+            elif action == 'run':
+                await session.run(body.get('max_instructions'))
+            elif action == 'step':
+                session.step(body.get('count', 1))
+            elif action == 'input':
+                session.send_input(body.get('text'))
+            else:
+                raise ServerError(404, f"Unknown action: {action}")
+            return 200, session.state()
+
+    async def _read_request(self, reader):
+        """Read one HTTP request, returning None when the client hangs up"""
+        request_line = await reader.readline()
+        if not request_line:
+            return None
+        try:
+            method, path, version = request_line.decode('latin-1').split()
+        except ValueError:
+            raise ServerError(400, "Malformed request line")
+
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        length = headers.get('content-length', '0') or '0'
+        if not length.isdigit():
+            raise ServerError(400, "Invalid Content-Length")
+        length = int(length)
+        if length > MAX_REQUEST_BODY:
+            raise ServerError(413, "Request body too large")
+        body = {}
+        if length:
+            try:
+                body = json.loads(await reader.readexactly(length))
+            except (ValueError, UnicodeDecodeError):
+                raise ServerError(400, "Request body must be JSON")
+            if not isinstance(body, dict):
+                raise ServerError(400, "Request body must be a JSON object")
+
+        keep_alive = headers.get('connection', '').lower() != 'close' and version == 'HTTP/1.1'
+        return method.upper(), path, body, keep_alive
+
+    async def _handle_connection(self, reader, writer):
+        try:
+            while True:
+                keep_alive = False
+                try:
+                    request = await self._read_request(reader)
+                    if request is None:
+                        break
+                    method, path, body, keep_alive = request
+                    status, payload = await self.handle_request(method, path, body)
+                except ServerError as e:
+                    status, payload = e.status, {'error': str(e)}
+                except Exception as e:
+                    status, payload = 500, {'error': f"Internal error: {e}"}
+
+                if isinstance(payload, str):
+                    data = payload.encode('utf-8')
+                    content_type = 'text/plain; version=0.0.4'
+                else:
+                    data = json.dumps(payload).encode('utf-8')
+                    content_type = 'application/json'
+                writer.write(
+                    f"HTTP/1.1 {status} {HTTP_REASONS.get(status, '')}\r\n"
+                    f"Content-Type: {content_type}\r\n"
+                    f"Content-Length: {len(data)}\r\n"
+                    f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n"
+                    .encode('latin-1') + data)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def start(self, host=DEFAULT_HOST, port=DEFAULT_PORT, unix_socket=None):
+        """Start listening on a loopback address or a Unix socket"""
+        if unix_socket:
+            if os.path.exists(unix_socket) and stat.S_ISSOCK(os.stat(unix_socket).st_mode):
+                os.unlink(unix_socket)
+            self.server = await asyncio.start_unix_server(self._handle_connection,
+                                                          path=unix_socket)
+        else:
+            if not is_local_host(host):
+                raise ValueError(f"Refusing to bind to non-local address: {host}")
+            self.server = await asyncio.start_server(self._handle_connection, host, port)
+        self._reaper = asyncio.create_task(self._reap_forever())
+        return self.server
+
+    async def close(self):
+        if self._reaper:
+            self._reaper.cancel()
+        if self.server:
+            self.server.close()
+            await self.server.wait_closed()
+        for session_id in list(self.sessions):
+            await self.close_session(session_id)
+
+    async def serve_forever(self, host=DEFAULT_HOST, port=DEFAULT_PORT, unix_socket=None):
+        server = await self.start(host, port, unix_socket)
+        try:
+            await server.serve_forever()
+        finally:
+            await self.close()
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    """HTTPConnection that talks to a Unix domain socket"""
+
+    def __init__(self, path, timeout=30):
+        super().__init__('localhost', timeout=timeout)
+        self.unix_path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.unix_path)
+
+class LocalClient:
+    """Minimal blocking client for the emulator server"""
+
+    def __init__(self, host=DEFAULT_HOST, port=DEFAULT_PORT, unix_socket=None, timeout=30):
+        if unix_socket:
+            self.connection = UnixHTTPConnection(unix_socket, timeout)
+        else:
+            self.connection = http.client.HTTPConnection(host, port, timeout=timeout)
+
+    def request(self, method, path, body=None):
+        """Send a request and return (status, payload)"""
+        data = json.dumps(body).encode('utf-8') if body is not None else None
+        headers = {'Content-Type': 'application/json'} if data else {}
+        self.connection.request(method, path, body=data, headers=headers)
+        response = self.connection.getresponse()
+        return response.status, json.loads(response.read())
+
+    def create_session(self, source=None):
+        body = {'source': source} if source is not None else {}
+        return self.request('POST', '/sessions', body)[1]
+
+    def load(self, session_id, source):
+        return self.request('POST', f'/sessions/{session_id}/load', {'source': source})[1]
+
+    def run(self, session_id, max_instructions=None):
+        body = {'max_instructions': max_instructions} if max_instructions else {}
+        return self.request('POST', f'/sessions/{session_id}/run', body)[1]
+
+    def step(self, session_id, count=1):
+        return self.request('POST', f'/sessions/{session_id}/step', {'count': count})[1]
+
+    def send_input(self, session_id, text):
+        return self.request('POST', f'/sessions/{session_id}/input', {'text': text})[1]
+
+    def state(self, session_id):
+        return self.request('GET', f'/sessions/{session_id}')[1]
+
+    def close_session(self, session_id):
+        return self.request('DELETE', f'/sessions/{session_id}')[1]
+
+    def metrics(self):
+        """Emulator statistics in the Prometheus text format"""
+        self.connection.request('GET', '/metrics')
+        return self.connection.getresponse().read().decode('utf-8')
+
+    def close(self):
+        self.connection.close()
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the local NeoEmu86 session server")
+    parser.add_argument('--host', default=DEFAULT_HOST, help="loopback address to bind")
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--unix-socket', help="listen on a Unix socket instead of TCP")
+    parser.add_argument('--pool-size', type=int, default=16,
+                        help="number of pre-warmed emulator instances")
+    parser.add_argument('--max-sessions', type=int, default=256)
+    parser.add_argument('--max-instructions', type=int, default=1_000_000,
+                        help="instruction budget for each session")
+    parser.add_argument('--max-output', type=int, default=64 * 1024,
+                        help="maximum output characters for each session")
+    parser.add_argument('--idle-timeout', type=float, default=600,
+                        help="seconds before an idle session is closed")
+    parser.add_argument('--reject-infinite-loops', action='store_true',
+                        help="refuse programs whose analysis finds a loop that never ends")
+    args = parser.parse_args()
+
+    if not args.unix_socket and not is_local_host(args.host):
+        parser.error(f"--host must be a loopback address, got {args.host}")
+
+    limits = SessionLimits(max_instructions=args.max_instructions,
+                           max_output=args.max_output,
+                           idle_timeout=args.idle_timeout,
+                           reject_infinite_loops=args.reject_infinite_loops)
+    server = EmulatorServer(args.pool_size, args.max_sessions, limits)
+    try:
+        asyncio.run(server.serve_forever(args.host, args.port, args.unix_socket))
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
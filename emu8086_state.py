@@ -0,0 +1,179 @@
+"""Checkpoint files holding the complete state of an emulator.
+
+A checkpoint is a flat binary file:
+
+  header     magic, format version
+  cpu        the 16-bit registers, FLAGS, instruction index and counters
+  devices    timer, pending IRQs, cursor and run options
+  blobs      length-prefixed program source, input and output buffers,
+             keyboard queue, breakpoints and coverage marks
+  memories   data space, video memory and vector table, each as a page
+             count, the page numbers and then the page contents
+
+Only allocated pages holding a non-zero byte are written. The program is
+stored as source and parsed again on load, which also restores labels and
+variables. Loading maps the file with mmap and copies each saved page out
+of the mapping into a bytes object before the file is closed; SparseMemory
+treats it as a shared copy-on-write page, so it is copied once more only
+when the program first writes it.
+
+Open DOS files, port devices and services installed from Python are not
+part of a checkpoint.
+"""
+
+import mmap
+import struct
+
+from emu8086_memory import PAGE_SIZE, ZERO_PAGE
+
+MAGIC = b'NEO86CKP'
+VERSION = 1
+
+HEADER = struct.Struct('<8sH')
+REGISTER_ORDER = ('ax', 'bx', 'cx', 'dx', 'si', 'di', 'bp', 'sp', 'cs', 'ds', 'es', 'ss')
+# Registers, FLAGS, instruction index, instruction count, cycles, halted,
+# waiting for input, BIOS ticks
+CPU = struct.Struct('<24sHIQQ??I')
+REGISTERS = struct.Struct('<12H')
+# Timer divisor and next tick, pending IRQ mask, cursor row, column and
+# shape, option bits
+DEVICES = struct.Struct('<IQHBBHB')
+LENGTH = struct.Struct('<I')
+KEYSTROKE = struct.Struct('<QI')  # Cycle and character code of a scheduled key
+PAGE_TABLE = struct.Struct('<IH')  # Memory size and page count
+
+# Option bits
+FAST_FORWARD = 1
+SUPERINSTRUCTIONS = 2
+COVERAGE = 4
+
+def _memories(emu):
+    return (emu.data_segment.memory, emu.screen.memory, emu.vector_table)
+
+def _pack_blob(data):
+    return LENGTH.pack(len(data)) + data
+
+def _pack_memory(memory):
+    numbers = sorted(number for number, page in memory.pages.items() if page != ZERO_PAGE)
+    return b''.join([PAGE_TABLE.pack(memory.size, len(numbers)),
+                     struct.pack(f'<{len(numbers)}H', *numbers)]
+                    + [bytes(memory.pages[number]) for number in numbers])
+
+def save_state(emu, path):
+    """Write a checkpoint of emu to path"""
+    registers = REGISTERS.pack(*(emu.registers[name].value for name in REGISTER_ORDER))
+    options = ((FAST_FORWARD if emu.loop_fast_forward else 0)
+               | (SUPERINSTRUCTIONS if emu.superinstructions else 0)
+               | (COVERAGE if emu.coverage is not None else 0))
+    screen = emu.screen
+    keyboard = emu.keyboard
+    parts = [
+        HEADER.pack(MAGIC, VERSION),
+        CPU.pack(registers, emu.flags.to_word(), emu.current_instruction_index,
+                 emu.instruction_count, emu.cycles, emu.halted, emu.waiting_for_input,
+                 emu.bios_ticks),
+        DEVICES.pack(emu.timer.divisor, emu.timer.next_tick,
+                     sum(1 << line for line in emu.pending_irqs),
+                     screen.cursor_row, screen.cursor_column, screen.cursor_shape, options),
+        _pack_blob(emu.source.encode('utf-8')),
+        _pack_blob(''.join(emu.input_buffer).encode('utf-8')),
+        _pack_blob(''.join(emu.output_buffer).encode('utf-8')),
+        _pack_blob(''.join(keyboard.latched).encode('utf-8')),
+        _pack_blob(b''.join(KEYSTROKE.pack(deadline, ord(char))
+                            for deadline, char in keyboard.scheduled)),
+        _pack_blob(struct.pack(f'<{len(emu.breakpoints)}I', *sorted(emu.breakpoints))),
+        _pack_blob(bytes(emu.coverage) if emu.coverage is not None else b''),
+    ]
+    parts.extend(_pack_memory(memory) for memory in _memories(emu))
+    with open(path, 'wb') as f:
+        f.write(b''.join(parts))
+
+class _Reader:
+    """Sequential struct reads from a buffer"""
+
+    def __init__(self, data):
+        self.data = data
+        self.offset = 0
+
+    def unpack(self, layout):
+        values = layout.unpack_from(self.data, self.offset)
+        self.offset += layout.size
+        return values
+
+    def take(self, length):
+        if self.offset + length > len(self.data):
+            raise ValueError("Checkpoint file is truncated")
+        data = self.data[self.offset:self.offset + length]
+        self.offset += length
+        return data
+
+    def blob(self):
+        length, = self.unpack(LENGTH)
+        return self.take(length)
+
+    def memory(self, memory):
+        size, count = self.unpack(PAGE_TABLE)
+        if size != memory.size:
+            raise ValueError("Checkpoint memory size does not match")
+        numbers = struct.unpack_from(f'<{count}H', self.data, self.offset)
+        self.offset += 2 * count
+        memory.pages = {number: self.take(PAGE_SIZE) for number in numbers}
+
+def load_state(emu, path, cache=None):
+    """Restore emu from a checkpoint written by save_state()"""
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        reader = _Reader(data)
+        try:
+            magic, version = reader.unpack(HEADER)
+        except struct.error:
+            raise ValueError("Not a checkpoint file")
+        if magic != MAGIC:
+            raise ValueError("Not a checkpoint file")
+        if version != VERSION:
+            raise ValueError(f"Unsupported checkpoint version: {version}")
+        try:
+            registers, flags, index, count, cycles, halted, waiting, ticks = reader.unpack(CPU)
+            divisor, next_tick, irqs, row, column, shape, options = reader.unpack(DEVICES)
+            source = reader.blob().decode('utf-8')
+            input_text = reader.blob().decode('utf-8')
+            output = reader.blob().decode('utf-8')
+            latched = reader.blob().decode('utf-8')
+            scheduled = [(deadline, chr(code)) for deadline, code
+                         in KEYSTROKE.iter_unpack(reader.blob())]
+            breakpoints = reader.blob()
+            coverage = reader.blob()
+
+            emu.reset()
+            emu.load_program(source, cache)
+            for memory in _memories(emu):
+                reader.memory(memory)
+        except struct.error:
+            raise ValueError("Checkpoint file is truncated")
+
+    for name, value in zip(REGISTER_ORDER, REGISTERS.unpack(registers)):
+        emu.set_register_value(name, value)  # Also sets the 8-bit halves
+    emu.flags.from_word(flags)
+    emu.current_instruction_index = index
+    emu.instruction_count = count
+    emu.cycles = cycles
+    emu.halted = halted
+    emu.waiting_for_input = waiting
+    emu.bios_ticks = ticks
+    emu.input_buffer.extend(input_text)
+    emu.output_buffer = [output] if output else []
+    emu.pending_irqs = [line for line in range(16) if irqs >> line & 1]
+    emu.screen.cursor_row, emu.screen.cursor_column = row, column
+    emu.screen.cursor_shape = shape
+    emu.screen.memory.mark_all()
+    emu.loop_fast_forward = bool(options & FAST_FORWARD)
+    emu.superinstructions = bool(options & SUPERINSTRUCTIONS)
+    emu.breakpoints = set(struct.unpack(f'<{len(breakpoints) // 4}I', breakpoints))
+    emu.coverage = bytearray(coverage) if options & COVERAGE else None
+
+    emu.scheduler.clear()
+    emu.timer.divisor = divisor
+    emu.timer.start_at(next_tick)
+    emu.keyboard.clear()
+    emu.keyboard.latched.extend(latched)
+    for deadline, char in scheduled:
+        emu.keyboard._schedule(deadline, char)
@@ -0,0 +1,138 @@
+"""8086 instruction timing.
+
+Costs are the clock counts from the 8086 instruction set tables. A memory
+operand adds the effective-address calculation time, which depends on the
+addressing mode, plus two clocks for a segment override. Where the manual
+gives a range (multiply and divide) the middle of the range is used.
+
+Conditional jumps, LOOP and JCXZ are cheaper when they fall through. The
+decoded cost is the fall-through cost and the extra for a taken branch is
+kept separately as taken_cycles, charged by the emulator only when the
+branch jumps. Shifts and rotates by CL are charged four clocks per bit at
+run time on top of their decoded cost.
+"""
+
+# The original IBM PC clock
+CLOCK_RATE = 4772727
+
+# Two-operand instructions by form: r = register, m = memory, i = immediate.
+# Memory forms also pay the effective-address time.
+_ALU_COSTS = {'rr': 3, 'rm': 9, 'mr': 16, 'ri': 4, 'mi': 17}
+TWO_OPERAND_COSTS = {
+    'mov': {'rr': 2, 'rm': 8, 'mr': 9, 'ri': 4, 'mi': 10},
+    'cmp': {'rr': 3, 'rm': 9, 'mr': 9, 'ri': 4, 'mi': 10},
+    'test': {'rr': 3, 'rm': 9, 'mr': 9, 'ri': 5, 'mi': 11},
+    'xchg': {'rr': 4, 'rm': 17, 'mr': 17},
+}
+for _opcode in ('add', 'adc', 'sub', 'sbb', 'and', 'or', 'xor'):
+    TWO_OPERAND_COSTS[_opcode] = _ALU_COSTS
+
+# One-operand instructions: (register, memory)
+UNARY_COSTS = {'inc': (2, 15), 'dec': (2, 15), 'neg': (3, 16), 'not': (3, 16)}
+
+# Multiply and divide by operand size: (register, memory)
+MULDIV_COSTS = {
+    'mul': {8: (74, 80), 16: (128, 134)},
+    'imul': {8: (89, 95), 16: (141, 147)},
+    'div': {8: (85, 91), 16: (153, 159)},
+    'idiv': {8: (107, 113), 16: (175, 181)},
+}
+
+# Branches: (fall-through cost, extra when taken)
+BRANCH_COSTS = {
+    'jcxz': (6, 12),
+    'loop': (5, 12),
+    'loope': (6, 12), 'loopz': (6, 12),
+    'loopne': (5, 14), 'loopnz': (5, 14),
+}
+CONDITIONAL_JUMP_COST = (4, 12)
+
+FIXED_COSTS = {
+    'nop': 3, 'hlt': 2,
+    'clc': 2, 'stc': 2, 'cmc': 2, 'cli': 2, 'sti': 2,
+    'cbw': 2, 'cwd': 5,
+    'daa': 4, 'das': 4, 'aaa': 8, 'aas': 8, 'aam': 83, 'aad': 60,
+    'pushf': 10, 'popf': 8,
+    'jmp': 15, 'call': 19,
+    'int': 51, 'iret': 24,
+}
+
+SHIFT_OPCODES = ('shl', 'sal', 'shr', 'sar', 'rol', 'ror', 'rcl', 'rcr')
+
+def ea_cycles(operand):
+    """Effective-address calculation time of a memory operand"""
+    registers = operand.registers
+    if not registers:
+        cycles = 6
+    elif len(registers) == 1:
+        cycles = 9 if operand.displacement else 5
+    else:
+        cycles = 7 if set(registers) in ({'bp', 'di'}, {'bx', 'si'}) else 8
+        if operand.displacement:
+            cycles += 4
+    if operand.segment:
+        cycles += 2
+    return cycles
+
+def _form(operand):
+    return {'reg': 'r', 'mem': 'm'}.get(operand.kind, 'i')
+
+def _memory_cycles(args):
+    return sum(ea_cycles(arg) for arg in args if arg.kind == 'mem')
+
+def instruction_cycles(opcode, args, conditional_jumps=()):
+    """Return (cycles, taken_cycles) for a decoded instruction"""
+    if opcode in TWO_OPERAND_COSTS and len(args) == 2:
+        costs = TWO_OPERAND_COSTS[opcode]
+        form = _form(args[0]) + _form(args[1])
+        return costs.get(form, costs.get('rm', 0)) + _memory_cycles(args), 0
+
+    if opcode in UNARY_COSTS and len(args) == 1:
+        register, memory = UNARY_COSTS[opcode]
+        if args[0].kind == 'mem':
+            return memory + ea_cycles(args[0]), 0
+        # 8-bit INC and DEC use the longer ModR/M encoding
+        return register + (1 if args[0].size == 8 and opcode in ('inc', 'dec') else 0), 0
+
+    if opcode in MULDIV_COSTS and len(args) == 1:
+        register, memory = MULDIV_COSTS[opcode][args[0].size or 8]
+        return (memory + ea_cycles(args[0]), 0) if args[0].kind == 'mem' else (register, 0)
+
+    if opcode in SHIFT_OPCODES and args:
+        memory = args[0].kind == 'mem'
+        if len(args) == 1 or (args[1].kind == 'imm' and args[1].value == 1):
+            cycles = 15 if memory else 2
+        elif args[1].kind == 'imm':
+            cycles = (20 if memory else 8) + 4 * (args[1].value & 0xFF)
+        else:
+            cycles = 20 if memory else 8  # Plus 4 per bit, charged when executed
+        return cycles + _memory_cycles(args[:1]), 0
+
+    if opcode in conditional_jumps:
+        return CONDITIONAL_JUMP_COST
+    if opcode in BRANCH_COSTS:
+        return BRANCH_COSTS[opcode]
+
+    if opcode == 'lea' and len(args) == 2 and args[1].kind == 'mem':
+        return 2 + ea_cycles(args[1]), 0
+    if opcode == 'push' and len(args) == 1:
+        if args[0].kind == 'mem':
+            return 16 + ea_cycles(args[0]), 0
+        return (10 if args[0].text in ('cs', 'ds', 'es', 'ss') else 11), 0
+    if opcode == 'pop' and len(args) == 1:
+        return (17 + ea_cycles(args[0]) if args[0].kind == 'mem' else 8), 0
+    if opcode in ('in', 'out') and len(args) == 2:
+        port, data = args if opcode == 'out' else args[::-1]
+        return (8 if port.kind == 'reg' else 10) + (4 if data.size == 16 else 0), 0
+    if opcode == 'ret':
+        return (12 if args else 8), 0
+    return FIXED_COSTS.get(opcode, 0), 0
+
+def estimated_seconds(cycles, clock_rate=CLOCK_RATE):
+    """Time the given number of cycles takes on a real machine"""
+    return cycles / clock_rate
+
+def format_timing(cycles, clock_rate=CLOCK_RATE):
+    """One-line summary such as '1234 cycles (0.259 ms at 4.77 MHz)'"""
+    return (f"{cycles} cycles ({estimated_seconds(cycles, clock_rate) * 1000:.3f} ms "
+            f"at {clock_rate / 1e6:.2f} MHz)")
@@ -0,0 +1,155 @@
+"""Text-mode video: the 80x25 colour screen at segment B800h.
+
+Each character cell is two bytes in video memory, the character and its
+attribute (foreground colour in the low nibble, background in bits 4-6).
+Programs write cells directly through a segment register holding B800h
+(for example 'mov es:[di], ax' with ES = B800h) or through the INT 10h
+services. Video memory is a DirtyMemory with one dirty mark per cell, so
+a display only redraws the cells written since its last frame.
+
+A blank screen in the default colours is a set of pages shared by every
+screen copy-on-write, so an emulator that never writes to the screen
+allocates no video pages.
+"""
+
+from emu8086_memory import PAGE_SIZE, DirtyMemory
+
+VIDEO_SEGMENT = 0xB800
+VIDEO_MEMORY_SIZE = 0x8000  # The 32KB window of the colour adapter
+
+COLUMNS = 80
+ROWS = 25
+CELLS = COLUMNS * ROWS
+ROW_BYTES = COLUMNS * 2
+
+DEFAULT_ATTRIBUTE = 0x07  # Light grey on black
+DEFAULT_CURSOR_SHAPE = 0x0607  # Start and end scan lines of the underline cursor
+TAB_WIDTH = 8
+
+# Video mode reported by INT 10h AH=0Fh: 80x25 colour text
+TEXT_MODE = 0x03
+
+# Pages of a blank screen in the default colours, shared by every screen
+_BLANK = bytes((0x20, DEFAULT_ATTRIBUTE)) * CELLS
+BLANK_PAGES = {number: _BLANK[number * PAGE_SIZE:(number + 1) * PAGE_SIZE].ljust(PAGE_SIZE, b'\0')
+               for number in range(-(-len(_BLANK) // PAGE_SIZE))}
+
+class TextScreen:
+    """Video memory and cursor of the text screen"""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        """Fresh video memory holding a blank screen"""
+        self.memory = DirtyMemory(VIDEO_MEMORY_SIZE, unit_bits=1, tracked=CELLS * 2)
+        self.cursor_shape = DEFAULT_CURSOR_SHAPE
+        self.clear()
+
+    def clear(self, attribute=DEFAULT_ATTRIBUTE):
+        """Blank the screen and home the cursor"""
+        if attribute == DEFAULT_ATTRIBUTE:
+            memory = self.memory
+            for number in BLANK_PAGES:
+                memory.pages.pop(number, None)
+            memory.pages.update(BLANK_PAGES)
+            memory.mark_all()
+        else:
+            self.memory.write(0, bytes((0x20, attribute)) * CELLS)
+        self.cursor_row = self.cursor_column = 0
+
+    def cell(self, row, column):
+        """(character, attribute) at a position"""
+        address = (row * COLUMNS + column) * 2
+        return self.memory.get_byte(address), self.memory.get_byte(address + 1)
+
+    def put(self, row, column, char, attribute=None):
+        """Store a character, and its attribute when one is given"""
+        address = (row * COLUMNS + column) * 2
+        if attribute is None:
+            self.memory.set_byte(address, char)
+        else:
+            self.memory.set_word(address, char | (attribute << 8))
+
+    def set_cursor(self, row, column):
+        self.cursor_row = min(row, ROWS - 1)
+        self.cursor_column = min(column, COLUMNS - 1)
+
+    def scroll_up(self, lines, attribute=DEFAULT_ATTRIBUTE, top=0, left=0,
+                  bottom=ROWS - 1, right=COLUMNS - 1):
+        """Scroll a window up by lines, blanking the rows uncovered; 0 blanks it all"""
+        self._scroll(lines, attribute, top, left, bottom, right, 1)
+
+    def scroll_down(self, lines, attribute=DEFAULT_ATTRIBUTE, top=0, left=0,
+                    bottom=ROWS - 1, right=COLUMNS - 1):
+        self._scroll(lines, attribute, top, left, bottom, right, -1)
+
+    def _scroll(self, lines, attribute, top, left, bottom, right, direction):
+        bottom, right = min(bottom, ROWS - 1), min(right, COLUMNS - 1)
+        if top > bottom or left > right:
+            return
+        height = bottom - top + 1
+        if lines == 0 or lines > height:
+            lines = height
+        memory = self.memory
+        width = (right - left + 1) * 2
+        rows = range(top, bottom + 1 - lines)
+        # Each row of the window moves with one read and one write
+        for row in (rows if direction > 0 else reversed(rows)):
+            source, dest = (row + lines, row) if direction > 0 else (row, row + lines)
+            memory.write(dest * ROW_BYTES + left * 2,
+                         memory.read(source * ROW_BYTES + left * 2, width))
+        blank = bytes((0x20, attribute)) * (right - left + 1)
+        first = bottom + 1 - lines if direction > 0 else top
+        for row in range(first, first + lines):
+            memory.write(row * ROW_BYTES + left * 2, blank)
+
+    def teletype(self, char, attribute=None):
+        """Write a character code at the cursor and advance it, as INT 10h
+        AH=0Eh does: CR, LF, backspace, tab and bell act as controls and
+        the screen scrolls at the bottom"""
+        if char == 0x0D:
+            self.cursor_column = 0
+        elif char == 0x0A:
+            self._line_feed()
+        elif char == 0x08:
+            self.cursor_column = max(self.cursor_column - 1, 0)
+        elif char == 0x07:
+            pass
+        elif char == 0x09:
+            for _ in range(TAB_WIDTH - self.cursor_column % TAB_WIDTH):
+                self.teletype(0x20, attribute)
+        else:
+            self.put(self.cursor_row, self.cursor_column, char, attribute)
+            self.cursor_column += 1
+            if self.cursor_column == COLUMNS:
+                self.cursor_column = 0
+                self._line_feed()
+
+    def _line_feed(self):
+        if self.cursor_row == ROWS - 1:
+            self.scroll_up(1, self.cell(ROWS - 1, 0)[1])
+        else:
+            self.cursor_row += 1
+
+    def write_text(self, text, attribute=None):
+        for char in text.encode('cp437', 'replace'):
+            self.teletype(char, attribute)
+
+    def take_dirty_cells(self):
+        """Indices (row * COLUMNS + column) of the cells written since the last call"""
+        return [cell for cell in self.memory.take_dirty() if cell < CELLS]
+
+    def text(self):
+        """The screen as lines of text with trailing blanks removed"""
+        data = self.memory.read(0, CELLS * 2)[::2].decode('cp437')
+        lines = [data[row * COLUMNS:(row + 1) * COLUMNS].rstrip() for row in range(ROWS)]
+        while lines and not lines[-1]:
+            lines.pop()
+        return '\n'.join(lines)
+
+    def copy_to(self, screen):
+        """Give another screen a copy-on-write copy of this one"""
+        screen.memory = self.memory.fork()
+        screen.cursor_row, screen.cursor_column = self.cursor_row, self.cursor_column
+        screen.cursor_shape = self.cursor_shape
@@ -1,14 +1,32 @@
+import math
 import sys
+import time
 from PyQt6.QtWidgets import (QApplication, QMainWindow, QWidget, QVBoxLayout,
                            QHBoxLayout, QTextEdit, QLabel, QPushButton,
                            QTableWidget, QTableWidgetItem, QTabWidget, QMessageBox,
                            QFileDialog, QStatusBar, QSpinBox, QLineEdit, QFrame,
-                           QGridLayout, QHeaderView, QInputDialog)
+                           QGridLayout, QHeaderView, QInputDialog, QCheckBox)
 from PyQt6.QtGui import (QFont, QPalette, QColor, QSyntaxHighlighter, 
                         QTextCharFormat, QKeySequence, QShortcut, QIcon,
-                        QTextCursor)
-from PyQt6.QtCore import Qt, QTimer
+                        QTextCursor, QFontMetrics, QPainter, QPixmap)
+from PyQt6.QtCore import Qt, QTimer, QRect
 from emu8086_core import Emulator
+from emu8086_timing import format_timing
+from emu8086_video import COLUMNS, ROWS
+
+# The 16 colours of the CGA text-mode palette
+CGA_PALETTE = [QColor(color) for color in (
+    '#000000', '#0000AA', '#00AA00', '#00AAAA', '#AA0000', '#AA00AA', '#AA5500', '#AAAAAA',
+    '#555555', '#5555FF', '#55FF55', '#55FFFF', '#FF5555', '#FF55FF', '#FFFF55', '#FFFFFF')]
+
+# Screen repaints per second at most
+SCREEN_FRAME_RATE = 60
+
+# Bytes per row of the memory view, which shows 16 rows
+MEMORY_ROW_BYTES = 16
+
+# Seconds between updates of the instructions/s shown while running
+STATUS_RATE_INTERVAL = 0.5
 
 class AssemblyHighlighter(QSyntaxHighlighter):
     def __init__(self, parent=None):
@@ -22,8 +40,11 @@ class AssemblyHighlighter(QSyntaxHighlighter):
         keywords = [
             "mov", "add", "sub", "mul", "div", "inc", "dec",
             "and", "or", "xor", "not", "jmp", "je", "jne",
-            "jl", "jle", "jg", "jge", "push", "pop", "int",
-            "proc", "endp", "end"
+            "jl", "jle", "jg", "jge", "jz", "jnz", "jc", "jnc",
+            "ja", "jae", "jb", "jbe", "js", "jns", "jo", "jno",
+            "jp", "jnp", "jcxz", "loop", "loope", "loopne",
+            "push", "pop", "pushf", "popf", "call", "ret",
+            "int", "proc", "endp", "end"
         ]
         for word in keywords:
             pattern = f"\\b{word}\\b"
@@ -138,6 +159,146 @@ class ConsoleWidget(QTextEdit):
         
         return self.input_text
 
+class ScreenWidget(QWidget):
+    """The 80x25 text screen.
+
+    Cells are drawn into a backing pixmap. A frame timer collects the cells
+    written since the last frame from the video memory's dirty bitmap and
+    redraws only those, so a busy program costs at most SCREEN_FRAME_RATE
+    partial repaints a second.
+    """
+
+    def __init__(self, screen, parent=None):
+        super().__init__(parent)
+        self.screen = screen
+        self.font = QFont("Consolas", 10)
+        self.font.setStyleHint(QFont.StyleHint.Monospace)
+        metrics = QFontMetrics(self.font)
+        self.cell_width = metrics.horizontalAdvance('M')
+        self.cell_height = metrics.height()
+        self.ascent = metrics.ascent()
+        self.image = QPixmap(COLUMNS * self.cell_width, ROWS * self.cell_height)
+        self.image.fill(CGA_PALETTE[0])
+        self.setFixedSize(self.image.size())
+        self.cursor = None  # (row, column) of the cursor last drawn
+        self.screen.memory.mark_all()
+        self.timer = QTimer(self)
+        self.timer.timeout.connect(self.refresh)
+        self.timer.start(1000 // SCREEN_FRAME_RATE)
+
+    def cell_rect(self, row, column):
+        return QRect(column * self.cell_width, row * self.cell_height,
+                     self.cell_width, self.cell_height)
+
+    def refresh(self):
+        """Draw the cells written since the last frame"""
+        screen = self.screen
+        cells = screen.take_dirty_cells()
+        cursor = (screen.cursor_row, screen.cursor_column)
+        if not cells and cursor == self.cursor:
+            return
+        dirty = QRect()
+        if cells:
+            painter = QPainter(self.image)
+            painter.setFont(self.font)
+            for cell in cells:
+                row, column = divmod(cell, COLUMNS)
+                char, attribute = screen.cell(row, column)
+                rect = self.cell_rect(row, column)
+                painter.fillRect(rect, CGA_PALETTE[(attribute >> 4) & 0x07])
+                painter.setPen(CGA_PALETTE[attribute & 0x0F])
+                painter.drawText(rect.x(), rect.y() + self.ascent, bytes((char,)).decode('cp437'))
+                dirty = dirty.united(rect)
+            painter.end()
+        if cursor != self.cursor:
+            if self.cursor is not None:
+                dirty = dirty.united(self.cell_rect(*self.cursor))
+            dirty = dirty.united(self.cell_rect(*cursor))
+            self.cursor = cursor
+        self.update(dirty)
+
+    def paintEvent(self, event):
+        painter = QPainter(self)
+        painter.drawPixmap(event.rect(), self.image, event.rect())
+        if self.cursor is not None:
+            rect = self.cell_rect(*self.cursor)
+            painter.fillRect(rect.x(), rect.bottom() - 1, rect.width(), 2, CGA_PALETTE[7])
+        painter.end()
+
+class MemoryWidget(QWidget):
+    """Hex view of 256 bytes of data memory.
+
+    With the heatmap on, the emulator counts every read and write, and
+    each byte is shaded by its access count on a log scale relative to
+    the busiest byte: blue when mostly read, red when mostly written.
+    """
+
+    def __init__(self, emulator, parent=None):
+        super().__init__(parent)
+        self.emulator = emulator
+        layout = QVBoxLayout(self)
+        controls = QHBoxLayout()
+        controls.addWidget(QLabel("Address"))
+        self.address = QSpinBox()
+        self.address.setDisplayIntegerBase(16)
+        self.address.setRange(0, 0x10000 - MEMORY_ROW_BYTES * 16)
+        self.address.setSingleStep(MEMORY_ROW_BYTES * 16)
+        self.address.valueChanged.connect(self.refresh)
+        controls.addWidget(self.address)
+        self.heatmap_box = QCheckBox("Heatmap")
+        self.heatmap_box.toggled.connect(self.toggle_heatmap)
+        controls.addWidget(self.heatmap_box)
+        self.export_btn = QPushButton("Export Heatmap")
+        self.export_btn.setEnabled(False)
+        self.export_btn.clicked.connect(self.export_heatmap)
+        controls.addWidget(self.export_btn)
+        controls.addStretch()
+        layout.addLayout(controls)
+        self.table = QTableWidget(16, MEMORY_ROW_BYTES)
+        self.table.setHorizontalHeaderLabels([f"{i:X}" for i in range(MEMORY_ROW_BYTES)])
+        self.table.horizontalHeader().setSectionResizeMode(QHeaderView.ResizeMode.Stretch)
+        layout.addWidget(self.table)
+        self.refresh()
+
+    def toggle_heatmap(self, on):
+        if on:
+            self.emulator.enable_heatmap()
+        else:
+            self.emulator.disable_heatmap()
+        self.export_btn.setEnabled(on)
+        self.refresh()
+
+    def export_heatmap(self):
+        file_name, _ = QFileDialog.getSaveFileName(
+            self, "Export Heatmap", "", "CSV Files (*.csv);;JSON Files (*.json)"
+        )
+        if file_name:
+            try:
+                self.emulator.heatmap.save(file_name)
+            except Exception as e:
+                QMessageBox.critical(self, "Error", f"Error exporting heatmap: {str(e)}")
+
+    def heat_color(self, reads, writes, scale):
+        heat = math.log1p(reads + writes) / scale
+        hue = (1 - writes / (reads + writes)) * 2 / 3  # Red (0) to blue (2/3)
+        return QColor.fromHsvF(hue, 0.9, 0.15 + 0.6 * heat)
+
+    def refresh(self):
+        base = self.address.value()
+        data = self.emulator.peek_memory(base, MEMORY_ROW_BYTES * 16)
+        heatmap = self.emulator.heatmap
+        scale = math.log1p(heatmap.peak()) if heatmap is not None else 0
+        self.table.setVerticalHeaderLabels(
+            [f"{base + row * MEMORY_ROW_BYTES:04X}" for row in range(16)])
+        for i, value in enumerate(data):
+            item = QTableWidgetItem(f"{value:02X}")
+            if scale:
+                reads, writes = heatmap.reads_at(base + i), heatmap.writes_at(base + i)
+                if reads or writes:
+                    item.setBackground(self.heat_color(reads, writes, scale))
+                    item.setToolTip(f"{reads} reads, {writes} writes")
+            self.table.setItem(*divmod(i, MEMORY_ROW_BYTES), item)
+
 class ModernEmu8086(QMainWindow):
     def __init__(self):
         super().__init__()
@@ -216,6 +377,8 @@ class ModernEmu8086(QMainWindow):
         self.microstep_btn = QPushButton("Microstep")
         self.pause_btn = QPushButton("Pause")
         self.stop_btn = QPushButton("Stop")
+        self.save_state_btn = QPushButton("Save State")
+        self.load_state_btn = QPushButton("Load State")
 
         toolbar_layout.addWidget(self.load_btn)
         toolbar_layout.addWidget(self.run_btn)
@@ -223,6 +386,8 @@ class ModernEmu8086(QMainWindow):
         toolbar_layout.addWidget(self.microstep_btn)
         toolbar_layout.addWidget(self.pause_btn)
         toolbar_layout.addWidget(self.stop_btn)
+        toolbar_layout.addWidget(self.save_state_btn)
+        toolbar_layout.addWidget(self.load_state_btn)
         toolbar_layout.addStretch()
 
         left_layout.addWidget(toolbar)
@@ -315,13 +480,11 @@ class ModernEmu8086(QMainWindow):
         middle_debug_layout.addWidget(code_segment)
         middle_debug_layout.addWidget(stack)
 
-        # Bottom section: Console output
-        console = QFrame()
-        console_layout = QVBoxLayout(console)
-        console_layout.addWidget(QLabel("Console"))
+        # Bottom section: Console output and the text screen
+        console = QTabWidget()
         self.console = QTextEdit()
         self.console.setReadOnly(True)
-        console_layout.addWidget(self.console)
+        console.addTab(self.console, "Console")
 
         # Add all sections to right panel
         right_layout.addWidget(top_debug)
@@ -342,24 +505,44 @@ class ModernEmu8086(QMainWindow):
         self.run_btn.clicked.connect(self.run_program)
         self.step_btn.clicked.connect(self.step_program)
         self.stop_btn.clicked.connect(self.reset_emulator)
+        self.save_state_btn.clicked.connect(self.save_state)
+        self.load_state_btn.clicked.connect(self.load_state)
         
         # Initialize emulator
         self.emulator = Emulator()
         self.emulator.set_io_handler(self)
+        self.emulator.enable_coverage()
+        self.screen_widget = ScreenWidget(self.emulator.screen)
+        console.addTab(self.screen_widget, "Screen")
+        self.memory_widget = MemoryWidget(self.emulator)
+        console.addTab(self.memory_widget, "Memory")
         self.current_line = 0
         self.program_lines = []
+        self.coverage = None  # CoverageMap of the last run, shown in the gutter
 
         # Update line numbers when text changes
-        self.code_editor.textChanged.connect(self.update_line_numbers)
+        self.code_editor.textChanged.connect(self.code_changed)
+        self.update_line_numbers()
+
+    def code_changed(self):
+        """Coverage marks no longer match edited code"""
+        self.coverage = None
+        self.update_line_numbers()
+
+    def update_coverage(self):
+        self.coverage = self.emulator.get_coverage()
         self.update_line_numbers()
 
     def update_line_numbers(self):
-        """Update line numbers and addresses"""
+        """Update line numbers and addresses, marking executed (●) and
+        never executed (○) code lines after a run"""
         text = self.code_editor.toPlainText()
         lines = text.count('\n') + 1
         
         # Update line numbers
-        line_numbers = '\n'.join(str(i) for i in range(1, lines + 1))
+        counts = self.coverage.counts if self.coverage is not None else {}
+        markers = {line: '●' if count else '○' for line, count in counts.items()}
+        line_numbers = '\n'.join(f"{markers.get(i, ' ')}{i}" for i in range(1, lines + 1))
         self.line_numbers.setText(line_numbers)
         
         # Update addresses (assuming each instruction is 3 bytes)
@@ -416,8 +599,10 @@ class ModernEmu8086(QMainWindow):
 
     def run_program(self):
         try:
-            # Reset the emulator
+            # Reset the emulator, restarting the heatmap counts if it is on
             self.emulator.reset()
+            if self.emulator.heatmap is not None:
+                self.emulator.enable_heatmap()
             self.console.clear()
             
             # Get code from editor
@@ -428,14 +613,24 @@ class ModernEmu8086(QMainWindow):
             
             # Get the instructions from the emulator
             self.program_lines = self.emulator.instructions
+            self.emulator.loop_fast_forward = True
             
-            # Execute all instructions
+            # Execute all instructions, showing the live instruction rate
             self.current_line = 0
+            rate_time, rate_count = time.perf_counter(), 0
             while self.current_line < len(self.program_lines):
                 self.execute_current_instruction()
                 QApplication.processEvents()  # Allow GUI updates
+                elapsed = time.perf_counter() - rate_time
+                if elapsed >= STATUS_RATE_INTERVAL:
+                    count = self.emulator.instruction_count
+                    self.status_bar.showMessage(
+                        f"Running - {(count - rate_count) / elapsed:,.0f} instructions/s")
+                    rate_time, rate_count = time.perf_counter(), count
             
-            self.status_bar.showMessage("Program executed successfully")
+            self.update_coverage()
+            self.status_bar.showMessage("Program executed successfully - "
+                                        + format_timing(self.emulator.cycles))
             
         except Exception as e:
             QMessageBox.critical(self, "Error", f"Error executing program: {str(e)}")
@@ -445,12 +640,13 @@ class ModernEmu8086(QMainWindow):
         if self.current_line < len(self.program_lines):
             instruction = self.program_lines[self.current_line]
             try:
-                result = self.emulator.execute_instruction(instruction)
-                if result == "jump":
-                    # Update current_line based on emulator's instruction index
-                    self.current_line = self.emulator.current_instruction_index
+                self.emulator.current_instruction_index = self.current_line
+                self.emulator.step()
+                self.emulator.sync_devices()
+                if self.emulator.halted:
+                    self.current_line = len(self.program_lines)
                 else:
-                    self.current_line += 1
+                    self.current_line = self.emulator.current_instruction_index
                 self.update_display()
                 
                 # Handle input/output
@@ -477,22 +673,59 @@ class ModernEmu8086(QMainWindow):
                 # Get the instructions from the emulator
                 self.program_lines = self.emulator.instructions
             
+            # Show every loop iteration when stepping
+            self.emulator.loop_fast_forward = False
+
             # Execute the next instruction
             self.execute_current_instruction()
+            self.update_coverage()
             
             # Check if program is complete
             if self.current_line >= len(self.program_lines):
                 QMessageBox.information(self, "End of Program", "Program execution completed!")
                 self.current_line = 0
-                self.status_bar.showMessage("Program execution completed")
+                self.status_bar.showMessage("Program execution completed - "
+                                            + format_timing(self.emulator.cycles))
             else:
-                self.status_bar.showMessage(f"Executed instruction {self.current_line + 1} of {len(self.program_lines)}")
+                self.status_bar.showMessage(f"Executed instruction {self.current_line + 1} of {len(self.program_lines)}"
+                                            f" - {format_timing(self.emulator.cycles)}")
                 
         except Exception as e:
             QMessageBox.critical(self, "Error", f"Error executing instruction: {str(e)}")
             self.current_line = 0
             self.status_bar.showMessage("Error in program execution")
 
+    def save_state(self):
+        """Checkpoint the debugging session"""
+        file_name, _ = QFileDialog.getSaveFileName(
+            self, "Save State", "", "Emulator State (*.n86);;All Files (*.*)"
+        )
+        if file_name:
+            try:
+                self.emulator.save_state(file_name)
+                self.status_bar.showMessage(f"Saved state to {file_name}")
+            except Exception as e:
+                QMessageBox.critical(self, "Error", f"Error saving state: {str(e)}")
+
+    def load_state(self):
+        """Reopen a checkpointed debugging session where it stopped"""
+        file_name, _ = QFileDialog.getOpenFileName(
+            self, "Load State", "", "Emulator State (*.n86);;All Files (*.*)"
+        )
+        if file_name:
+            try:
+                self.emulator.load_state(file_name)
+                self.code_editor.setText(self.emulator.source)
+                self.program_lines = self.emulator.instructions
+                self.current_line = self.emulator.current_instruction_index
+                self.console.clear()
+                self.update_display()
+                self.update_coverage()
+                self.status_bar.showMessage(f"Loaded state from {file_name} - "
+                                            + format_timing(self.emulator.cycles))
+            except Exception as e:
+                QMessageBox.critical(self, "Error", f"Error loading state: {str(e)}")
+
     def reset_emulator(self):
         self.emulator.reset()
         self.current_line = 0
@@ -510,13 +743,15 @@ class ModernEmu8086(QMainWindow):
         # Update code segment
         self.update_code_segment()
 
-        # Update stack
+        # Update stack, showing the words from SP upwards
+        sp = self.emulator.get_register_value('sp')
         for i in range(16):
-            self.stack_table.setItem(i, 0, QTableWidgetItem(f"{i*16:04X}"))
-            for j in range(16):
-                addr = i * 16 + j
-                value = self.emulator.get_memory_byte(addr)
-                self.stack_table.setItem(i, j+1, QTableWidgetItem(f"{value:02X}"))
+            addr = (sp + i * 2) & 0xFFFF
+            value = int.from_bytes(self.emulator.peek_memory(addr, 2), 'little')
+            self.stack_table.setItem(i, 0, QTableWidgetItem(f"{addr:04X}"))
+            self.stack_table.setItem(i, 1, QTableWidgetItem(f"{value:04X}"))
+
+        self.memory_widget.refresh()
 
     def load_file(self):
         """Load an assembly file"""
@@ -1,59 +1,323 @@
-from emu8086_core import Emulator
+from emu8086_core import Emulator, ProgramCache
+from emu8086_coverage import CoverageMap, write_coverage
+from emu8086_heatmap import MemoryHeatmap
+from emu8086_metrics import format_json, format_prometheus
+from emu8086_replay import Recording, replay
+from emu8086_timing import CLOCK_RATE, format_timing
+import argparse
+import json
 import sys
 
+# Formats of --stats
+STATS_FORMATS = {'json': format_json, 'prometheus': format_prometheus}
+
+# Limits applied to a job that does not set its own
+DEFAULT_JOB_INSTRUCTIONS = 1_000_000
+DEFAULT_JOB_OUTPUT = 64 * 1024
+
+class ConsoleIO:
+    """I/O handler that connects the emulator to stdin/stdout"""
+
+    def handle_input(self):
+        return sys.stdin.read(1) or None
+
+    def handle_output(self, text):
+        sys.stdout.write(text)
+        sys.stdout.flush()
+
+class JobOutput:
+    """I/O handler of a job that keeps at most max_output characters of
+    output and halts the program once it writes more"""
+
+    def __init__(self, emu, max_output):
+        self.emu = emu
+        self.max_output = max_output
+        self.output = []
+        self.size = 0
+        self.truncated = False
+
+    def handle_input(self):
+        return None  # Jobs only read their input tape
+
+    def handle_output(self, text):
+        room = self.max_output - self.size
+        if len(text) > room:
+            text = text[:max(room, 0)]
+            self.truncated = True
+            self.emu.halted = True
+        self.size += len(text)
+        self.output.append(text)
+
+    def text(self):
+        return ''.join(self.output)
+
+class JobError(Exception):
+    """A job that cannot be run, reported in its result object"""
+
+def _job_limit(job, name, default):
+    value = job.get(name, default)
+    if not isinstance(value, int) or isinstance(value, bool) or value <= 0:
+        raise JobError(f"'{name}' must be a positive integer")
+    return value
+
+def run_job(emu, job, cache, coverage=None):
+    """Run one job object and return its result object.
+
+    A job has "source" (program text) or "path" (an assembly file), and
+    optionally "id", "input" (the input tape), "max_instructions",
+    "max_output", "analyze" (include the static analysis in the result) and
+    "reject_infinite" (do not run a program the analysis proves never
+    terminates). The program runs until it terminates, hits the
+    instruction limit or needs more input than the tape holds; it is
+    halted as soon as its output exceeds max_output.
+
+    When coverage is a dict, the lines the job executed are merged into
+    the CoverageMap it holds for the job's source text.
+    """
+    result = {'id': job.get('id') if isinstance(job, dict) else None}
+    output = JobOutput(emu, DEFAULT_JOB_OUTPUT)
+    try:
+        if not isinstance(job, dict):
+            raise JobError("Job must be a JSON object")
+        source = job.get('source')
+        if source is None:
+            if not isinstance(job.get('path'), str):
+                raise JobError("Job needs 'source' or 'path'")
+            try:
+                with open(job['path'], 'r') as f:
+                    source = f.read()
+            except OSError as e:
+                raise JobError(f"Cannot read {job['path']}: {e.strerror}")
+        if not isinstance(source, str):
+            raise JobError("'source' must be a string")
+        tape = job.get('input', '')
+        if not isinstance(tape, str):
+            raise JobError("'input' must be a string")
+        max_instructions = _job_limit(job, 'max_instructions', DEFAULT_JOB_INSTRUCTIONS)
+        output.max_output = _job_limit(job, 'max_output', DEFAULT_JOB_OUTPUT)
+
+        emu.reset()
+        emu.set_io_handler(output)
+        result['cached'] = emu.load_program(source, cache)
+        if job.get('analyze') or job.get('reject_infinite'):
+            analysis = emu.analyze()
+            result['analysis'] = analysis.as_dict()
+            if analysis.has_infinite_loop and job.get('reject_infinite'):
+                result['status'] = 'rejected'
+                return result
+        emu.add_input(tape)
+        emu.run(max_instructions, blocking_input=False)
+    except Exception as e:
+        result.update(status='error', error=str(e), output=output.text())
+        return result
+    finally:
+        emu.set_io_handler(None)
+
+    if coverage is not None:
+        name = job.get('path') or f"job-{result['id']}.asm"
+        if source not in coverage:
+            coverage[source] = CoverageMap(emu.program, name)
+        coverage[source].add_run(emu.coverage)
+
+    result.update(
+        status='ok',
+        finished=emu.is_finished(),
+        halted=emu.halted,
+        waiting_for_input=emu.waiting_for_input,
+        limit_reached=not emu.is_finished() and not emu.waiting_for_input,
+        instruction_count=emu.instruction_count,
+        cycles=emu.cycles,
+        registers=emu.get_registers_state(),
+        flags=emu.get_flags_state(),
+        output=output.text(),
+        output_truncated=output.truncated,
+    )
+    return result
+
+def run_jobs(stream, out, cache=None, coverage=None, sandbox=None, heatmap=None):
+    """Read JSON job lines from stream and write one result line per job.
+
+    With coverage a dict, line coverage is merged per distinct program.
+    With sandbox a directory, the DOS file services of every job use it.
+    With heatmap a MemoryHeatmap, the memory accesses of all jobs are
+    counted in it. Returns the emulator statistics of the whole batch.
+    """
+    emu = Emulator()
+    if sandbox:
+        emu.set_sandbox(sandbox)
+    if heatmap is not None:
+        emu.enable_heatmap(heatmap)
+    if coverage is not None:
+        emu.enable_coverage()
+    cache = cache if cache is not None else ProgramCache()
+    for line in stream:
+        if not line.strip():
+            continue
+        try:
+            job = json.loads(line)
+        except ValueError as e:
+            result = {'id': None, 'status': 'error', 'error': f"Invalid job: {e}"}
+        else:
+            result = run_job(emu, job, cache, coverage)
+        out.write(json.dumps(result) + '\n')
+        out.flush()
+    return emu.get_stats()
+
+def print_analysis(analysis):
+    """Report static analysis findings on stderr"""
+    if analysis.unreachable:
+        lines = ', '.join(map(str, analysis.unreachable))
+        print(f"Unreachable code at lines {lines}", file=sys.stderr)
+    for loop in analysis.infinite_loops:
+        print(f"Infinite loop at lines {loop[0]}-{loop[-1]}", file=sys.stderr)
+    print(f"Maximum loop nesting: {analysis.max_loop_depth}", file=sys.stderr)
+
+def replay_file(path, sandbox=None):
+    """Replay a recording with no UI and compare its output; returns the exit code"""
+    recording = Recording.load(path)
+    emu = Emulator()
+    if sandbox:
+        emu.set_sandbox(sandbox)
+    result = replay(recording, emu)
+    print(f"{result.instruction_count} instructions, {format_timing(result.cycles)}, "
+          f"{result.seconds:.3f} s ({result.instructions_per_second:,.0f} instructions/s)",
+          file=sys.stderr)
+    if result.matches:
+        print("Replay matches the recording", file=sys.stderr)
+        return 0
+    offset = result.first_difference()
+    if offset is None:
+        print(f"Replay ran {result.instruction_count} instructions, recording "
+              f"{result.recorded_instructions}", file=sys.stderr)
+    else:
+        print(f"Replay output differs at character {offset}: "
+              f"expected {result.expected[offset:offset + 20]!r}, "
+              f"got {result.output[offset:offset + 20]!r}", file=sys.stderr)
+    return 1
+
 def main():
-    if len(sys.argv) != 2:
-        print("Usage: python run_emu8086.py <assembly_file>")
-        sys.exit(1)
+    parser = argparse.ArgumentParser(description="Run an 8086 assembly program")
+    parser.add_argument('assembly_file', nargs='?')
+    parser.add_argument('--jobs', metavar='FILE',
+                        help="run JSON-lines jobs from FILE ('-' for stdin), "
+                        "writing one JSON result line per job")
+    parser.add_argument('--profile', action='store_true',
+                        help="print a per-procedure call profile to stderr")
+    parser.add_argument('--collapsed', metavar='FILE',
+                        help="write the call profile in collapsed-stack format")
+    parser.add_argument('--coverage', metavar='FILE',
+                        help="write line coverage as lcov, or JSON for a .json FILE; "
+                        "with --jobs, coverage is merged over all jobs")
+    parser.add_argument('--no-fast-forward', action='store_true',
+                        help="execute every iteration of counted loops")
+    parser.add_argument('--no-fuse', action='store_true',
+                        help="dispatch common instruction pairs separately")
+    parser.add_argument('--cycles', action='store_true',
+                        help="print the cycle count and estimated 8086 run time to stderr")
+    parser.add_argument('--paced', nargs='?', type=float, const=CLOCK_RATE / 1e6,
+                        metavar='MHZ', help="run no faster than a real 8086 "
+                        "(default 4.77 MHz)")
+    parser.add_argument('--analyze', action='store_true',
+                        help="print unreachable code, infinite loops and loop nesting "
+                        "to stderr before running")
+    parser.add_argument('--screen', action='store_true',
+                        help="print the final contents of the text screen (B800h)")
+    parser.add_argument('--record', metavar='FILE',
+                        help="record input events and output to FILE for --replay")
+    parser.add_argument('--replay', metavar='FILE',
+                        help="rerun a recording without a console and check that "
+                        "the output matches byte for byte (exit status 1 if not)")
+    parser.add_argument('--heatmap', metavar='FILE',
+                        help="count reads and writes of every memory byte and write "
+                        "them as CSV, or JSON for a .json FILE; with --jobs, counts "
+                        "cover all jobs")
+    parser.add_argument('--stats', choices=sorted(STATS_FORMATS),
+                        help="print emulator statistics (instructions/s, parse time, "
+                        "interrupts, I/O bytes) to stderr after the run or all jobs")
+    parser.add_argument('--sandbox', metavar='DIR',
+                        help="serve the DOS file services (INT 21h AH=3Ch-42h) "
+                        "from files inside DIR")
+    args = parser.parse_args()
+
+    if args.jobs:
+        coverage = {} if args.coverage else None
+        heatmap = MemoryHeatmap() if args.heatmap else None
+        if args.jobs == '-':
+            stats = run_jobs(sys.stdin, sys.stdout, coverage=coverage, sandbox=args.sandbox,
+                             heatmap=heatmap)
+        else:
+            with open(args.jobs, 'r') as f:
+                stats = run_jobs(f, sys.stdout, coverage=coverage, sandbox=args.sandbox,
+                                 heatmap=heatmap)
+        if args.coverage:
+            write_coverage(args.coverage, coverage.values())
+        if args.heatmap:
+            heatmap.save(args.heatmap)
+        if args.stats:
+            print(STATS_FORMATS[args.stats](stats), end='', file=sys.stderr)
+        return
+    if args.replay:
+        sys.exit(replay_file(args.replay, args.sandbox))
+    if args.assembly_file is None:
+        parser.error("an assembly file, --jobs or --replay is required")
 
     # Read the assembly file
     try:
-        with open(sys.argv[1], 'r') as f:
+        with open(args.assembly_file, 'r') as f:
             code = f.read()
     except FileNotFoundError:
-        print(f"Error: File {sys.argv[1]} not found")
+        print(f"Error: File {args.assembly_file} not found")
         sys.exit(1)
 
     # Initialize emulator
     emu = Emulator()
+    emu.set_io_handler(ConsoleIO())
+    emu.loop_fast_forward = not args.no_fast_forward
+    emu.superinstructions = not args.no_fuse
+    if args.sandbox:
+        emu.set_sandbox(args.sandbox)
     
     try:
         # Parse the program
         emu.parse_program(code)
+        if args.analyze:
+            print_analysis(emu.analyze())
+        if args.profile or args.collapsed:
+            emu.enable_profiling()
+        if args.coverage:
+            emu.enable_coverage()
+        if args.heatmap:
+            emu.enable_heatmap()
+        if args.record:
+            emu.start_recording()
         
-        # Extract code segment instructions
-        lines = code.split('\n')
-        instructions = []
-        in_code_segment = False
-        
-        for line in lines:
-            line = line.strip()
-            if not line or line.startswith(';'):
-                continue
-                
-            # Remove comments
-            line = line.split(';')[0].strip()
-            
-            # Check for segments
-            if line.lower().startswith('.model') or \
-               line.lower().startswith('.stack') or \
-               line.lower().startswith('.data'):
-                continue
-                
-            if line.lower().startswith('.code'):
-                in_code_segment = True
-                continue
-            
-            if in_code_segment and line:
-                instructions.append(line)
-        
-        # Execute instructions
-        for instruction in instructions:
-            emu.execute_instruction(instruction)
+        # Execute the program
+        if args.paced:
+            emu.run_paced(args.paced * 1e6)
+        else:
+            emu.run()
             
     except Exception as e:
         print(f"Error: {str(e)}")
         sys.exit(1)
 
+    if args.record:
+        emu.stop_recording().save(args.record)
+    if args.coverage:
+        write_coverage(args.coverage, [emu.get_coverage(args.assembly_file)])
+    if args.heatmap:
+        emu.heatmap.save(args.heatmap)
+    if args.screen:
+        print(emu.screen.text())
+    if args.cycles:
+        print(format_timing(emu.cycles), file=sys.stderr)
+    if args.stats:
+        print(STATS_FORMATS[args.stats](emu.get_stats()), end='', file=sys.stderr)
+    if args.profile:
+        print(emu.profiler.format_report(emu.instruction_count), file=sys.stderr)
+    if args.collapsed:
+        with open(args.collapsed, 'w') as f:
+            f.write(emu.get_collapsed_stacks())
+
 if __name__ == '__main__':
-    main() 
\ No newline at end of file
+    main()
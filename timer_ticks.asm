@@ -0,0 +1,55 @@
+.model small
+.stack 100h
+.data
+    ticks dw 0                        ; Timer ticks counted by the INT 1Ch hook
+    msg db 'Timer ticks: $'
+
+.code
+main proc
+    mov ax, @data                     ; Initialize data segment
+    mov ds, ax
+
+    ; Hook the user timer tick (INT 1Ch)
+    mov dx, offset tick
+    mov ah, 25h                       ; DOS set interrupt vector
+    mov al, 1ch
+    int 21h
+
+    ; Twenty delay loops of 65535 iterations each
+    mov bx, 20
+delay:
+    mov cx, 0ffffh
+spin:
+    loop spin
+    dec bx
+    jnz delay
+
+    ; Print the tick count in decimal
+    lea dx, msg
+    mov ah, 9
+    int 21h
+    mov ax, ticks
+    mov bx, 10
+    xor cx, cx
+split:
+    xor dx, dx
+    div bx                            ; Peel off the lowest digit
+    push dx
+    inc cx
+    cmp ax, 0
+    jnz split
+print:
+    pop dx
+    add dl, '0'
+    mov ah, 2                         ; DOS print character
+    int 21h
+    loop print
+
+    mov ah, 4ch                       ; Exit program
+    int 21h
+
+tick:
+    inc ticks
+    iret
+main endp
+end main